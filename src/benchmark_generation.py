@@ -0,0 +1,462 @@
+import sys
+import os
+beauvoir_path = os.path.dirname(os.path.realpath(__file__)) + '/'
+sys.path.append(beauvoir_path)
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+from PIL import Image
+import bpy
+
+from utils.image_classifier_generator import ImageClassifierGenerator
+from utils.image_detector_generator import ImageDetectorGenerator
+from utils.shapenet_data_manager import ShapeNetDataManager
+from utils.blender_utils import load_obj
+from utils.blender_utils import clear_scene
+from utils.blender_utils import get_scene_state
+from utils.blender_utils import reset_scene
+from utils.blender_utils import update_scene
+from utils.blender_utils import view_selected_object
+from utils.blender_utils import set_render_properties
+from utils.blender_utils import get_vertices
+from utils.blender_utils import get_convex_hull_vertices
+from utils.blender_utils import get_image_bounding_box
+from utils.blender_utils import add_plain_background
+from utils.blender_utils import add_array_background
+from utils.blender_utils import add_random_patch_background
+from utils.background_pool import BackgroundPool
+from utils.mesh_cache import MeshCache
+from utils.mesh_converter import convert_obj
+from utils.mesh_converter import convert_lods
+from utils.mesh_converter import get_available_lods
+from utils.xml_utils import write_xml
+from utils.xml_utils import make_xml
+from utils.xml_utils import XMLParser
+
+# Measures generation throughput on procedurally generated spheres, so no
+# ShapeNet or YCB download is needed. Run headless on the CPU with:
+# blender -bP benchmark_generation.py -- --output ../data/benchmark.json
+# Compare the written json files between versions to track regressions.
+# 'levels_of_detail' holds the mean absolute pixel difference (0 to 255)
+# and the box coordinate difference between images rendered from the
+# levels of detail and from the full meshes.
+
+
+def parse_benchmark_args(argv=None):
+    """ parses the benchmark arguments given to blender after '--'
+    args:
+        argv: list of strings. If None sys.argv is used.
+    returns:
+        args: namespace
+    """
+    if argv is None:
+        argv = sys.argv
+    if '--' in argv:
+        argv = argv[argv.index('--') + 1:]
+    else:
+        argv = []
+
+    def to_ints(string):
+        return [int(value) for value in string.split(',')]
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', type=str,
+                        default='../data/benchmark.json')
+    parser.add_argument('--work_path', type=str, default=None)
+    parser.add_argument('--vertex_counts', type=to_ints,
+                        default=[2000, 20000, 200000])
+    parser.add_argument('--resolutions', type=to_ints, default=[128, 300])
+    parser.add_argument('--objects_per_scene', type=to_ints,
+                        default=[1, 3, 5])
+    parser.add_argument('--num_images', type=int, default=20)
+    parser.add_argument('--num_repeats', type=int, default=20)
+    parser.add_argument('--render_profile', type=str, default='balanced')
+    parser.add_argument('--seed', type=int, default=777)
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def write_sphere_obj(filepath, num_vertices, material_name='material'):
+    """ writes an UV sphere of about 'num_vertices' vertices as .obj file
+    args:
+        filepath: string with the path of the .obj file
+        num_vertices: int
+        material_name: string used in the 'usemtl' line
+    returns:
+        int with the number of written vertices
+    """
+    num_rings = max(int(np.sqrt(num_vertices / 2.)), 3)
+    num_segments = 2 * num_rings
+    theta = np.linspace(0, np.pi, num_rings)
+    phi = np.linspace(0, 2 * np.pi, num_segments, endpoint=False)
+    theta, phi = np.meshgrid(theta, phi, indexing='ij')
+    vertices = np.stack([np.sin(theta) * np.cos(phi),
+                         np.cos(theta),
+                         np.sin(theta) * np.sin(phi)], axis=-1)
+    uvs = np.stack([phi / (2 * np.pi), theta / np.pi], axis=-1)
+    args = np.arange(num_rings * num_segments).reshape(
+        num_rings, num_segments)
+    next_args = np.roll(args, -1, axis=1)
+    quads = np.stack([args[:-1], args[1:], next_args[1:], next_args[:-1]],
+                     axis=-1).reshape(-1, 4) + 1
+    quads = np.repeat(quads, 2, axis=1)
+    with open(filepath, 'w') as obj_file:
+        obj_file.write('usemtl ' + material_name + '\n')
+        np.savetxt(obj_file, vertices.reshape(-1, 3), fmt='v %.6f %.6f %.6f')
+        np.savetxt(obj_file, uvs.reshape(-1, 2), fmt='vt %.6f %.6f')
+        np.savetxt(obj_file, quads, fmt='f %d/%d %d/%d %d/%d %d/%d')
+    return num_rings * num_segments
+
+
+def make_shapenet_tree(data_prefix, class_names, num_models_per_class,
+                       num_vertices):
+    """ writes spheres in the directory layout of ShapeNetCore.v2
+    args:
+        data_prefix: string with the dataset directory
+        class_names: list of ShapeNet class names
+        num_models_per_class: int
+        num_vertices: int with the number of vertices of every sphere
+    returns:
+        class_to_path: dictionary mapping every class to one model path
+    """
+    name_to_offset = dict((class_name, offset) for offset, class_name
+                          in ShapeNetDataManager(None).get_offset_to_name(
+                          ).items())
+    class_to_path = dict()
+    for class_name in class_names:
+        for model_arg in range(num_models_per_class):
+            model_path = (data_prefix + name_to_offset[class_name] + '/' +
+                          str(model_arg) + '/models/')
+            os.makedirs(model_path, exist_ok=True)
+            filepath = model_path + 'model_normalized.obj'
+            write_sphere_obj(filepath, num_vertices)
+            convert_obj(filepath)
+            convert_lods(filepath)
+            class_to_path.setdefault(class_name, filepath)
+    return class_to_path
+
+
+def make_backgrounds(background_path, num_images=4, size=(640, 480)):
+    os.makedirs(background_path, exist_ok=True)
+    random_state = np.random.RandomState(0)
+    for image_arg in range(num_images):
+        image = random_state.randint(0, 256, (size[1], size[0], 3))
+        Image.fromarray(image.astype(np.uint8)).save(
+            background_path + str(image_arg) + '.png')
+
+
+def time_function(function, num_repeats, teardown=None):
+    """ times a function several times
+    args:
+        function: function without arguments
+        num_repeats: int
+        teardown: function without arguments called after every run
+        outside of the timed region
+    returns:
+        dictionary with the mean, median, minimum and 95th percentile in
+        milliseconds
+    """
+    durations = []
+    for repeat_arg in range(num_repeats):
+        start_time = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start_time)
+        if teardown is not None:
+            teardown()
+    durations = np.asarray(durations) * 1e3
+    return {'num_repeats': num_repeats,
+            'mean_ms': float(np.mean(durations)),
+            'median_ms': float(np.median(durations)),
+            'min_ms': float(np.min(durations)),
+            'p95_ms': float(np.percentile(durations, 95))}
+
+
+def release_generator(generator, scene_state):
+    """ clears the mesh cache and material pool of a generator and removes
+    its datablocks, so that every run starts from the same scene
+    args:
+        generator: generator that already rendered
+        scene_state: dictionary returned by get_scene_state
+    returns:
+        None
+    """
+    generator.mesh_cache.clear()
+    if generator.material_pool is not None:
+        generator.material_pool.clear()
+    reset_scene(scene_state)
+
+
+def time_generator(generator, num_images, scene_state):
+    start_time = time.perf_counter()
+    generator.render()
+    elapsed_time = time.perf_counter() - start_time
+    release_generator(generator, scene_state)
+    return {'num_images': num_images,
+            'seconds': elapsed_time,
+            'images_per_second': num_images / elapsed_time}
+
+
+def benchmark_classifier(args, class_to_path, work_path, resolution,
+                         full_detail, scene_state):
+    save_path = work_path + 'runs/classifier/'
+    shutil.rmtree(save_path, ignore_errors=True)
+    num_images_per_class = max(args.num_images // len(class_to_path), 1)
+    generator = ImageClassifierGenerator(
+        class_to_path, save_path, num_images_per_class,
+        (resolution, resolution), render_profile=args.render_profile,
+        background='crop', background_images_directory=(
+            work_path + 'backgrounds/'),
+        full_detail=full_detail, cache_path=work_path + 'cache/',
+        seed=args.seed)
+    return time_generator(generator, num_images_per_class *
+                          len(class_to_path), scene_state)
+
+
+def compare_levels_of_detail(args, class_to_path, work_path, resolution,
+                             scene_state):
+    """ renders the same classifier images from the levels of detail and
+    from the full meshes and measures how much the images and the boxes
+    differ, i.e. what full_detail=False costs in accuracy
+    """
+    save_path = work_path + 'runs/levels_of_detail/'
+    num_images_per_class = max(args.num_images // len(class_to_path), 1)
+    samples = []
+    for full_detail in [False, True]:
+        shutil.rmtree(save_path, ignore_errors=True)
+        generator = ImageClassifierGenerator(
+            class_to_path, save_path, num_images_per_class,
+            (resolution, resolution), render_profile=args.render_profile,
+            background='crop', background_images_directory=(
+                work_path + 'backgrounds/'),
+            full_detail=full_detail, cache_path=work_path + 'cache/',
+            seed=args.seed)
+        samples.append([(image_array.astype(np.float32), boxes)
+                        for image_array, boxes, _, _
+                        in generator.generate_samples()])
+        release_generator(generator, scene_state)
+    pixel_differences, box_differences = [], []
+    for (lod_image, lod_boxes), (full_image, full_boxes) in zip(*samples):
+        pixel_differences.append(np.mean(np.abs(lod_image - full_image)))
+        box_differences.append(np.max(np.abs(lod_boxes - full_boxes)))
+    return {'num_images': len(pixel_differences),
+            'mean_pixel_difference': float(np.mean(pixel_differences)),
+            'max_pixel_difference': float(np.max(pixel_differences)),
+            'mean_box_difference': float(np.mean(box_differences)),
+            'max_box_difference': float(np.max(box_differences))}
+
+
+def benchmark_detector(args, data_prefix, class_names, work_path, resolution,
+                       num_objects, scene_state):
+    save_path = work_path + 'runs/detector/'
+    shutil.rmtree(save_path, ignore_errors=True)
+    generator = ImageDetectorGenerator(
+        data_prefix, save_path, class_names, args.num_images,
+        (resolution, resolution), render_profile=args.render_profile,
+        background='crop', background_images_directory=(
+            work_path + 'backgrounds/'),
+        max_num_objects_in_scene=num_objects,
+        cache_path=work_path + 'cache/', seed=args.seed)
+    return time_generator(generator, args.num_images, scene_state)
+
+
+def benchmark_load_obj(filepath, num_repeats, scene_state):
+    """ times loading a model with the .obj importer, from its converted
+    mesh, from its coarsest level of detail and from the mesh cache
+    """
+    def teardown():
+        reset_scene(scene_state)
+
+    results = dict()
+    results['import_obj'] = time_function(
+        lambda: load_obj(filepath, use_converted=False),
+        max(num_repeats // 4, 1), teardown)
+    results['converted'] = time_function(
+        lambda: load_obj(filepath), num_repeats, teardown)
+    available_lods = get_available_lods(filepath)
+    if len(available_lods) > 0:
+        lod = min(available_lods)
+        results['lod' + str(lod)] = time_function(
+            lambda: load_obj(filepath, lod=lod), num_repeats, teardown)
+    mesh_cache = MeshCache()
+    load_obj(filepath, mesh_cache=mesh_cache)
+    reset_scene(scene_state)
+    results['mesh_cache'] = time_function(
+        lambda: load_obj(filepath, mesh_cache=mesh_cache),
+        num_repeats, teardown)
+    mesh_cache.clear()
+    reset_scene(scene_state)
+    return results
+
+
+def benchmark_bounding_box(filepath, num_repeats, scene_state):
+    """ times projecting the bounding box with all vertices and with the
+    convex hull vertices
+    """
+    obj = load_obj(filepath)
+    obj.select = True
+    view_selected_object()
+    update_scene()
+    vertices = get_vertices(obj)
+    hull_vertices = get_convex_hull_vertices(obj)
+    results = {'num_vertices': len(vertices),
+               'num_hull_vertices': len(hull_vertices)}
+    results['all_vertices'] = time_function(
+        lambda: get_image_bounding_box(obj), num_repeats)
+    results['hull_vertices'] = time_function(
+        lambda: get_image_bounding_box(obj, hull_vertices), num_repeats)
+    results['convex_hull'] = time_function(
+        lambda: get_convex_hull_vertices(obj), max(num_repeats // 4, 1))
+    reset_scene(scene_state)
+    return results
+
+
+def benchmark_backgrounds(work_path, num_repeats, scene_state):
+    background_path = work_path + 'backgrounds/'
+    background_pool = BackgroundPool(background_path)
+    image_path = background_path + '0.png'
+    results = dict()
+    results['plain'] = time_function(
+        lambda: add_plain_background(np.random.randint(0, 256, 3).tolist()),
+        num_repeats)
+    results['array'] = time_function(
+        lambda: add_array_background(background_pool.sample_patch()),
+        num_repeats)
+    results['random_patch'] = time_function(
+        lambda: add_random_patch_background(
+            image_path, cache_path=work_path + 'cache/'),
+        num_repeats, lambda: reset_scene(scene_state))
+    reset_scene(scene_state)
+    return results
+
+
+def benchmark_annotations(work_path, class_names, num_annotations,
+                          num_repeats):
+    dataset_path = work_path + 'runs/annotations/'
+    shutil.rmtree(dataset_path, ignore_errors=True)
+    annotations_path = dataset_path + 'annotations/'
+    os.makedirs(annotations_path)
+    os.makedirs(dataset_path + 'images/')
+    random_state = np.random.RandomState(0)
+    coordinates = random_state.uniform(0, 1, (3, 4))
+    names = class_names[:3]
+    results = dict()
+    results['make_xml'] = time_function(
+        lambda: make_xml('benchmark', 'image', (300, 300, 3),
+                         coordinates, names), num_repeats)
+    start_time = time.perf_counter()
+    for image_arg in range(num_annotations):
+        write_xml(annotations_path + str(image_arg) + '.xml', 'benchmark',
+                  str(image_arg), (300, 300, 3), coordinates, names)
+    results['write_xml'] = {
+        'num_annotations': num_annotations,
+        'mean_ms': (time.perf_counter() - start_time) / num_annotations * 1e3}
+    data_loader = XMLParser(dataset_path, class_names)
+    results['load_data_uncached'] = time_function(
+        lambda: data_loader.load_data(use_cache=False),
+        max(num_repeats // 4, 1))
+    data_loader.load_data()
+    results['load_data_cached'] = time_function(
+        lambda: data_loader.load_data(), num_repeats)
+    results['load_data_cached']['num_annotations'] = num_annotations
+    return results
+
+
+def get_environment():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=beauvoir_path,
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'blender_version': bpy.app.version_string,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'git_commit': commit,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def run_benchmarks(args):
+    work_path = args.work_path
+    if work_path is None:
+        work_path = tempfile.mkdtemp(prefix='beauvoir_benchmark_')
+    work_path = os.path.join(work_path, '')
+    class_names = ['airplane', 'bottle', 'car', 'chair', 'mug']
+    make_backgrounds(work_path + 'backgrounds/')
+    clear_scene()
+    # every generator run is reset to this scene
+    run_scene_state = get_scene_state()
+    results = {'environment': get_environment(),
+               'config': vars(args),
+               'end_to_end': [],
+               'levels_of_detail': [],
+               'micro': []}
+    for num_vertices in args.vertex_counts:
+        data_prefix = work_path + 'shapenet_' + str(num_vertices) + '/'
+        class_to_path = make_shapenet_tree(data_prefix, class_names, 2,
+                                           num_vertices)
+        for resolution in args.resolutions:
+            for full_detail in [False, True]:
+                result = benchmark_classifier(
+                    args, class_to_path, work_path, resolution, full_detail,
+                    run_scene_state)
+                result.update({'generator': 'classifier',
+                               'num_vertices': num_vertices,
+                               'resolution': resolution,
+                               'full_detail': full_detail})
+                results['end_to_end'].append(result)
+            result = compare_levels_of_detail(
+                args, class_to_path, work_path, resolution, run_scene_state)
+            result.update({'num_vertices': num_vertices,
+                           'resolution': resolution})
+            results['levels_of_detail'].append(result)
+            for num_objects in args.objects_per_scene:
+                result = benchmark_detector(
+                    args, data_prefix, class_names, work_path, resolution,
+                    num_objects, run_scene_state)
+                result.update({'generator': 'detector',
+                               'num_vertices': num_vertices,
+                               'resolution': resolution,
+                               'max_num_objects_in_scene': num_objects})
+                results['end_to_end'].append(result)
+
+        set_render_properties((300, 300))
+        clear_scene()
+        scene_state = get_scene_state()
+        filepath = class_to_path[class_names[0]]
+        results['micro'].append({
+            'num_vertices': num_vertices,
+            'load_obj': benchmark_load_obj(
+                filepath, args.num_repeats, scene_state),
+            'bounding_box': benchmark_bounding_box(
+                filepath, args.num_repeats, scene_state)})
+
+    clear_scene()
+    scene_state = get_scene_state()
+    results['backgrounds'] = benchmark_backgrounds(
+        work_path, args.num_repeats, scene_state)
+    results['annotations'] = benchmark_annotations(
+        work_path, class_names, 1000, args.num_repeats)
+    if args.work_path is None:
+        shutil.rmtree(work_path, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    benchmark_args = parse_benchmark_args()
+    benchmark_results = run_benchmarks(benchmark_args)
+    output_directory = os.path.dirname(benchmark_args.output)
+    if output_directory != '' and not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    with open(benchmark_args.output, 'w') as output_file:
+        json.dump(benchmark_results, output_file, indent=4, sort_keys=True)
+    for result in benchmark_results['end_to_end']:
+        print(result)
+    print('results written to', benchmark_args.output)
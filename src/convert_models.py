@@ -0,0 +1,40 @@
+import sys
+import os
+beauvoir_path = os.path.dirname(os.path.realpath(__file__)) + '/'
+sys.path.append(beauvoir_path)
+from utils.shapenet_data_manager import ShapeNetDataManager
+from utils.ycb_data_manager import YCBVideoDataManager
+from utils.mesh_converter import convert_models
+
+# converts every .obj model into a '.npz' mesh next to it that
+# blender_utils.load_obj loads instead of running the .obj importer.
+# Decimated levels of detail ('.lod<faces>.npz') are written as well and
+# selected by the generators from the image resolution.
+# Run with the python interpreter, not blender: python convert_models.py
+shapenet_path = '../data/ShapeNetCore.v2/'
+shapenet_index_path = '../data/shapenet_index.sqlite'
+ycb_path = '../data/models/'
+num_workers = None
+
+filepaths = []
+if os.path.exists(shapenet_path):
+    data_manager = ShapeNetDataManager(shapenet_path,
+                                       index_path=shapenet_index_path)
+    filepaths.extend(data_manager.load_data().keys())
+if os.path.exists(ycb_path):
+    data_manager = YCBVideoDataManager(ycb_path, 'all')
+    filepaths.extend(data_manager.load_data().values())
+
+stats = convert_models(filepaths, num_workers)
+print('converted:', stats['num_converted'],
+      'up to date:', stats['num_skipped'],
+      'failed:', len(stats['failed_paths']),
+      'time:', stats['elapsed_time'])
+for num_faces, lod_stats in sorted(stats['lod_stats'].items()):
+    if lod_stats['num_models'] == 0:
+        continue
+    print('lod', num_faces, 'models:', lod_stats['num_models'],
+          'faces:', lod_stats['num_faces'],
+          'original faces:', lod_stats['num_original_faces'],
+          'reduction:', (lod_stats['num_original_faces'] /
+                         float(lod_stats['num_faces'])))
@@ -3,7 +3,15 @@ import os
 beauvoir_path = os.path.dirname(os.path.realpath(__file__)) + '/'
 sys.path.append(beauvoir_path)
 sys.path.append('/usr/local/lib/python3.5/dist-packages/')
+from collections import OrderedDict
 from utils.image_classifier_generator import ImageClassifierGenerator
+from utils.shapenet_data_manager import ShapeNetDataManager
+from utils.sharding import parse_worker_args
+from utils.sharding import is_parent
+from utils.sharding import render_in_workers
+from utils.sharding import get_shard
+from utils.sharding import get_worker_cache_path
+from utils.sharding import get_render_threads
 
 obj_model_directory = '../data/ShapeNetCore.v2/'
 save_path = '../data/crop_data/128x128/'
@@ -16,18 +24,59 @@ class_names = ['airplane', 'bench', 'bottle', 'bus', 'camera', 'can', 'car',
 
 num_images_per_class = 5
 resolution = (128, 128)
+render_profile = 'balanced'
+views_per_scene = 1
 background = 'crop'
 max_num_lamps = 3
 zoom_range = [-.3, .3]
 translation_range = [-.1, .1]
+cache_path = '../data/cache/'
+index_path = '../data/shapenet_index.sqlite'
+seed = 777
+
+# e.g. blender -bP generate_classification_data.py -- --num_workers 32
+worker_args = parse_worker_args()
+if is_parent(worker_args):
+    # the model index is refreshed once instead of once per worker
+    ShapeNetDataManager(obj_model_directory, index_path=index_path,
+                        refresh_index=True).load_data()
+    num_images = len(class_names) * num_images_per_class
+    render_in_workers(os.path.realpath(__file__), worker_args.num_workers,
+                      num_images, worker_args.blender_path,
+                      save_path + 'manifest.txt')
+    sys.exit(0)
+
+image_args = get_shard(num_images_per_class, worker_args.num_workers,
+                       worker_args.worker_arg)
+cache_path = get_worker_cache_path(cache_path, worker_args.worker_arg)
+num_render_threads = get_render_threads(worker_args.num_workers)
+
+# every class is rendered from its first model, in the same order in all
+# workers since the image args depend on the class order
+path_to_class = ShapeNetDataManager(obj_model_directory, class_names,
+                                    index_path).load_data()
+data = OrderedDict()
+for class_name in class_names:
+    class_paths = sorted(path for path, path_class_name
+                         in path_to_class.items()
+                         if path_class_name == class_name)
+    if len(class_paths) > 0:
+        data[class_name] = class_paths[0]
 
 image_generator = ImageClassifierGenerator(
-                        obj_model_directory, save_path,
-                        class_names, num_images_per_class,
-                        resolution, background=background,
+                        data, save_path,
+                        num_images_per_class=num_images_per_class,
+                        resolution=resolution,
+                        render_profile=render_profile,
+                        background=background,
                         background_images_directory=background_path,
                         max_num_lamps=max_num_lamps,
                         zoom_range=zoom_range,
-                        translation_range=translation_range)
+                        translation_range=translation_range,
+                        cache_path=cache_path,
+                        image_args=image_args,
+                        seed=seed,
+                        num_render_threads=num_render_threads,
+                        views_per_scene=views_per_scene)
 
 image_generator.render()
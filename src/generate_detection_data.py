@@ -4,6 +4,13 @@ beauvoir_path = os.path.dirname(os.path.realpath(__file__)) + '/'
 sys.path.append(beauvoir_path)
 sys.path.append('/usr/local/lib/python3.5/dist-packages/')
 from utils.image_detector_generator import ImageDetectorGenerator
+from utils.shapenet_data_manager import ShapeNetDataManager
+from utils.sharding import parse_worker_args
+from utils.sharding import is_parent
+from utils.sharding import render_in_workers
+from utils.sharding import get_shard
+from utils.sharding import get_worker_cache_path
+from utils.sharding import get_render_threads
 
 obj_model_directory = '../data/ShapeNetCore.v2/'
 save_path = '../data/detection_data/'
@@ -16,18 +23,44 @@ class_names = ['airplane', 'bench', 'bottle', 'bus', 'camera', 'can', 'car',
 
 num_images = 500
 resolution = (300, 300)
+render_profile = 'balanced'
 background = 'crop'
 max_num_lamps = 3
 translation_range = [-1, 1]
 max_num_objects_in_scene = 5
+cache_path = '../data/cache/'
+index_path = '../data/shapenet_index.sqlite'
+seed = 777
+
+# e.g. blender -bP generate_detection_data.py -- --num_workers 32
+worker_args = parse_worker_args()
+if is_parent(worker_args):
+    # the model index is refreshed once instead of once per worker
+    ShapeNetDataManager(obj_model_directory, index_path=index_path,
+                        refresh_index=True).load_data()
+    render_in_workers(os.path.realpath(__file__), worker_args.num_workers,
+                      num_images, worker_args.blender_path,
+                      save_path + 'manifest.txt')
+    sys.exit(0)
+
+image_args = get_shard(num_images, worker_args.num_workers,
+                       worker_args.worker_arg)
+cache_path = get_worker_cache_path(cache_path, worker_args.worker_arg)
+num_render_threads = get_render_threads(worker_args.num_workers)
 
 image_generator = ImageDetectorGenerator(
                         obj_model_directory, save_path,
                         class_names, num_images,
-                        resolution, background=background,
+                        resolution, render_profile=render_profile,
+                        background=background,
                         background_images_directory=background_path,
                         max_num_lamps=max_num_lamps,
                         translation_range=translation_range,
-                        max_num_objects_in_scene=max_num_objects_in_scene)
+                        max_num_objects_in_scene=max_num_objects_in_scene,
+                        cache_path=cache_path,
+                        image_args=image_args,
+                        seed=seed,
+                        num_render_threads=num_render_threads,
+                        index_path=index_path)
 
 image_generator.render()
@@ -0,0 +1,124 @@
+import sys
+import os
+beauvoir_path = os.path.dirname(os.path.realpath(__file__)) + '/'
+sys.path.append(beauvoir_path)
+import numpy as np
+import pytest
+
+from utils.camera_utils import get_intrinsics
+from utils.camera_utils import get_view_frame_intrinsics
+from utils.camera_utils import get_world_to_camera
+from utils.camera_utils import get_camera_to_world
+from utils.camera_utils import look_at
+from utils.camera_utils import project_points
+from utils.camera_utils import get_bounding_boxes
+from utils.camera_utils import get_visible_fractions
+
+# Run with: python -m pytest test_camera_utils.py
+# The test against blender's world_to_camera_view is skipped without bpy.
+
+resolution = (100, 100)
+# camera on the -y axis looking at the origin with z up
+camera_location = (0., -5., 0.)
+
+
+@pytest.fixture
+def world_to_camera():
+    return look_at(camera_location)
+
+
+@pytest.fixture
+def intrinsics():
+    return get_intrinsics(50., 36., resolution)
+
+
+def test_origin_projects_to_principal_point(world_to_camera, intrinsics):
+    image_points, depths = project_points(
+        [[0., 0., 0.]], world_to_camera, intrinsics)
+    assert np.allclose(image_points, [[50., 50.]])
+    assert np.allclose(depths, [5.])
+
+
+def test_known_projection(world_to_camera, intrinsics):
+    image_points, depths = project_points(
+        [[1., 0., 0.], [0., 5., 2.]], world_to_camera, intrinsics)
+    focal_pixels = 50. / 36. * 100.
+    assert np.allclose(image_points[0], [50. + focal_pixels / 5., 50.])
+    assert np.allclose(image_points[1], [50., 50. - focal_pixels * 2. / 10.])
+    assert np.allclose(depths, [5., 10.])
+
+
+def test_image_y_axis_points_down(world_to_camera, intrinsics):
+    image_points, _ = project_points(
+        [[0., 0., 1.], [0., 0., -1.]], world_to_camera, intrinsics)
+    assert image_points[0, 1] < 50. < image_points[1, 1]
+    assert np.allclose(image_points[:, 0], 50.)
+
+
+def test_points_behind_camera(world_to_camera, intrinsics):
+    points = [[0., 0., 0.], [0., -10., 0.]]
+    image_points, depths = project_points(points, world_to_camera, intrinsics)
+    assert depths[1] < 0.
+    fractions = get_visible_fractions(image_points, depths, resolution)
+    assert fractions == 0.
+
+
+def test_point_at_camera_depth_projects_to_principal_point(
+        world_to_camera, intrinsics):
+    image_points, depths = project_points(
+        [[1., -5., 1.]], world_to_camera, intrinsics)
+    assert depths[0] == 0.
+    assert np.allclose(image_points, [[50., 50.]])
+
+
+def test_batched_poses(intrinsics):
+    world_to_camera = look_at([camera_location, (5., 0., 0.)])
+    image_points, depths = project_points(
+        [[0., 0., 0.], [0., 0., 1.]], world_to_camera, intrinsics)
+    assert image_points.shape == (2, 2, 2)
+    assert np.allclose(image_points[:, 0], 50.)
+    assert np.allclose(depths[:, 0], 5.)
+
+
+def test_camera_to_world_round_trip(world_to_camera):
+    camera_to_world = get_camera_to_world(world_to_camera)
+    # blender cameras sit at their location and look along their -z axis
+    assert np.allclose(camera_to_world[:3, 3], camera_location)
+    assert np.allclose(camera_to_world[:3, 2], [0., -1., 0.])
+    assert np.allclose(get_world_to_camera(camera_to_world), world_to_camera)
+
+
+def test_view_frame_intrinsics_match_sensor_intrinsics():
+    half_size = 16. / 35.
+    # corners in the order of blender's camera.view_frame
+    view_frame = [[half_size, half_size, -1.], [half_size, -half_size, -1.],
+                  [-half_size, -half_size, -1.], [-half_size, half_size, -1.]]
+    assert np.allclose(get_view_frame_intrinsics(view_frame, resolution),
+                       get_intrinsics(35., 32., resolution))
+
+
+def test_bounding_boxes_are_clipped():
+    image_points = np.array([[-50., 20.], [50., 150.]])
+    boxes = get_bounding_boxes(image_points, resolution)
+    assert np.allclose(boxes, [0., 0.2, 0.5, 1.])
+    fractions = get_visible_fractions(image_points, np.ones(2), resolution)
+    assert np.allclose(fractions, (0.5 * 0.8) / (1. * 1.3))
+
+
+def test_to_camera_view_batch_matches_blender():
+    bpy = pytest.importorskip('bpy')
+    from mathutils import Vector
+    from bpy_extras.object_utils import world_to_camera_view
+    from utils.blender_utils import to_camera_view_batch
+
+    scene = bpy.context.scene
+    scene.render.resolution_x, scene.render.resolution_y = 320, 240
+    camera = bpy.data.objects['Camera']
+    camera.data.type = 'PERSP'
+    points = np.random.RandomState(0).uniform(-2., 2., (32, 3))
+    projections = to_camera_view_batch(scene, camera, None, points)
+    for point, projection in zip(points, projections):
+        expected = world_to_camera_view(scene, camera, Vector(point))
+        # blender image coordinates have their y axis pointing up and
+        # points behind the camera have negative depths
+        assert np.allclose(projection, tuple(expected), atol=1e-5)
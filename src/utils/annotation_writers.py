@@ -0,0 +1,249 @@
+import os
+import json
+import fcntl
+
+from .xml_utils import make_xml
+from .manifest import append_lines
+
+
+class VOCWriter(object):
+    """ writes one Pascal VOC xml file per image inside 'annotations_path'.
+    Annotations are kept in memory and written every 'buffer_size' images
+    or when flush is called.
+
+    # Arguments
+        annotations_path: string with the annotations directory
+        folder_name: string written in the 'folder' tag
+        pretty: boolean. If True the xml files are indented
+        buffer_size: int with the number of annotations written at once
+    """
+
+    def __init__(self, annotations_path, folder_name='CLARA2017',
+                 pretty=False, buffer_size=100):
+        self.annotations_path = annotations_path
+        self.folder_name = folder_name
+        self.pretty = pretty
+        self.buffer_size = buffer_size
+        self.buffer = []
+        if not os.path.exists(self.annotations_path):
+            os.makedirs(self.annotations_path)
+
+    def write(self, image_arg, image_name, img_shape, coordinates, names,
+              extras=None):
+        """ adds the annotation of one image
+        args:
+            image_arg: int identifying the image
+            image_name: string with the image path including its extension
+            img_shape: list of three ints (width, height, depth)
+            coordinates: array of shape (num_objects, 4) with the boxes
+            names: list of strings with the class name of every object
+            extras: list with a dictionary of additional fields for every
+            object, e.g. 'visible_box', 'box_area_ratio', 'num_pixels'
+            and 'mask'
+        returns:
+            boolean indicating if the buffer was flushed
+        """
+        xml_pathname = self.annotations_path + str(image_arg) + '.xml'
+        xml_string = make_xml(self.folder_name, image_name, img_shape,
+                              coordinates, names, self.pretty, extras)
+        self.buffer.append((xml_pathname, xml_string))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        for xml_pathname, xml_string in self.buffer:
+            with open(xml_pathname, 'w') as xml_file:
+                xml_file.write(xml_string)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+
+class JSONLinesWriter(object):
+    """ appends one json object per image to a single file. Annotations
+    are kept in memory and written every 'buffer_size' images or when
+    flush is called.
+
+    # Arguments
+        filepath: string with the path of the '.jsonl' file
+        buffer_size: int with the number of annotations written at once
+    """
+
+    def __init__(self, filepath, buffer_size=100):
+        self.filepath = filepath
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def write(self, image_arg, image_name, img_shape, coordinates, names,
+              extras=None):
+        """ adds the annotation of one image
+        args:
+            image_arg: int identifying the image
+            image_name: string with the image path including its extension
+            img_shape: list of three ints (width, height, depth)
+            coordinates: array of shape (num_objects, 4) with the boxes
+            names: list of strings with the class name of every object
+            extras: list with a dictionary of additional fields for every
+            object, e.g. 'visible_box', 'box_area_ratio', 'num_pixels'
+            and 'mask'
+        returns:
+            boolean indicating if the buffer was flushed
+        """
+        objects = []
+        for object_arg, (name, box) in enumerate(zip(names, coordinates)):
+            obj = {'name': name, 'box': [float(value) for value in box]}
+            if extras is not None:
+                obj.update(extras[object_arg])
+            objects.append(obj)
+        record = {'image_arg': image_arg,
+                  'filename': image_name,
+                  'size': [int(value) for value in img_shape],
+                  'objects': objects}
+        self.buffer.append(json.dumps(record) + '\n')
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        append_lines(self.filepath, self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+
+    def read(self):
+        """ reads all annotations written so far by any worker. If an
+        image was written more than once, e.g. after resuming a run, the
+        last one is kept.
+        args:
+            None
+        returns:
+            list of dictionaries
+        """
+        if not os.path.exists(self.filepath):
+            return []
+        arg_to_record = dict()
+        with open(self.filepath, 'r') as jsonl_file:
+            for line in jsonl_file:
+                if not line.endswith('\n'):
+                    continue
+                record = json.loads(line)
+                arg_to_record[record['image_arg']] = record
+        return list(arg_to_record.values())
+
+
+class COCOWriter(JSONLinesWriter):
+    """ writes a single COCO style json file when closed. Annotations are
+    staged in a '.jsonl' file next to it, so interrupted runs can be
+    resumed without losing them.
+
+    # Arguments
+        filepath: string with the path of the '.json' file
+        class_names: list of strings used as categories. If None
+        categories are created in order of appearance.
+        buffer_size: int with the number of annotations written at once
+    """
+
+    def __init__(self, filepath, class_names=None, buffer_size=100):
+        staging_filepath = os.path.splitext(filepath)[0] + '.jsonl'
+        super(COCOWriter, self).__init__(staging_filepath, buffer_size)
+        self.coco_filepath = filepath
+        self.class_names = class_names
+
+    def close(self):
+        """ writes the COCO file from the records staged by all workers.
+        Workers share the staging file, so the worker closing last sees
+        every record. The lock keeps workers closing at the same time from
+        writing an older view after a newer one.
+        args:
+            None
+        returns:
+            None
+        """
+        self.flush()
+        with open(self.coco_filepath + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                temporary_path = (self.coco_filepath + '.' +
+                                  str(os.getpid()) + '.tmp')
+                with open(temporary_path, 'w') as coco_file:
+                    json.dump(self.to_coco(self.read()), coco_file)
+                os.replace(temporary_path, self.coco_filepath)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def to_coco(self, records):
+        """ converts the staged records into a COCO dictionary. Boxes are
+        converted from normalized corners to [x, y, width, height] pixels.
+        args:
+            records: list of dictionaries returned by read
+        returns:
+            dictionary with 'images', 'annotations' and 'categories'
+        """
+        class_names = list(self.class_names or [])
+        images, annotations = [], []
+        for record in sorted(records, key=lambda record: record['image_arg']):
+            width, height = record['size'][0:2]
+            images.append({'id': record['image_arg'],
+                           'file_name': record['filename'],
+                           'width': width, 'height': height})
+            for obj in record['objects']:
+                if obj['name'] not in class_names:
+                    class_names.append(obj['name'])
+                x_min, y_min, x_max, y_max = obj['box']
+                x_min, x_max = sorted([x_min, x_max])
+                y_min, y_max = sorted([y_min, y_max])
+                box_width = (x_max - x_min) * width
+                box_height = (y_max - y_min) * height
+                annotation = {
+                    'id': len(annotations) + 1,
+                    'image_id': record['image_arg'],
+                    'category_id': class_names.index(obj['name']) + 1,
+                    'bbox': [x_min * width, y_min * height,
+                             box_width, box_height],
+                    'area': box_width * box_height,
+                    'iscrowd': 0}
+                if 'mask' in obj:
+                    annotation['segmentation'] = obj['mask']
+                    annotation['area'] = obj.get('num_pixels',
+                                                 annotation['area'])
+                if 'visible_box' in obj:
+                    x_min, y_min, x_max, y_max = obj['visible_box']
+                    annotation['visible_bbox'] = [
+                        x_min * width, y_min * height,
+                        (x_max - x_min) * width, (y_max - y_min) * height]
+                if 'box_area_ratio' in obj:
+                    annotation['box_area_ratio'] = obj['box_area_ratio']
+                annotations.append(annotation)
+        categories = [{'id': class_arg + 1, 'name': class_name}
+                      for class_arg, class_name in enumerate(class_names)]
+        return {'images': images,
+                'annotations': annotations,
+                'categories': categories}
+
+
+def get_annotation_writer(annotation_format, save_path, class_names=None,
+                          buffer_size=100):
+    """ builds the annotation writer of the given format
+    args:
+        annotation_format: string, either 'voc', 'jsonl' or 'coco'
+        save_path: string with the dataset directory
+        class_names: list of strings, only used by 'coco'
+        buffer_size: int with the number of annotations written at once
+    returns:
+        VOCWriter, JSONLinesWriter or COCOWriter
+    """
+    if annotation_format == 'voc':
+        return VOCWriter(save_path + 'annotations/', buffer_size=buffer_size)
+    elif annotation_format == 'jsonl':
+        return JSONLinesWriter(save_path + 'annotations.jsonl', buffer_size)
+    elif annotation_format == 'coco':
+        return COCOWriter(save_path + 'annotations.json', class_names,
+                          buffer_size)
+    else:
+        raise Exception("Annotation formats available are: "
+                        "'voc', 'jsonl' or 'coco'")
@@ -0,0 +1,101 @@
+import os
+import glob
+import random
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+
+class BackgroundPool(object):
+    """ decodes the '.png' background images of a directory on first use
+    and takes random crops from them as numpy slices. Decoded images are
+    kept in memory up to 'max_megabytes', older ones are decoded again when
+    needed. If all images do not fit in 'max_megabytes' they are stored as
+    '.npy' files and memory mapped instead of being kept in memory.
+
+    # Arguments
+        background_images_directory: string with the images directory
+        cache_path: string with the directory for the memory mapped
+        images. If None 'decoded/' inside the images directory is used so
+        that all workers share the same files.
+        max_megabytes: float with the maximum memory for decoded images.
+    """
+
+    def __init__(self, background_images_directory, cache_path=None,
+                 max_megabytes=2048):
+        self.image_paths = sorted(glob.glob(
+                        background_images_directory + '*.png'))
+        if len(self.image_paths) == 0:
+            raise Exception(
+                    "There are no files with '.png' prefix in directory",
+                    background_images_directory)
+        if cache_path is None:
+            cache_path = background_images_directory + 'decoded/'
+        self.cache_path = cache_path
+        self.max_megabytes = max_megabytes
+        self.use_memory_map = self._get_num_megabytes() > max_megabytes
+        self.path_to_image = OrderedDict()
+        self.num_megabytes = 0.
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def sample_patch(self, box_size=200):
+        """ takes a random crop of a random background image
+        args:
+            box_size: length of random box
+        returns:
+            numpy array of shape (box_size, box_size, 3) and type uint8 or
+            None if the selected image is not larger than box_size.
+        """
+        image = self._get_image(random.choice(self.image_paths))
+        height, width = image.shape[0:2]
+        if height <= box_size or width <= box_size:
+            return None
+        x_min = np.random.randint(0, width - box_size)
+        y_min = np.random.randint(0, height - box_size)
+        return image[y_min:(y_min + box_size), x_min:(x_min + box_size)]
+
+    def _get_image(self, image_path):
+        image = self.path_to_image.get(image_path)
+        if image is not None:
+            self.path_to_image.move_to_end(image_path)
+            return image
+        image = self._load(image_path)
+        self.path_to_image[image_path] = image
+        if not self.use_memory_map:
+            self.num_megabytes = self.num_megabytes + image.nbytes / 1e6
+            while (self.num_megabytes > self.max_megabytes and
+                   len(self.path_to_image) > 1):
+                path, evicted_image = self.path_to_image.popitem(last=False)
+                self.num_megabytes = (self.num_megabytes -
+                                      evicted_image.nbytes / 1e6)
+        return image
+
+    def _get_num_megabytes(self):
+        num_bytes = 0
+        for image_path in self.image_paths:
+            width, height = Image.open(image_path).size
+            num_bytes = num_bytes + (width * height * 3)
+        return num_bytes / 1e6
+
+    def _load(self, image_path):
+        if not self.use_memory_map:
+            return self._decode(image_path)
+        array_path = (self.cache_path +
+                      os.path.basename(image_path)[:-4] + '.npy')
+        if (not os.path.exists(array_path) or
+                os.path.getmtime(array_path) < os.path.getmtime(image_path)):
+            if not os.path.exists(self.cache_path):
+                os.makedirs(self.cache_path, exist_ok=True)
+            # other workers may be reading the same file
+            temporary_path = array_path + '.' + str(os.getpid()) + '.tmp'
+            with open(temporary_path, 'wb') as array_file:
+                np.save(array_file, self._decode(image_path))
+            os.replace(temporary_path, array_path)
+        return np.load(array_path, mmap_mode='r')
+
+    def _decode(self, image_path):
+        image = Image.open(image_path).convert('RGB')
+        return np.asarray(image, dtype=np.uint8)
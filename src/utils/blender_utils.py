@@ -1,11 +1,131 @@
+import os
 import bpy
+import bmesh
 import numpy as np
 from mathutils import Vector
+from mathutils import Matrix
 from PIL import Image
 
-
-def load_obj(filepath, obj_name='mesh'):
+from .mesh_converter import is_converted
+from .mesh_converter import get_converted_path
+from .mesh_converter import get_lod_path
+from .camera_utils import get_world_to_camera
+from .camera_utils import get_camera_to_world
+from .camera_utils import get_view_frame_intrinsics
+from .camera_utils import look_at
+from .camera_utils import project_points
+from .camera_utils import get_bounding_boxes
+from .camera_utils import get_visible_fractions
+from .camera_utils import sample_camera_locations
+
+
+def load_obj(filepath, obj_name='mesh', mesh_cache=None, use_converted=True,
+             lod=None, material_pool=None):
     """ load .obj file in blender
+    args:
+        filepath: str filepath to the .obj filename.
+        obj_name: string for object name in blender.
+        mesh_cache: MeshCache instance. If given, meshes already imported
+        from filepath are reused instead of parsing the .obj file again.
+        use_converted: boolean. If True and an up to date mesh converted by
+        mesh_converter exists it is loaded instead of the .obj file.
+        lod: int with the number of triangles of a level of detail written
+        by mesh_converter.convert_lods. If None the full mesh is loaded.
+        material_pool: MaterialPool instance used for the materials of
+        cached meshes.
+    returns:
+        obj_object: loaded object in blender.
+    """
+    mesh_key = filepath if lod is None else get_lod_path(filepath, lod)
+    if mesh_cache is not None:
+        entry = mesh_cache.get(mesh_key)
+        if entry is not None:
+            obj_object = instantiate_mesh(entry, obj_name, material_pool)
+            obj_object['filepath'] = filepath
+            obj_object['mesh_key'] = mesh_key
+            return obj_object
+    if lod is not None:
+        obj_object = load_converted_obj(mesh_key, obj_name)
+    elif use_converted and is_converted(filepath):
+        obj_object = load_converted_obj(get_converted_path(filepath), obj_name)
+    else:
+        obj_object = import_obj(filepath, obj_name)
+    obj_object['filepath'] = filepath
+    obj_object['mesh_key'] = mesh_key
+    if mesh_cache is not None:
+        mesh_cache.put(mesh_key, obj_object)
+        # the cached materials are templates of later instances
+        if mesh_key in mesh_cache:
+            link_material_copies(obj_object, material_pool)
+    return obj_object
+
+
+def replace_mesh(obj, lod=None, mesh_cache=None, material_pool=None):
+    """ replaces a placed object by another level of detail of its model.
+    The new object keeps the pose, pass index and materials of the object,
+    which is deleted.
+    args:
+        obj: blender object loaded with load_obj
+        lod: int with the level of detail or None for the full mesh
+        mesh_cache: MeshCache instance given to load_obj
+        material_pool: MaterialPool instance given to load_obj
+    returns:
+        new blender object
+    """
+    obj_name = obj.name
+    filepath = obj['filepath']
+    location = obj.location.copy()
+    delta_rotation = obj.delta_rotation_euler.copy()
+    pass_index = obj.pass_index
+    materials = [slot.material for slot in obj.material_slots]
+    delete_object(obj)
+    new_obj = load_obj(filepath, obj_name, mesh_cache, lod=lod,
+                       material_pool=material_pool)
+    new_obj.location = location
+    new_obj.delta_rotation_euler = delta_rotation
+    new_obj.pass_index = pass_index
+    if len(new_obj.material_slots) == len(materials):
+        for slot, material in zip(new_obj.material_slots, materials):
+            slot.link = 'OBJECT'
+            slot.material = material
+    else:
+        change_color(new_obj)
+    return new_obj
+
+
+def update_level_of_detail(obj, lod_selector, hull_cache, mesh_cache=None,
+                           material_pool=None):
+    """ selects the level of detail of a placed object from the area of its
+    projected bounding box and loads that level if it differs from the
+    loaded one
+    args:
+        obj: blender object loaded with load_obj
+        lod_selector: mesh_converter.LODSelector instance
+        hull_cache: ConvexHullCache instance
+        mesh_cache: MeshCache instance given to load_obj
+        material_pool: MaterialPool instance given to load_obj
+    returns:
+        obj: the given or the new blender object
+        box_coordinates: list of floats with the bounding box of obj as
+        returned by get_image_bounding_box
+    """
+    box_coordinates = get_image_bounding_box(
+        obj, hull_cache.get_vertices(obj))
+    x_min, y_min, x_max, y_max = box_coordinates
+    box_area = abs((x_max - x_min) * (y_max - y_min))
+    filepath = obj['filepath']
+    lod = lod_selector.select(filepath, box_area)
+    mesh_key = filepath if lod is None else get_lod_path(filepath, lod)
+    if mesh_key != obj['mesh_key']:
+        obj = replace_mesh(obj, lod, mesh_cache, material_pool)
+        box_coordinates = get_image_bounding_box(
+            obj, hull_cache.get_vertices(obj))
+    return obj, box_coordinates
+
+
+def import_obj(filepath, obj_name='mesh'):
+    """ imports .obj file with the blender importer and moves its origin
+    to its lowest point
     args:
         filepath: str filepath to the .obj filename.
         obj_name: string for object name in blender.
@@ -23,6 +143,153 @@ def load_obj(filepath, obj_name='mesh'):
     return obj_object
 
 
+def load_converted_obj(converted_path, obj_name='mesh'):
+    """ builds a blender object from a mesh converted by mesh_converter.
+    The origin of the converted mesh is already at its lowest point.
+    args:
+        converted_path: str filepath to the '.npz' file.
+        obj_name: string for object name in blender.
+    returns:
+        obj_object: loaded object in blender.
+    """
+    arrays = np.load(converted_path)
+    vertices = arrays['vertices']
+    loop_vertex_args = arrays['loop_vertex_args']
+    loop_totals = arrays['loop_totals']
+    loop_starts = np.zeros_like(loop_totals)
+    loop_starts[1:] = np.cumsum(loop_totals)[:-1]
+
+    mesh = bpy.data.meshes.new(obj_name)
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set('co', vertices.ravel())
+    mesh.loops.add(len(loop_vertex_args))
+    mesh.loops.foreach_set('vertex_index', loop_vertex_args)
+    mesh.polygons.add(len(loop_totals))
+    mesh.polygons.foreach_set('loop_start', loop_starts)
+    mesh.polygons.foreach_set('loop_total', loop_totals)
+
+    uvs = arrays['uvs']
+    if len(uvs) > 0:
+        loop_uv_args = arrays['loop_uv_args']
+        loop_uvs = uvs[np.maximum(loop_uv_args, 0)]
+        loop_uvs[loop_uv_args < 0] = 0.
+        mesh.uv_textures.new()
+        mesh.uv_layers[0].data.foreach_set('uv', loop_uvs.ravel())
+
+    directory = os.path.dirname(converted_path)
+    for material_arg, material_name in enumerate(arrays['material_names']):
+        material = bpy.data.materials.new(name=str(material_name))
+        set_obj_material(
+            material, arrays['material_diffuse'][material_arg],
+            arrays['material_specular'][material_arg],
+            float(arrays['material_hardness'][material_arg]),
+            float(arrays['material_alpha'][material_arg]),
+            str(arrays['material_textures'][material_arg]), directory)
+        mesh.materials.append(material)
+    mesh.polygons.foreach_set('material_index', arrays['material_args'])
+    mesh.update(calc_edges=True)
+    # the faces are taken from the .obj file as they are
+    mesh.validate()
+
+    scene = bpy.context.scene
+    obj_object = bpy.data.objects.new(name=obj_name, object_data=mesh)
+    scene.objects.link(obj_object)
+    for selected_object in bpy.context.selected_objects:
+        selected_object.select = False
+    obj_object.select = True
+    scene.objects.active = obj_object
+    return obj_object
+
+
+def set_obj_material(material, diffuse, specular, hardness, alpha,
+                     texture='', directory=''):
+    """ sets up a material as the blender .obj importer does for a .mtl
+    material
+    args:
+        material: blender material
+        diffuse: list of three floats with the Kd color
+        specular: list of three floats with the Ks color
+        hardness: float with the Ns exponent
+        alpha: float with the d opacity
+        texture: string with the path of the map_Kd image relative to
+        'directory'. If empty no texture is added.
+        directory: string with the directory of the .obj file
+    returns:
+        None
+    """
+    material.diffuse_color = [float(value) for value in diffuse]
+    material.diffuse_intensity = 1.0
+    material.specular_color = [float(value) for value in specular]
+    material.specular_intensity = 1.0
+    material.specular_hardness = int((hardness * 0.51) + 1)
+    if alpha < 1.0:
+        material.use_transparency = True
+        material.transparency_method = 'Z_TRANSPARENCY'
+        material.alpha = alpha
+    if texture == '':
+        return
+    try:
+        image = bpy.data.images.load(os.path.join(directory, texture),
+                                     check_existing=True)
+    except RuntimeError:
+        print('texture', texture, 'of', directory, 'could not be loaded')
+        return
+    image_texture = bpy.data.textures.new(name='Kd', type='IMAGE')
+    image_texture.image = image
+    texture_slot = material.texture_slots.add()
+    texture_slot.texture = image_texture
+    texture_slot.texture_coords = 'UV'
+    texture_slot.use_map_color_diffuse = True
+
+
+def instantiate_mesh(entry, obj_name='mesh', material_pool=None):
+    """ creates a new object sharing the mesh of a MeshCache entry.
+    Materials are linked to the object as copies, so that changing the
+    color of one instance does not change the others.
+    args:
+        entry: dictionary returned by MeshCache.get
+        obj_name: string for object name in blender.
+        material_pool: MaterialPool instance. If given the copies are
+        taken from it instead of being created.
+    returns:
+        obj_object: new blender object
+    """
+    scene = bpy.context.scene
+    obj_object = bpy.data.objects.new(name=obj_name, object_data=entry['mesh'])
+    scene.objects.link(obj_object)
+    obj_object.rotation_euler = entry['rotation']
+    obj_object.scale = entry['scale']
+    obj_object.location = (0., 0., 0.)
+    link_material_copies(obj_object, material_pool)
+    for selected_object in bpy.context.selected_objects:
+        selected_object.select = False
+    obj_object.select = True
+    scene.objects.active = obj_object
+    return obj_object
+
+
+def link_material_copies(obj_object, material_pool=None):
+    """ replaces the materials of the mesh by copies linked to the object,
+    so that changing the color of the object keeps the mesh materials
+    args:
+        obj_object: blender object
+        material_pool: MaterialPool instance. If given the copies are
+        taken from it instead of being created.
+    returns:
+        None
+    """
+    for slot in obj_object.material_slots:
+        if slot.material is None:
+            continue
+        if material_pool is not None:
+            material = material_pool.acquire(slot.material)
+        else:
+            material = slot.material.copy()
+            material.use_fake_user = False
+        slot.link = 'OBJECT'
+        slot.material = material
+
+
 def get_object_lowest_point(obj):
     """ returns lowest location of the object:
     args:
@@ -51,18 +318,83 @@ def move_origin(location, axis='z'):
     bpy.context.scene.cursor_location = saved_location
 
 
-def set_render_properties(resolution=(500, 500), resolution_percentage=100):
+# Blender internal settings tuned for CPU throughput. Every image is
+# rendered as a few large tiles and all cores are used.
+RENDER_PROFILES = {
+    'fast-preview': {'use_antialiasing': False,
+                     'antialiasing_samples': '5',
+                     'use_raytrace': False,
+                     'use_shadows': False,
+                     'use_sss': False,
+                     'use_envmap': False,
+                     'tile_size': 64,
+                     'compression': 0,
+                     'color_depth': '8'},
+    'balanced': {'use_antialiasing': True,
+                 'antialiasing_samples': '5',
+                 'use_raytrace': True,
+                 'use_shadows': True,
+                 'use_sss': False,
+                 'use_envmap': False,
+                 'tile_size': 64,
+                 'compression': 15,
+                 'color_depth': '8'},
+    'quality': {'use_antialiasing': True,
+                'antialiasing_samples': '16',
+                'use_raytrace': True,
+                'use_shadows': True,
+                'use_sss': True,
+                'use_envmap': True,
+                'tile_size': 128,
+                'compression': 15,
+                'color_depth': '8'}}
+
+
+def set_render_properties(resolution=(500, 500), resolution_percentage=100,
+                          render_profile=None, num_threads=None):
     """
     args:
         resolution: list of int indicating the height and width of the
         image to be rendered.
         resolution_percentage: int between [1, 100]
+        render_profile: string with a key of RENDER_PROFILES. If None the
+        settings of the startup file are kept.
+        num_threads: int with the number of render threads. If None
+        blender uses all cpus, which oversubscribes them when several
+        blender processes render at once.
     returns:
         None
     """
-    bpy.context.scene.render.resolution_x = resolution[0]
-    bpy.context.scene.render.resolution_y = resolution[1]
-    bpy.context.scene.render.resolution_percentage = resolution_percentage
+    render = bpy.context.scene.render
+    render.resolution_x = resolution[0]
+    render.resolution_y = resolution[1]
+    render.resolution_percentage = resolution_percentage
+    if num_threads is None:
+        render.threads_mode = 'AUTO'
+    else:
+        render.threads_mode = 'FIXED'
+        render.threads = num_threads
+    if render_profile is None:
+        return
+    if render_profile not in RENDER_PROFILES:
+        raise Exception('Render profiles available are:',
+                        list(RENDER_PROFILES.keys()))
+    settings = RENDER_PROFILES[render_profile]
+    render.engine = 'BLENDER_RENDER'
+    render.use_antialiasing = settings['use_antialiasing']
+    render.antialiasing_samples = settings['antialiasing_samples']
+    render.use_raytrace = settings['use_raytrace']
+    render.use_shadows = settings['use_shadows']
+    render.use_sss = settings['use_sss']
+    render.use_envmap = settings['use_envmap']
+    render.tile_x = settings['tile_size']
+    render.tile_y = settings['tile_size']
+    render.use_save_buffers = False
+    render.use_file_extension = True
+    render.image_settings.file_format = 'PNG'
+    render.image_settings.color_mode = 'RGB'
+    render.image_settings.compression = settings['compression']
+    render.image_settings.color_depth = settings['color_depth']
 
 
 def update_scene():
@@ -80,13 +412,156 @@ def render_image(filepath, camera_name='Camera'):
     args:
         filepath: string for filepath where the rendered
         image will get saves.
-    returns: None
+    returns:
+        string with the filepath including the file extension
     """
     objects = bpy.data.objects
     bpy.context.scene.render.filepath = filepath
     camera = objects[camera_name]
     bpy.context.scene.camera = camera
     bpy.ops.render.render(write_still=True)
+    return filepath + bpy.context.scene.render.file_extension
+
+
+def save_render_image(filepath):
+    """ writes the last render as render_image does, i.e. with the file
+    format, color management, dither and color depth of the scene, without
+    rendering again
+    args:
+        filepath: string with the path without the file extension
+    returns:
+        string with the filepath including the file extension
+    """
+    scene = bpy.context.scene
+    filepath = filepath + scene.render.file_extension
+    bpy.data.images['Render Result'].save_render(filepath, scene=scene)
+    return filepath
+
+
+def enable_object_index_pass():
+    """ adds the object index pass to the render layer and routes it to
+    the alpha channel of the compositor viewer, so that every render also
+    yields an instance map without rendering again. The written image is
+    unchanged.
+    args:
+        None
+    returns:
+        None
+    """
+    enable_viewer_pass(use_object_index=True)
+
+
+def enable_viewer_pass(use_object_index=False):
+    """ routes the rendered image to the compositor viewer, whose pixels
+    can be read from python after every render. The written image is
+    unchanged.
+    args:
+        use_object_index: boolean. If True the object index pass replaces
+        the alpha channel of the viewer.
+    returns:
+        None
+    """
+    scene = bpy.context.scene
+    scene.render.layers[0].use_pass_object_index = use_object_index
+    scene.render.use_compositing = True
+    scene.use_nodes = True
+    node_tree = scene.node_tree
+    node_tree.nodes.clear()
+    render_layers = node_tree.nodes.new('CompositorNodeRLayers')
+    composite = node_tree.nodes.new('CompositorNodeComposite')
+    viewer = node_tree.nodes.new('CompositorNodeViewer')
+    viewer.use_alpha = True
+    node_tree.links.new(render_layers.outputs['Image'],
+                        composite.inputs['Image'])
+    node_tree.links.new(render_layers.outputs['Alpha'],
+                        composite.inputs['Alpha'])
+    node_tree.links.new(render_layers.outputs['Image'],
+                        viewer.inputs['Image'])
+    alpha_output = 'IndexOB' if use_object_index else 'Alpha'
+    node_tree.links.new(render_layers.outputs[alpha_output],
+                        viewer.inputs['Alpha'])
+
+
+def read_viewer_pixels():
+    """ reads the compositor viewer of the last render. Needs
+    enable_viewer_pass to be called before rendering.
+    args:
+        None
+    returns:
+        float32 numpy array of shape (height, width, 4) with linear RGB
+        values. The first row is the top of the image.
+    """
+    viewer_image = bpy.data.images['Viewer Node']
+    # the viewer image is reused by every render and kept by reset_scene
+    viewer_image.use_fake_user = True
+    width, height = viewer_image.size
+    pixels = np.empty(width * height * 4, dtype=np.float32)
+    if hasattr(viewer_image.pixels, 'foreach_get'):
+        viewer_image.pixels.foreach_get(pixels)
+    else:
+        # before blender 2.83 the pixels are only readable as a list of
+        # 4 * width * height python floats. Its cost is part of the
+        # 'render' stage of the profiler and is paid once per image.
+        pixels[:] = viewer_image.pixels[:]
+    return pixels.reshape(height, width, 4)[::-1]
+
+
+def read_object_index_pass(pixels=None):
+    """ reads the object index map of the last render. Needs
+    enable_object_index_pass to be called before rendering.
+    args:
+        pixels: array returned by read_viewer_pixels. If None the viewer
+        is read.
+    returns:
+        numpy array of shape (height, width) with the 'pass_index' of the
+        object seen by every pixel and zero for the background. The first
+        row is the top of the image.
+    """
+    # passing the pixels read for the render image avoids reading the
+    # viewer twice
+    if pixels is None:
+        pixels = read_viewer_pixels()
+    return np.rint(pixels[:, :, 3]).astype(np.int32)
+
+
+def read_render_image(pixels=None):
+    """ reads the last render as an 8 bit sRGB image without writing it.
+    Needs enable_viewer_pass to be called before rendering.
+    args:
+        pixels: array returned by read_viewer_pixels. If None the viewer
+        is read.
+    returns:
+        uint8 numpy array of shape (height, width, 3)
+    """
+    if pixels is None:
+        pixels = read_viewer_pixels()
+    image_array = linear_to_srgb(np.clip(pixels[:, :, :3], 0., 1.))
+    return np.rint(image_array * 255.).astype(np.uint8)
+
+
+def render_viewer(camera_name='Camera'):
+    """ renders the scene without writing a file or reading its pixels.
+    The result can then be read with read_viewer_pixels or written with
+    save_render_image.
+    args:
+        camera_name: string
+    returns:
+        None
+    """
+    bpy.context.scene.camera = bpy.data.objects[camera_name]
+    bpy.ops.render.render()
+
+
+def render_viewer_pixels(camera_name='Camera'):
+    """ renders the scene without writing a file. Needs
+    enable_viewer_pass to be called before rendering.
+    args:
+        camera_name: string
+    returns:
+        float32 numpy array returned by read_viewer_pixels
+    """
+    render_viewer(camera_name)
+    return read_viewer_pixels()
 
 
 def get_camera():
@@ -121,12 +596,9 @@ def point_camera(camera, point=(0., 0., 0.)):
     returns:
         None
     """
-    point = Vector(point)
-    camera_location = camera.location
-    direction = point - camera_location
-    quaternion_rotation = direction.to_track_quat('-Z', 'Y')
-    euler_rotation = quaternion_rotation.to_euler()
-    camera.rotation_euler = euler_rotation
+    world_to_camera = look_at(np.array(camera.location), point)
+    rotation = get_camera_to_world(world_to_camera)[:3, :3]
+    camera.rotation_euler = Matrix(rotation.tolist()).to_euler()
 
 
 def move_camera_randomly(camera, min_radius=1, max_radius=4,
@@ -139,13 +611,9 @@ def move_camera_randomly(camera, min_radius=1, max_radius=4,
     returns:
         None
     """
-    radius = np.random.uniform(min_radius, max_radius)
-    theta = np.random.uniform(np.deg2rad(min_theta), np.deg2rad(max_theta))
-    phi = np.random.uniform(0, 2. * np.pi)
-    x = radius * np.cos(phi) * np.sin(theta)
-    y = radius * np.sin(phi) * np.sin(theta)
-    z = radius * np.cos(theta)
-    camera.location = (x, y, z)
+    location = sample_camera_locations(
+        1, min_radius, max_radius, min_theta, max_theta)[0]
+    camera.location = location.tolist()
 
 
 def delete_all_lamps():
@@ -229,42 +697,113 @@ def add_image_background(filepath):
     returns:
         None
     """
-    img = bpy.data.images.load(filepath)
+    img = bpy.data.images.load(filepath, check_existing=True)
     for area in bpy.context.screen.areas:
         if area.type == 'VIEW_3D':
             space_data = area.spaces.active
-            bg = space_data.background_images.new()
-            bg.image = img
+            if len(space_data.background_images) == 0:
+                space_data.background_images.new()
+            space_data.background_images[0].image = img
             space_data.show_background_images = True
             break
 
-    texture = bpy.data.textures.new("Texture.001", 'IMAGE')
+    texture = bpy.data.textures.get('image_background')
+    if texture is None:
+        texture = bpy.data.textures.new('image_background', 'IMAGE')
     texture.image = img
     bpy.data.worlds['World'].active_texture = texture
     bpy.context.scene.world.texture_slots[0].use_map_horizon = True
 
 
-def add_plain_background(RGB, height=200, width=200):
-    """ adds a plain rgb background to the scene
+# RGBA buffers of add_array_background reused for every resolution
+_background_pixels = dict()
+
+
+def add_array_background(image_array, name='background'):
+    """ uses an image array as background of the scene. The pixels are
+    written into one blender image per resolution and a texture that are
+    reused by every call, so no files are written and no datablocks are
+    created. Before blender 2.83 pixels can only be assigned as a python
+    sequence, which dominates the cost of large backgrounds.
+    args:
+        image_array: numpy array of shape (height, width, 3) and type uint8
+        name: string with the name prefix of the reused image and texture
+    returns:
+        None
+    """
+    height, width = image_array.shape[0:2]
+    image_name = '{}_{}x{}'.format(name, width, height)
+    image = bpy.data.images.get(image_name)
+    if image is None:
+        image = bpy.data.images.new(image_name, width=width, height=height)
+        image.use_fake_user = True
+    pixels = _background_pixels.get((height, width))
+    if pixels is None:
+        pixels = np.ones(shape=(height, width, 4), dtype=np.float32)
+        _background_pixels[(height, width)] = pixels
+    # blender stores RGBA float pixels starting from the bottom row
+    np.multiply(image_array[::-1], 1. / 255., out=pixels[:, :, :3])
+    if hasattr(image.pixels, 'foreach_set'):
+        image.pixels.foreach_set(pixels.ravel())
+    else:
+        image.pixels[:] = pixels.ravel().tolist()
+
+    texture = bpy.data.textures.get(name)
+    if texture is None:
+        texture = bpy.data.textures.new(name, 'IMAGE')
+        texture.use_fake_user = True
+    texture.image = image
+    bpy.data.worlds['World'].active_texture = texture
+    bpy.context.scene.world.texture_slots[0].use_map_horizon = True
+
+
+def srgb_to_linear(values):
+    """ converts sRGB encoded values into linear values
+    args:
+        values: array of floats between [0, 1]
+    returns:
+        numpy array of floats between [0, 1]
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(values <= 0.04045, values / 12.92,
+                    ((values + 0.055) / 1.055) ** 2.4)
+
+
+def linear_to_srgb(values):
+    """ converts linear values into sRGB encoded values
+    args:
+        values: array of floats between [0, 1]
+    returns:
+        numpy array of floats between [0, 1]
+    """
+    values = np.asarray(values, dtype=np.float32)
+    return np.where(values <= 0.0031308, values * 12.92,
+                    1.055 * np.power(values, 1. / 2.4) - 0.055)
+
+
+def add_plain_background(RGB):
+    """ adds a plain rgb background to the scene by setting the world
+    horizon color. No files are written and no datablocks are created.
     args:
         RGB: list of ints containing the (R,G,B) values
     returns:
         None
     """
-    image_array = np.zeros(shape=(height, width, 3))
-    image_array[:, :, 0].fill(RGB[0])
-    image_array[:, :, 1].fill(RGB[1])
-    image_array[:, :, 2].fill(RGB[2])
-    pil_image = Image.fromarray(image_array.astype('uint8'))
-    pil_image.save('../data/cache/plain_background.png')
-    add_image_background('../data/cache/plain_background.png')
+    world = bpy.context.scene.world
+    # the horizon color is linear while image textures are sRGB encoded
+    world.horizon_color = srgb_to_linear(np.asarray(RGB) / 255.).tolist()
+    texture_slot = world.texture_slots[0]
+    if texture_slot is not None:
+        texture_slot.use_map_horizon = False
 
 
-def add_random_patch_background(image_path, box_size=200):
+def add_random_patch_background(image_path, box_size=200,
+                                cache_path='../data/cache/'):
     """ performs a random crop on the loaded image and uses it as background
     args:
         image_path: string containing path the image
         box_size: length of random box
+        cache_path: string with the directory used for temporary images
     returns:
         None
     """
@@ -279,8 +818,8 @@ def add_random_patch_background(image_path, box_size=200):
     x_max = int(x_min + box_size)
     y_max = int(y_min + box_size)
     cropped_image = image.crop((x_min, y_min, x_max, y_max))
-    cropped_image.save('../data/cache/random_background.png')
-    add_image_background('../data/cache/random_background.png')
+    cropped_image.save(cache_path + 'random_background.png')
+    add_image_background(cache_path + 'random_background.png')
 
 
 def translate_object(obj, coordinates):
@@ -315,10 +854,13 @@ def change_color2(obj, RGB):
     returns:
         None
     """
-    # active_obj = bpy.context.active_object
-    material = bpy.data.materials.new(name='color_material')
-    obj.data.materials.append(material)
-    bpy.context.object.active_material.diffuse_color = RGB
+    # the material is reused instead of creating one for every call
+    material = bpy.data.materials.get('color_material')
+    if material is None:
+        material = bpy.data.materials.new(name='color_material')
+    if material.name not in obj.data.materials:
+        obj.data.materials.append(material)
+    material.diffuse_color = RGB
 
 
 def change_color(obj):
@@ -334,19 +876,25 @@ def change_color(obj):
 
 
 def change_light_conditions(max_num_lamps, location_range,
-                            energy_range, lamp_type='POINT'):
+                            energy_range, lamp_type='POINT', lamp_pool=None):
     """ change light conditions
     args:
         max_num_lamps: maximum number of lamps in the scene
         location_range: list of two floats
         energy: list of two integers
         lamp_type: string specifying the blender lamp type
+        lamp_pool: LampPool instance. If given its lamps are reconfigured
+        instead of adding new lamps.
     returns:
         None
     """
     num_lamps = np.random.randint(1, max_num_lamps + 1)
-    for lamp_arg in range(num_lamps):
-        lamp = add_lamp('lamp_' + str(lamp_arg))
+    if lamp_pool is not None:
+        lamps = lamp_pool.get_lamps(num_lamps)
+    else:
+        lamps = [add_lamp('lamp_' + str(lamp_arg))
+                 for lamp_arg in range(num_lamps)]
+    for lamp in lamps:
         lamp.location = np.random.uniform(*location_range, size=3).tolist()
         lamp.data.energy = np.random.randint(*energy_range)
         lamp.data.type = lamp_type
@@ -405,6 +953,119 @@ def change_lamp(lamp, location, energy=5, lamp_type='POINT'):
     lamp.energy = energy
 
 
+SCENE_COLLECTIONS = ('objects', 'meshes', 'lamps', 'materials',
+                     'textures', 'images')
+
+
+def clear_scene():
+    """ deletes all mesh and lamp objects in memory
+    args:
+        None
+    returns:
+        None
+    """
+    for obj in list(bpy.data.objects):
+        if obj.type == 'MESH' or obj.type == 'LAMP':
+            delete_object(obj)
+
+
+def get_scene_state(camera_name='Camera'):
+    """ records the datablocks and camera pose of the current scene
+    args:
+        camera_name: string with the name of the camera object
+    returns:
+        scene_state: dictionary mapping every bpy.data collection name in
+        SCENE_COLLECTIONS to the set of datablock names it contains, and
+        'camera' to the camera (location, rotation) pair.
+    """
+    scene_state = dict()
+    for collection_name in SCENE_COLLECTIONS:
+        collection = getattr(bpy.data, collection_name)
+        scene_state[collection_name] = set(collection.keys())
+    camera = bpy.data.objects[camera_name]
+    scene_state['camera'] = (camera.location.copy(),
+                             camera.rotation_euler.copy())
+    return scene_state
+
+
+def get_data_sizes():
+    """ returns the number of datablocks of every collection in
+    SCENE_COLLECTIONS
+    args:
+        None
+    returns:
+        dictionary mapping collection names to ints
+    """
+    sizes = dict()
+    for collection_name in SCENE_COLLECTIONS:
+        sizes[collection_name] = len(getattr(bpy.data, collection_name))
+    return sizes
+
+
+def is_owned_by_blender(collection_name, datablock):
+    """ checks if a datablock is created and reused by blender itself, e.g.
+    the 'Render Result' and 'Viewer Node' images, and must not be removed
+    args:
+        collection_name: string with the bpy.data collection name
+        datablock: blender datablock of that collection
+    returns:
+        boolean
+    """
+    return (collection_name == 'images' and
+            datablock.type in ('RENDER_RESULT', 'COMPOSITING'))
+
+
+def purge_orphans(collection_names=('meshes', 'materials', 'textures',
+                                     'images', 'lamps')):
+    """ removes datablocks without users and without a fake user until
+    none is left, since removing a datablock can orphan the ones it used
+    args:
+        collection_names: list of bpy.data collection names
+    returns:
+        int with the number of removed datablocks
+    """
+    num_removed = 0
+    has_removed = True
+    while has_removed:
+        has_removed = False
+        for collection_name in collection_names:
+            collection = getattr(bpy.data, collection_name)
+            for datablock in list(collection):
+                if datablock.users > 0 or datablock.use_fake_user:
+                    continue
+                if is_owned_by_blender(collection_name, datablock):
+                    continue
+                collection.remove(datablock)
+                num_removed = num_removed + 1
+                has_removed = True
+    return num_removed
+
+
+def reset_scene(scene_state, camera_name='Camera'):
+    """ removes in memory every datablock created after 'scene_state' was
+    recorded and restores the camera pose. Datablocks with a fake user
+    are kept since they are owned by a cache or pool, as are the render
+    result images owned by blender.
+    args:
+        scene_state: dictionary returned by get_scene_state
+        camera_name: string with the name of the camera object
+    returns:
+        None
+    """
+    # objects are removed first so that their data becomes orphan
+    for collection_name in SCENE_COLLECTIONS:
+        collection = getattr(bpy.data, collection_name)
+        recorded_names = scene_state[collection_name]
+        for datablock in list(collection):
+            if datablock.name in recorded_names or datablock.use_fake_user:
+                continue
+            if is_owned_by_blender(collection_name, datablock):
+                continue
+            collection.remove(datablock, do_unlink=True)
+    camera = bpy.data.objects[camera_name]
+    camera.location, camera.rotation_euler = scene_state['camera']
+
+
 def delete_scene(filename):
     # select objects by type
     for o in bpy.data.objects:
@@ -430,26 +1091,60 @@ def clamp(x, minimum=0., maximum=1.):
     return max(minimum, min(x, maximum))
 
 
-def get_image_bounding_box(obj):
+def get_vertices(obj):
+    """ reads the local coordinates of all mesh vertices at once
+    args:
+        obj: blender mesh object
+    returns:
+        numpy array of shape (num_vertices, 3) and type float32
+    """
+    mesh_vertices = obj.data.vertices
+    vertices = np.empty(len(mesh_vertices) * 3, dtype=np.float32)
+    mesh_vertices.foreach_get('co', vertices)
+    return vertices.reshape(-1, 3)
+
+
+def get_convex_hull_vertices(obj):
+    """ computes the vertices of the mesh that lie on its convex hull.
+    Only these vertices can define the projected bounding box of the mesh.
+    args:
+        obj: blender mesh object
+    returns:
+        numpy array of shape (num_hull_vertices, 3) with local coordinates.
+        If the hull can not be computed all vertices are returned.
+    """
+    vertices = get_vertices(obj)
+    bm = bmesh.new()
+    bm.from_mesh(obj.data)
+    # hull vertices are mapped back to the mesh through their indices
+    bm.verts.ensure_lookup_table()
+    bm.verts.index_update()
+    hull = bmesh.ops.convex_hull(bm, input=bm.verts)
+    hull_args = {element.index for element in hull['geom']
+                 if isinstance(element, bmesh.types.BMVert)}
+    bm.free()
+    if len(hull_args) == 0:
+        return vertices
+    return vertices[sorted(hull_args)]
+
+
+def get_image_bounding_box(obj, vertices=None):
     """ projects all vertices from the blender obj
     into the image coordinates to obtain a bounding box
     args:
         obj: blender object
+        vertices: numpy array of shape (num_vertices, 3) with local
+        coordinates to project. If None all mesh vertices are used.
     returns: a list of floats containing the bounding box
     coordinates: [x_min, y_min, x_max, y_max]
     """
     scene = bpy.context.scene
     camera = bpy.data.objects['Camera']
-    x_image_projections = []
-    y_image_projections = []
-    for obj_vertix in obj.data.vertices:
-        vertix = obj.matrix_world * obj_vertix.co
-        normalized_image_corner = to_camera_view(scene, camera, vertix)
-        x_image_projections.append(normalized_image_corner.x)
-        y_image_projections.append(normalized_image_corner.y)
-
-    x_image_projections = np.asarray(x_image_projections)
-    y_image_projections = np.asarray(y_image_projections)
+    if vertices is None:
+        vertices = get_vertices(obj)
+    image_projections = to_camera_view_batch(scene, camera, obj, vertices)
+    x_image_projections = image_projections[:, 0]
+    y_image_projections = image_projections[:, 1]
 
     x_min = np.min(x_image_projections)
     x_max = np.max(x_image_projections)
@@ -462,6 +1157,89 @@ def get_image_bounding_box(obj):
     return coordinates
 
 
+def get_camera_matrices(scene, camera):
+    """ reads the extrinsics and intrinsics of a perspective camera for
+    camera_utils.project_points
+    args:
+        scene: blender scene
+        camera: camera blender object
+    returns:
+        world_to_camera: numpy array of shape (4, 4)
+        intrinsics: numpy array of shape (3, 3) projecting into normalized
+        image coordinates
+    """
+    world_to_camera = get_world_to_camera(
+        np.array(camera.matrix_world.normalized()))
+    view_frame = [tuple(vector) for vector in camera.data.view_frame(
+        scene=scene)]
+    return world_to_camera, get_view_frame_intrinsics(view_frame)
+
+
+def get_visibility(obj, vertices=None):
+    """ checks how much of an object is inside the camera frame before
+    rendering it
+    args:
+        obj: blender object
+        vertices: numpy array of shape (num_vertices, 3) with local
+        coordinates to project. If None all mesh vertices are used.
+    returns:
+        visible_fraction: float with the fraction of the projected box
+        inside the image. Zero if the object is behind the camera.
+        box_area: float with the normalized area of the clipped box
+    """
+    if vertices is None:
+        vertices = get_vertices(obj)
+    scene = bpy.context.scene
+    camera = bpy.data.objects['Camera']
+    if camera.data.type == 'ORTHO':
+        # the pinhole matrices do not describe orthographic cameras
+        projections = to_camera_view_batch(scene, camera, obj, vertices)
+        image_points, depths = projections[:, :2], projections[:, 2]
+    else:
+        world_to_camera, intrinsics = get_camera_matrices(scene, camera)
+        local_to_camera = np.dot(world_to_camera, np.array(obj.matrix_world))
+        image_points, depths = project_points(
+            vertices, local_to_camera, intrinsics)
+    visible_fraction = float(get_visible_fractions(image_points, depths))
+    x_min, y_min, x_max, y_max = get_bounding_boxes(image_points)
+    box_area = float((x_max - x_min) * (y_max - y_min))
+    return visible_fraction, box_area
+
+
+def to_camera_view_batch(scene, camera, obj, vertices):
+    """ projects local coordinates of obj into the image coordinates of
+    the camera. Same as to_camera_view but for all vertices at once.
+    args:
+        scene: blender scene
+        camera: camera blender object
+        obj: blender object the vertices belong to. If None vertices are
+        given in world coordinates.
+        vertices: numpy array of shape (num_vertices, 3)
+    returns:
+        numpy array of shape (num_vertices, 3) in image coordinates.
+    """
+    local_to_world = np.eye(4)
+    if obj is not None:
+        local_to_world = np.array(obj.matrix_world)
+    if camera.data.type == 'ORTHO':
+        world_to_camera = np.array(camera.matrix_world.normalized().inverted())
+        local_to_camera = np.dot(world_to_camera, local_to_world)
+        co_local = (np.dot(vertices, local_to_camera[:3, :3].T) +
+                    local_to_camera[:3, 3])
+        frame = camera.data.view_frame(scene=scene)[:3]
+        frame = -np.array([tuple(vector) for vector in frame])
+        x = (co_local[:, 0] - frame[1, 0]) / (frame[2, 0] - frame[1, 0])
+        y = (co_local[:, 1] - frame[0, 1]) / (frame[1, 1] - frame[0, 1])
+        return np.stack([x, y, -co_local[:, 2]], axis=1)
+    world_to_camera, intrinsics = get_camera_matrices(scene, camera)
+    local_to_camera = np.dot(world_to_camera, local_to_world)
+    image_points, depths = project_points(
+        vertices, local_to_camera, intrinsics)
+    # blender image coordinates have their y axis pointing up
+    return np.stack([image_points[:, 0], 1. - image_points[:, 1], depths],
+                    axis=1)
+
+
 def to_camera_view(scene, obj, coord):
     """ projects 3D coord into the image coordinates of the camera obj
     args:
@@ -471,21 +1249,5 @@ def to_camera_view(scene, obj, coord):
     returns:
         3D vector in image coordiantes.
     """
-    co_local = obj.matrix_world.normalized().inverted() * coord
-    z = -co_local.z
-
-    camera = obj.data
-    frame = [-v for v in camera.view_frame(scene=scene)[:3]]
-    if camera.type != 'ORTHO':
-        if z == 0.0:
-            return Vector((0.5, 0.5, 0.0))
-        else:
-            frame = [(v / (v.z / z)) for v in frame]
-
-    min_x, max_x = frame[1].x, frame[2].x
-    min_y, max_y = frame[0].y, frame[1].y
-
-    x = (co_local.x - min_x) / (max_x - min_x)
-    y = (co_local.y - min_y) / (max_y - min_y)
-
-    return Vector((x, y, z))
+    projection = to_camera_view_batch(scene, obj, None, np.array([coord]))
+    return Vector(projection[0].tolist())
@@ -0,0 +1,232 @@
+import numpy as np
+
+# Cameras follow the computer vision convention: x points right, y points
+# down and z points forward. Blender cameras look along their -z axis
+# with y pointing up, which is this convention rotated around x.
+BLENDER_TO_CAMERA = np.diag([1., -1., -1.])
+
+
+def get_intrinsics(focal_length, sensor_width, resolution,
+                   sensor_height=None, sensor_fit='AUTO'):
+    """ builds the pinhole intrinsics of a camera without lens shift
+    args:
+        focal_length: float with the focal length in millimeters
+        sensor_width: float with the sensor width in millimeters
+        resolution: list of two ints with the image width and height
+        sensor_height: float with the sensor height in millimeters, only
+        used with sensor_fit 'VERTICAL'
+        sensor_fit: string, either 'AUTO', 'HORIZONTAL' or 'VERTICAL' as
+        in blender. 'AUTO' fits the sensor width to the larger side.
+    returns:
+        numpy array of shape (3, 3) in pixels
+    """
+    width, height = resolution
+    if sensor_fit == 'AUTO':
+        sensor_size, image_size = sensor_width, max(width, height)
+    elif sensor_fit == 'HORIZONTAL':
+        sensor_size, image_size = sensor_width, width
+    elif sensor_fit == 'VERTICAL':
+        sensor_size, image_size = sensor_height, height
+    else:
+        raise Exception("Sensor fits available are: "
+                        "'AUTO', 'HORIZONTAL' or 'VERTICAL'")
+    focal_pixels = focal_length / float(sensor_size) * image_size
+    return np.array([[focal_pixels, 0., width / 2.],
+                     [0., focal_pixels, height / 2.],
+                     [0., 0., 1.]])
+
+
+def get_view_frame_intrinsics(view_frame, resolution=(1, 1)):
+    """ builds the intrinsics of a perspective camera from the corners of
+    its view frame, which already include sensor fit and lens shift
+    args:
+        view_frame: array of shape (4, 3) with the frame corners returned
+        by blender's camera.view_frame in camera coordinates
+        resolution: list of two ints. With (1, 1) points are projected to
+        normalized image coordinates.
+    returns:
+        numpy array of shape (3, 3)
+    """
+    # same corners as bpy_extras.object_utils.world_to_camera_view
+    frame = -np.asarray(view_frame, dtype=np.float64)[:3]
+    min_x, max_x = frame[1, 0] / frame[1, 2], frame[2, 0] / frame[2, 2]
+    min_y, max_y = frame[0, 1] / frame[0, 2], frame[1, 1] / frame[1, 2]
+    width, height = resolution
+    return np.array([[width / (max_x - min_x), 0.,
+                      -width * min_x / (max_x - min_x)],
+                     [0., height / (max_y - min_y),
+                      height * max_y / (max_y - min_y)],
+                     [0., 0., 1.]])
+
+
+def get_world_to_camera(camera_to_world):
+    """ converts blender camera poses into extrinsics
+    args:
+        camera_to_world: array of shape (4, 4) or (num_poses, 4, 4) with
+        the normalized matrix_world of blender cameras
+    returns:
+        numpy array of the same shape with world to camera matrices
+    """
+    world_to_camera = np.linalg.inv(np.asarray(camera_to_world))
+    world_to_camera[..., :3, :] = np.matmul(
+        BLENDER_TO_CAMERA, world_to_camera[..., :3, :])
+    return world_to_camera
+
+
+def get_camera_to_world(world_to_camera):
+    """ converts extrinsics into blender camera poses
+    args:
+        world_to_camera: array of shape (4, 4) or (num_poses, 4, 4)
+    returns:
+        numpy array of the same shape with blender matrix_world values
+    """
+    world_to_camera = np.array(world_to_camera, dtype=np.float64)
+    world_to_camera[..., :3, :] = np.matmul(
+        BLENDER_TO_CAMERA, world_to_camera[..., :3, :])
+    return np.linalg.inv(world_to_camera)
+
+
+def look_at(camera_locations, target=(0., 0., 0.), up=(0., 0., 1.)):
+    """ builds the extrinsics of cameras looking at a target. The image y
+    axis points away from 'up', as with blender's to_track_quat('-Z', 'Y').
+    args:
+        camera_locations: array of shape (3) or (num_poses, 3)
+        target: array of shape (3) or (num_poses, 3)
+        up: array of shape (3) with the world up direction
+    returns:
+        numpy array of shape (4, 4) or (num_poses, 4, 4)
+    """
+    camera_locations = np.asarray(camera_locations, dtype=np.float64)
+    is_single = camera_locations.ndim == 1
+    camera_locations = np.atleast_2d(camera_locations)
+    target = np.asarray(target, dtype=np.float64)
+    forward = target - camera_locations
+    forward = forward / np.linalg.norm(forward, axis=1, keepdims=True)
+    up = np.broadcast_to(np.asarray(up, dtype=np.float64), forward.shape)
+    right = np.cross(forward, up)
+    right_norm = np.linalg.norm(right, axis=1, keepdims=True)
+    # cameras looking along 'up' use the world y axis instead
+    is_parallel = right_norm[:, 0] < 1e-9
+    if np.any(is_parallel):
+        right[is_parallel] = np.cross(forward[is_parallel], [0., 1., 0.])
+        right_norm[is_parallel] = np.linalg.norm(
+            right[is_parallel], axis=1, keepdims=True)
+    right = right / right_norm
+    down = np.cross(forward, right)
+    rotations = np.stack([right, down, forward], axis=1)
+    world_to_camera = np.zeros((len(camera_locations), 4, 4))
+    world_to_camera[:, :3, :3] = rotations
+    world_to_camera[:, :3, 3] = -np.einsum(
+        'pij,pj->pi', rotations, camera_locations)
+    world_to_camera[:, 3, 3] = 1.
+    if is_single:
+        return world_to_camera[0]
+    return world_to_camera
+
+
+def project_points(points, world_to_camera, intrinsics):
+    """ projects M points under P camera poses in a single call
+    args:
+        points: array of shape (num_points, 3) in world coordinates
+        world_to_camera: array of shape (4, 4) or (num_poses, 4, 4)
+        intrinsics: array of shape (3, 3)
+    returns:
+        image_points: array of shape ([num_poses,] num_points, 2). Points
+        at depth zero are projected to the principal point.
+        depths: array of shape ([num_poses,] num_points) with the distance
+        of every point along the optical axis
+    """
+    points = np.asarray(points, dtype=np.float64)
+    world_to_camera = np.asarray(world_to_camera, dtype=np.float64)
+    camera_points = (np.matmul(points, np.swapaxes(
+        world_to_camera[..., :3, :3], -1, -2)) +
+        world_to_camera[..., None, :3, 3])
+    depths = camera_points[..., 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized_points = camera_points[..., :2] / depths[..., None]
+    normalized_points[depths == 0.] = 0.
+    image_points = (np.matmul(normalized_points, intrinsics[:2, :2].T) +
+                    intrinsics[:2, 2])
+    return image_points, depths
+
+
+def get_bounding_boxes(image_points, resolution=(1, 1)):
+    """ computes the clipped boxes enclosing projected points
+    args:
+        image_points: array of shape ([num_poses,] num_points, 2)
+        resolution: list of two ints used for normalizing the boxes
+    returns:
+        array of shape ([num_poses,] 4) with normalized
+        [x_min, y_min, x_max, y_max] values between [0, 1]
+    """
+    image_points = image_points / np.asarray(resolution, dtype=np.float64)
+    minimum = np.min(image_points, axis=-2)
+    maximum = np.max(image_points, axis=-2)
+    boxes = np.concatenate([minimum, maximum], axis=-1)
+    return np.clip(boxes, 0., 1.)
+
+
+def get_visible_fractions(image_points, depths, resolution=(1, 1)):
+    """ computes which fraction of the box enclosing the projected points
+    lies inside the image. Points behind the camera make the whole
+    projection unusable and give a fraction of zero.
+    args:
+        image_points: array of shape ([num_poses,] num_points, 2)
+        depths: array of shape ([num_poses,] num_points)
+        resolution: list of two ints used for normalizing the points
+    returns:
+        array of shape ([num_poses]) with values between [0, 1]
+    """
+    image_points = image_points / np.asarray(resolution, dtype=np.float64)
+    minimum = np.min(image_points, axis=-2)
+    maximum = np.max(image_points, axis=-2)
+    area = np.prod(maximum - minimum, axis=-1)
+    clipped_area = np.prod(
+        np.clip(maximum, 0., 1.) - np.clip(minimum, 0., 1.), axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fractions = np.where(area > 0., clipped_area / area, 0.)
+    return np.where(np.any(depths <= 0., axis=-1), 0., fractions)
+
+
+def sample_camera_locations(num_poses, min_radius=1, max_radius=4,
+                            min_theta=15, max_theta=90,
+                            center=(0., 0., 0.)):
+    """ samples camera locations uniformly in spherical coordinates.
+    Random numbers are drawn as in blender_utils.move_camera_randomly.
+    args:
+        num_poses: int
+        min_radius: float
+        max_radius: float
+        min_theta: float. Minimum polar angle in degrees.
+        max_theta: float. Maximum polar angle in degrees.
+        center: array of shape (3) added to every location
+    returns:
+        numpy array of shape (num_poses, 3)
+    """
+    radius = np.random.uniform(min_radius, max_radius, num_poses)
+    theta = np.random.uniform(np.deg2rad(min_theta), np.deg2rad(max_theta),
+                              num_poses)
+    phi = np.random.uniform(0, 2. * np.pi, num_poses)
+    x = radius * np.cos(phi) * np.sin(theta)
+    y = radius * np.sin(phi) * np.sin(theta)
+    z = radius * np.cos(theta)
+    return np.stack([x, y, z], axis=1) + np.asarray(center)
+
+
+def sample_camera_poses(num_poses, min_radius=1, max_radius=4,
+                        min_theta=15, max_theta=90, target=(0., 0., 0.)):
+    """ samples cameras on a spherical shell looking at a target
+    args:
+        num_poses: int
+        min_radius: float
+        max_radius: float
+        min_theta: float. Minimum polar angle in degrees.
+        max_theta: float. Maximum polar angle in degrees.
+        target: array of shape (3) the cameras look at
+    returns:
+        camera_locations: array of shape (num_poses, 3)
+        world_to_camera: array of shape (num_poses, 4, 4)
+    """
+    camera_locations = sample_camera_locations(
+        num_poses, min_radius, max_radius, min_theta, max_theta, target)
+    return camera_locations, look_at(camera_locations, target)
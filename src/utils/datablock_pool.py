@@ -0,0 +1,163 @@
+from collections import OrderedDict
+
+import bpy
+
+
+class LampPool(object):
+    """ lamps that are created once and reconfigured for every image.
+    Lamps that are not used by an image are hidden from the render. The
+    pool has to be created before blender_utils.get_scene_state so that
+    blender_utils.reset_scene keeps its lamps.
+
+    # Arguments
+        max_num_lamps: int with the number of pooled lamps
+        name: string prefix of the lamp names
+    """
+
+    def __init__(self, max_num_lamps, name='pooled_lamp'):
+        self.lamps = []
+        scene = bpy.context.scene
+        for lamp_arg in range(max_num_lamps):
+            lamp_name = name + '_' + str(lamp_arg)
+            lamp_data = bpy.data.lamps.get(lamp_name)
+            if lamp_data is None:
+                lamp_data = bpy.data.lamps.new(name=lamp_name, type='POINT')
+            lamp_data.use_fake_user = True
+            lamp = bpy.data.objects.get(lamp_name)
+            if lamp is None:
+                lamp = bpy.data.objects.new(name=lamp_name,
+                                            object_data=lamp_data)
+            if lamp.name not in scene.objects:
+                scene.objects.link(lamp)
+            lamp.use_fake_user = True
+            self.lamps.append(lamp)
+        self.hide()
+
+    def __len__(self):
+        return len(self.lamps)
+
+    def get_lamps(self, num_lamps):
+        """ shows the first 'num_lamps' lamps and hides the others
+        args:
+            num_lamps: int
+        returns:
+            list of blender lamp objects to be configured
+        """
+        if num_lamps > len(self.lamps):
+            raise Exception('The pool only has', len(self.lamps), 'lamps')
+        for lamp_arg, lamp in enumerate(self.lamps):
+            is_hidden = lamp_arg >= num_lamps
+            lamp.hide = is_hidden
+            lamp.hide_render = is_hidden
+        return self.lamps[:num_lamps]
+
+    def hide(self):
+        self.get_lamps(0)
+
+
+class MaterialPool(object):
+    """ reusable copies of the materials of cached meshes. Instances of a
+    cached mesh need their own materials to get their own colors; instead
+    of copying them for every image, released copies are handed out again.
+    Copies are pooled by the template datablock, since models often share
+    material names. Templates leaving the MeshCache have to be passed to
+    remove_templates.
+
+    # Arguments
+        max_num_free_materials: int with the maximum number of released
+        copies kept. Older copies are removed from blender.
+    """
+
+    def __init__(self, max_num_free_materials=256):
+        self.max_num_free_materials = max_num_free_materials
+        self.template_to_free = OrderedDict()
+        self.used = []
+        self.num_created = 0
+        self.num_reused = 0
+
+    def acquire(self, template):
+        """ returns a material with the settings of 'template'
+        args:
+            template: blender material
+        returns:
+            blender material that is not used by any other object
+        """
+        template_pointer = template.as_pointer()
+        free_materials = self.template_to_free.get(template_pointer)
+        if free_materials:
+            material = free_materials.pop()
+            material.diffuse_color = template.diffuse_color
+            material.diffuse_intensity = template.diffuse_intensity
+            self.num_reused = self.num_reused + 1
+        else:
+            material = template.copy()
+            material.use_fake_user = True
+            self.num_created = self.num_created + 1
+        self.used.append((template_pointer, material))
+        return material
+
+    def release_all(self):
+        """ marks all handed out materials as free again. Call it after
+        the objects using them were removed.
+        args:
+            None
+        returns:
+            None
+        """
+        for template_pointer, material in self.used:
+            free_materials = self.template_to_free.setdefault(
+                template_pointer, [])
+            free_materials.append(material)
+            self.template_to_free.move_to_end(template_pointer)
+        self.used = []
+        num_free_materials = sum(len(free_materials) for free_materials
+                                 in self.template_to_free.values())
+        while num_free_materials > self.max_num_free_materials:
+            template_pointer, free_materials = self.template_to_free.popitem(
+                last=False)
+            for material in free_materials:
+                bpy.data.materials.remove(material, do_unlink=True)
+            num_free_materials = num_free_materials - len(free_materials)
+
+    def remove_templates(self, templates):
+        """ removes the copies of templates that are about to be removed
+        from blender, whose pointers could otherwise be reused by new
+        templates. Copies still in use are no longer pooled and are
+        removed by blender_utils.reset_scene.
+        args:
+            templates: list of blender materials, e.g. the materials of a
+            mesh evicted from the MeshCache
+        returns:
+            None
+        """
+        template_pointers = set(template.as_pointer() for template
+                                in templates if template is not None)
+        for template_pointer in template_pointers:
+            free_materials = self.template_to_free.pop(template_pointer, [])
+            for material in free_materials:
+                bpy.data.materials.remove(material, do_unlink=True)
+        used = []
+        for template_pointer, material in self.used:
+            if template_pointer in template_pointers:
+                material.use_fake_user = False
+            else:
+                used.append((template_pointer, material))
+        self.used = used
+
+    def clear(self):
+        """ removes all copies from blender, e.g. between two runs. Call it
+        after the objects using them were removed.
+        args:
+            None
+        returns:
+            None
+        """
+        self.release_all()
+        for free_materials in self.template_to_free.values():
+            for material in free_materials:
+                bpy.data.materials.remove(material, do_unlink=True)
+        self.template_to_free.clear()
+
+    def get_stats(self):
+        return {'num_created': self.num_created,
+                'num_reused': self.num_reused}
@@ -1,53 +1,88 @@
-import glob
-import random
+import os
+import sys
+from itertools import groupby
 
 from numpy.random import uniform
 from numpy.random import randint
+import numpy as np
 
 from .blender_utils import load_obj
 from .blender_utils import change_light_conditions
-from .blender_utils import render_image
+from .blender_utils import enable_viewer_pass
+from .blender_utils import render_viewer
+from .blender_utils import read_render_image
 from .blender_utils import view_selected_object
 from .blender_utils import set_render_properties
 from .blender_utils import rotate_object
 from .blender_utils import translate_object
 from .blender_utils import update_scene
-from .blender_utils import delete_scene
+from .blender_utils import clear_scene
+from .blender_utils import get_scene_state
+from .blender_utils import reset_scene
 from .blender_utils import add_plain_background
-from .blender_utils import add_random_patch_background
+from .blender_utils import add_array_background
 from .blender_utils import change_color
 from .blender_utils import zoom_camera
-from .blender_utils import get_image_bounding_box
+from .blender_utils import get_camera
+from .blender_utils import change_camera_perspective
+from .blender_utils import update_level_of_detail
+from .blender_utils import save_render_image
+from .blender_utils import get_visibility
+from .blender_utils import RENDER_PROFILES
+from .blender_utils import get_data_sizes
+from .blender_utils import purge_orphans
+from .background_pool import BackgroundPool
+from .mesh_cache import MeshCache
+from .mesh_cache import ConvexHullCache
+from .mesh_converter import LODSelector
+from .datablock_pool import LampPool
+from .datablock_pool import MaterialPool
+from .manifest import ProgressManifest
+from .manifest import seed_image
+from .manifest import update_metadata
+from .profiler import get_profiler
+from .packed_dataset import OUTPUT_FORMATS
+from .output_writers import SampleWriter
+from .output_writers import get_image_shape
+from .watchdog import MemoryWatchdog
+from .watchdog import RECYCLE_EXIT_CODE
 
 
 class ImageClassifierGenerator():
     def __init__(self, data, save_path,
                  num_images_per_class=100,
                  resolution=(500, 500), resolution_percentage=100,
-                 background='plain', background_images_directory=None,
+                 background='plain',
+                 background_images_directory=None,
                  lamp_type='POINT', max_num_lamps=4,
                  lamp_location_range=[-15, 15], lamp_energy_range=[1, 5],
                  rotation_range=[0, 360],
-                 translation_range=None, zoom_range=None):
+                 translation_range=None, zoom_range=None,
+                 max_cached_vertices=int(5e6), max_cached_megabytes=None,
+                 use_convex_hull=True, full_detail=False,
+                 cache_path='../data/cache/',
+                 image_args=None, seed=None, manifest_path=None,
+                 views_per_scene=1, profile=False, profile_interval=100,
+                 min_visible_fraction=0., min_box_area=0.,
+                 max_pose_attempts=10,
+                 memory_check_interval=50, soft_memory_megabytes=None,
+                 hard_memory_megabytes=None, max_datablocks=None,
+                 async_encoding=False, image_format='PNG', image_quality=90,
+                 num_encoding_workers=2, max_queued_images=8,
+                 output_format='files', max_shard_megabytes=256,
+                 render_profile=None, num_render_threads=None):
 
         if background not in ['plain', 'crop']:
             raise Exception("Backgrounds available are: 'plain' or 'crop'")
         if background == 'crop' and background_images_directory is None:
             raise Exception("Background 'crop' need background_images_path")
 
-        if background == 'crop':
-            self.background_image_paths = glob.glob(
-                            background_images_directory + '*.png')
-            if len(self.background_image_paths) == 0:
-                raise Exception(
-                        "There are no files with '.png' prefix in directory",
-                        self.background_image_paths)
-
         self.data = data
-        self.blender_save_path = '../data/cache/current_scene.blend'
         self.save_path = save_path
         self.resolution = resolution
         self.resolution_percentage = resolution_percentage
+        self.render_profile = render_profile
+        self.num_render_threads = num_render_threads
         self.num_images_per_class = num_images_per_class
         self.background = background
         self.lamp_type = lamp_type
@@ -57,6 +92,56 @@ class ImageClassifierGenerator():
         self.rotation_range = rotation_range
         self.translation_range = translation_range
         self.zoom_range = zoom_range
+        self.hull_cache = ConvexHullCache(use_convex_hull)
+        self.mesh_cache = MeshCache(max_cached_vertices, max_cached_megabytes,
+                                    self.on_mesh_evicted)
+        self.lod_selector = LODSelector(resolution, resolution_percentage,
+                                        full_detail=full_detail)
+        self.cache_path = cache_path
+        if background == 'crop':
+            self.background_pool = BackgroundPool(background_images_directory)
+        self.seed = seed
+        if manifest_path is None:
+            manifest_path = self.save_path + 'manifest.txt'
+        self.manifest_path = manifest_path
+        self.profile = profile
+        self.profile_interval = profile_interval
+        self.profiler = get_profiler()
+        self.watchdog = MemoryWatchdog(
+            memory_check_interval, soft_memory_megabytes,
+            hard_memory_megabytes, max_datablocks, get_data_sizes,
+            purge_orphans)
+        if output_format not in OUTPUT_FORMATS:
+            raise Exception('Output formats available are:', OUTPUT_FORMATS)
+        if async_encoding and output_format != 'files':
+            raise Exception("async_encoding needs output_format 'files'")
+        self.output_format = output_format
+        self.max_shard_megabytes = max_shard_megabytes
+        self.async_encoding = async_encoding
+        self.image_format = image_format
+        self.image_quality = image_quality
+        self.num_encoding_workers = num_encoding_workers
+        self.max_queued_images = max_queued_images
+        self.is_over_memory_limit = False
+        self.lamp_pool = None
+        self.material_pool = None
+        self.min_visible_fraction = min_visible_fraction
+        self.min_box_area = min_box_area
+        if max_pose_attempts < 1:
+            raise ValueError('max_pose_attempts must be at least 1')
+        self.max_pose_attempts = max_pose_attempts
+        self.pose_stats = {'num_poses': 0, 'num_rejected': 0,
+                           'num_exhausted': 0}
+
+        if image_args is None:
+            image_args = range(self.num_images_per_class)
+        self.image_args = image_args
+        if views_per_scene < 1:
+            raise Exception('views_per_scene must be at least 1')
+        self.views_per_scene = views_per_scene
+
+        if not os.path.exists(self.cache_path):
+            os.makedirs(self.cache_path)
 
     def set_render_properties(self):
         """ sets the render properties regarding resolution and resolution
@@ -66,19 +151,238 @@ class ImageClassifierGenerator():
         returns:
             None
         """
-        set_render_properties(self.resolution, self.resolution_percentage)
+        set_render_properties(self.resolution, self.resolution_percentage,
+                              self.render_profile, self.num_render_threads)
 
-    def render(self):
+    def on_mesh_evicted(self, key, mesh):
+        """ drops the convex hull and the pooled material copies of a mesh
+        leaving the mesh cache
+        args:
+            key: string with the mesh key
+            mesh: blender mesh datablock
+        returns:
+            None
+        """
+        self.hull_cache.remove(key)
+        if self.material_pool is not None:
+            self.material_pool.remove_templates(mesh.materials)
+
+    def write_metadata(self):
+        """ writes the render settings of the run to 'metadata.json'
+        args:
+            None
+        returns:
+            None
+        """
+        if not os.path.exists(self.save_path):
+            os.makedirs(self.save_path, exist_ok=True)
+        metadata = {'resolution': list(self.resolution),
+                    'resolution_percentage': self.resolution_percentage,
+                    'render_profile': self.render_profile,
+                    'num_render_threads': self.num_render_threads,
+                    'render_settings': RENDER_PROFILES.get(
+                        self.render_profile),
+                    'views_per_scene': self.views_per_scene,
+                    'min_visible_fraction': self.min_visible_fraction,
+                    'min_box_area': self.min_box_area,
+                    'output_format': self.output_format,
+                    'image_format': self.image_format,
+                    'seed': self.seed}
+        update_metadata(self.save_path + 'metadata.json', metadata)
+
+    def write_pose_stats(self):
+        """ adds the pose counters of the run to 'metadata.json'. Counters
+        of all workers and restarts are summed up.
+        args:
+            None
+        returns:
+            None
+        """
+        update_metadata(self.save_path + 'metadata.json', dict(),
+                        {'pose_stats': self.pose_stats})
+
+    def generate_samples(self, is_done=None, read_image=True):
+        """ renders the images one by one and yields them as soon as each
+        render finishes. Nothing is written to disk. The scene of an image
+        is kept until the next sample is requested, so consumers apply
+        backpressure by not requesting it. Stops between scenes when the
+        memory watchdog asks for a restart. Closing the generator early
+        resets the scene.
+        args:
+            is_done: function taking an image key and returning True for
+            images that have to be skipped. If None no image is skipped.
+            read_image: boolean. If False the rendered pixels are not read
+            and the image arrays are None, e.g. when blender writes the
+            files itself.
+        returns:
+            generator of (image_array, boxes, class_names, metadata) with
+            an uint8 array of shape (height, width, 3), a float array of
+            shape (1, 4) with the box of the object, a list with its class
+            name and a dictionary with the image 'key', its 'arg' in the
+            dataset and its 'image_name'
+        """
         self.set_render_properties()
-        for class_name, model_path in self.data.items():
-            print(class_name, model_path)
-            for num_images_rendered in range(self.num_images_per_class):
-                obj = self.construct_scene(model_path, class_name)
-                box_coordinates = get_image_bounding_box(obj)
-                image_name = self.make_image_name(
-                        class_name, num_images_rendered, box_coordinates)
-                render_image(image_name)
-                delete_scene(self.blender_save_path)
+        enable_viewer_pass()
+        self.profiler = get_profiler(
+            self.profile, self.save_path + 'profile.jsonl',
+            self.profile_interval, get_data_sizes)
+        clear_scene()
+        # pooled datablocks are created before recording the scene state
+        # so that reset_scene keeps them
+        self.lamp_pool = LampPool(self.max_num_lamps)
+        self.material_pool = MaterialPool()
+        scene_state = get_scene_state()
+        self.is_over_memory_limit = False
+        try:
+            for class_arg, (class_name, model_path) in enumerate(
+                    self.data.items()):
+                if self.is_over_memory_limit:
+                    break
+                print(class_name, model_path)
+                # consecutive images share a scene and only differ in their
+                # view
+                for scene_arg, scene_image_args in groupby(
+                        self.image_args,
+                        lambda arg: arg // self.views_per_scene):
+                    image_args = [arg for arg in scene_image_args
+                                  if is_done is None or not is_done(
+                                      class_name + '/' + str(arg))]
+                    if len(image_args) == 0:
+                        continue
+                    if self.seed is not None:
+                        seed_image(self.seed,
+                                   class_name + '/scene/' + str(scene_arg))
+                    # closing this generator also closes the scene's one
+                    yield from self.generate_scene_samples(
+                        class_arg, class_name, model_path, image_args,
+                        scene_state, read_image)
+                    # workers only stop between scenes
+                    if self.is_over_memory_limit:
+                        break
+        finally:
+            self.profiler.report('mesh cache', self.mesh_cache.get_stats())
+            self.profiler.report('levels of detail',
+                                 self.lod_selector.get_stats())
+            self.profiler.report('poses', self.pose_stats)
+            self.profiler.report('pooled materials',
+                                 self.material_pool.get_stats())
+            self.profiler.report('memory watchdog', self.watchdog.stats)
+            self.profiler.close()
+            self.material_pool.clear()
+
+    def generate_scene_samples(self, class_arg, class_name, model_path,
+                               image_args, scene_state, read_image=True):
+        """ renders the views of a scene and yields them as
+        generate_samples does. The scene is reset after its last view or
+        when the consumer stops early.
+        args:
+            class_arg: int with the position of the class in 'data'
+            class_name: string
+            model_path: string with the path of the .obj file
+            image_args: list of ints with the images of the scene
+            scene_state: dictionary returned by get_scene_state
+            read_image: boolean. If False the image arrays are None.
+        returns:
+            generator of (image_array, boxes, class_names, metadata)
+        """
+        is_scene_reset = False
+        try:
+            obj = self.build_scene(model_path, class_name)
+            for view_arg, num_images_rendered in enumerate(image_args):
+                image_key = class_name + '/' + str(num_images_rendered)
+                if self.seed is not None:
+                    seed_image(self.seed, image_key)
+                self.sample_view(obj)
+                with self.profiler.stage('bounding_box'):
+                    obj, box_coordinates = update_level_of_detail(
+                        obj, self.lod_selector, self.hull_cache,
+                        self.mesh_cache, self.material_pool)
+                with self.profiler.stage('render'):
+                    render_viewer()
+                    image_array = None
+                    if read_image:
+                        image_array = read_render_image()
+                metadata = {
+                    'key': image_key,
+                    'arg': (class_arg * self.num_images_per_class +
+                            num_images_rendered),
+                    'image_name': self.make_image_name(
+                        class_name, num_images_rendered, box_coordinates)}
+                yield (image_array, np.array([box_coordinates]),
+                       [class_name], metadata)
+                if view_arg == len(image_args) - 1:
+                    self.release_scene(scene_state)
+                    is_scene_reset = True
+                self.profiler.end_image(image_key)
+                if self.watchdog.check():
+                    self.is_over_memory_limit = True
+        finally:
+            # consumers stopping early close the generator at the yield
+            if not is_scene_reset:
+                self.release_scene(scene_state)
+
+    def release_scene(self, scene_state):
+        """ removes the objects of the last scene and frees their pooled
+        materials
+        args:
+            scene_state: dictionary returned by get_scene_state
+        returns:
+            None
+        """
+        with self.profiler.stage('reset_scene'):
+            reset_scene(scene_state)
+            self.material_pool.release_all()
+
+    def render(self):
+        self.write_metadata()
+        manifest = ProgressManifest(self.manifest_path)
+        sample_writer = self.make_sample_writer()
+        # images written by blender do not need the pixels to be read
+        for image_array, boxes, class_names, metadata in (
+                self.generate_samples(manifest.is_done,
+                                      not sample_writer.saves_render())):
+            with self.profiler.stage('write'):
+                labels = {'class_names': class_names,
+                          'boxes': boxes.tolist()}
+                sample_writer.write(image_array, labels, metadata)
+            with self.profiler.stage('manifest'):
+                for key, written_path, checksum in (
+                        sample_writer.get_written_images()):
+                    manifest.add(key, checksum)
+        for key, written_path, checksum in sample_writer.close():
+            manifest.add(key, checksum)
+        manifest.flush()
+        self.write_pose_stats()
+        if self.is_over_memory_limit:
+            # the supervisor restarts the worker, which resumes from the
+            # manifest with a fresh blender process
+            sys.exit(RECYCLE_EXIT_CODE)
+
+    def make_sample_writer(self):
+        """ creates the writer of the output format. Image files are
+        encoded in background threads only with 'async_encoding'.
+        args:
+            None
+        returns:
+            SampleWriter instance
+        """
+        settings = RENDER_PROFILES.get(self.render_profile, {})
+        num_encoding_workers, save_render = 0, None
+        if self.async_encoding:
+            num_encoding_workers = self.num_encoding_workers
+        elif self.image_format == 'PNG':
+            # blender writes the files as before, color managed by the scene
+            save_render = save_render_image
+        class_names = list(self.data.keys())
+        num_images = len(class_names) * self.num_images_per_class
+        max_num_objects = 1
+        return SampleWriter(
+            self.save_path, self.output_format, num_images,
+            get_image_shape(self.resolution, self.resolution_percentage),
+            class_names, max_num_objects, self.image_format,
+            settings.get('compression', 15), self.image_quality,
+            num_encoding_workers, self.max_queued_images,
+            self.max_shard_megabytes, save_render)
 
     def make_image_name(self, class_name, arg, box_coordinates):
         """ construct the image name using the given labels
@@ -104,34 +408,110 @@ class ImageClassifierGenerator():
         returns:
             obj: blender object file
         """
+        obj = self.build_scene(filepath, class_name)
+        self.sample_view(obj)
+        return obj
 
-        obj = load_obj(filepath, class_name)
+    def build_scene(self, filepath, class_name):
+        """ loads the object and randomizes the parts of the scene that are
+        shared by all its views: lamps, object rotation, background and
+        colors
+        args:
+            filepath: file path containing the .obj file
+            class_name: the class name to name it inside blender
+        returns:
+            obj: blender object file
+        """
+        with self.profiler.stage('load_obj'):
+            lod = self.lod_selector.select(filepath, record=False)
+            obj = load_obj(filepath, class_name, self.mesh_cache, lod=lod,
+                           material_pool=self.material_pool)
 
-        change_light_conditions(self.max_num_lamps, self.lamp_location_range,
-                                self.lamp_energy_range, self.lamp_type)
+        with self.profiler.stage('lights'):
+            change_light_conditions(
+                self.max_num_lamps, self.lamp_location_range,
+                self.lamp_energy_range, self.lamp_type, self.lamp_pool)
 
         if self.rotation_range is not None:
             rotation = uniform(*self.rotation_range, size=3)
             rotate_object(obj, rotation.tolist())
 
-        view_selected_object()
+        with self.profiler.stage('background'):
+            self.add_background()
 
-        if self.translation_range is not None:
-            translation = uniform(*self.translation_range, size=3)
-            translate_object(obj, translation.tolist())
+        with self.profiler.stage('color'):
+            change_color(obj)
+        return obj
 
-        if self.zoom_range is not None:
-            zoom = uniform(*self.zoom_range)
-            zoom_camera(zoom)
+    def sample_view(self, obj):
+        """ randomizes the view until enough of the object is visible or
+        'max_pose_attempts' views were tried. The last view is kept.
+        args:
+            obj: blender object returned by build_scene
+        returns:
+            None
+        """
+        for attempt_arg in range(self.max_pose_attempts):
+            self.randomize_view(obj)
+            self.pose_stats['num_poses'] += 1
+            with self.profiler.stage('visibility'):
+                is_visible = self.is_visible(obj)
+            if is_visible:
+                return
+            self.pose_stats['num_rejected'] += 1
+        self.pose_stats['num_exhausted'] += 1
 
-        if self.background == 'plain':
-            RGB_values = randint(0, 256, 3).tolist()
-            add_plain_background(RGB_values)
-        else:
-            image = random.choice(self.background_image_paths)
-            add_random_patch_background(image)
+    def randomize_view(self, obj):
+        """ frames the object from a new camera pose. With more than one
+        view per scene the camera is first moved to a random direction.
+        args:
+            obj: blender object returned by build_scene
+        returns:
+            None
+        """
+        with self.profiler.stage('view'):
+            if self.views_per_scene > 1:
+                change_camera_perspective(get_camera())
 
-        change_color(obj)
+            # the translation of the previous view is not framed again
+            translate_object(obj, [0., 0., 0.])
+            update_scene()
+            view_selected_object()
 
-        update_scene()
-        return obj
+            if self.translation_range is not None:
+                translation = uniform(*self.translation_range, size=3)
+                translate_object(obj, translation.tolist())
+
+            if self.zoom_range is not None:
+                zoom = uniform(*self.zoom_range)
+                zoom_camera(zoom)
+
+        with self.profiler.stage('update_scene'):
+            update_scene()
+
+    def is_visible(self, obj):
+        """ checks if enough of the object is inside the camera frame
+        args:
+            obj: blender object
+        returns:
+            boolean
+        """
+        visible_fraction, box_area = get_visibility(
+            obj, self.hull_cache.get_vertices(obj))
+        return (visible_fraction >= self.min_visible_fraction and
+                box_area >= self.min_box_area)
+
+    def add_background(self):
+        """ adds a plain background or a random crop of the background pool
+        args:
+            None
+        returns:
+            None
+        """
+        if self.background == 'crop':
+            patch = self.background_pool.sample_patch()
+            if patch is not None:
+                add_array_background(patch)
+                return
+        RGB_values = randint(0, 256, 3).tolist()
+        add_plain_background(RGB_values)
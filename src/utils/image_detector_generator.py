@@ -1,30 +1,58 @@
 import os
-import glob
+import sys
 import random
 
 from numpy.random import uniform
 from numpy.random import randint
 import numpy as np
 
-from .data_manager import load_data
-from .data_manager import get_class_names
+from .shapenet_data_manager import ShapeNetDataManager
 
 from .blender_utils import load_obj
 from .blender_utils import change_light_conditions
-from .blender_utils import render_image
+from .blender_utils import enable_viewer_pass
+from .blender_utils import render_viewer
+from .blender_utils import read_viewer_pixels
+from .blender_utils import read_render_image
 from .blender_utils import view_selected_object
 from .blender_utils import set_render_properties
 from .blender_utils import rotate_object
 from .blender_utils import translate_object
 from .blender_utils import update_scene
-from .blender_utils import delete_scene
+from .blender_utils import clear_scene
+from .blender_utils import get_scene_state
+from .blender_utils import reset_scene
 from .blender_utils import add_plain_background
-from .blender_utils import add_random_patch_background
+from .blender_utils import add_array_background
 from .blender_utils import change_color
 from .blender_utils import zoom_camera
-from .blender_utils import get_image_bounding_box
+from .blender_utils import update_level_of_detail
+from .blender_utils import save_render_image
+from .blender_utils import get_visibility
+from .blender_utils import read_object_index_pass
+from .blender_utils import RENDER_PROFILES
+from .blender_utils import get_data_sizes
+from .blender_utils import purge_orphans
+from .background_pool import BackgroundPool
+from .mesh_cache import MeshCache
+from .mesh_cache import ConvexHullCache
+from .mesh_converter import LODSelector
+from .datablock_pool import LampPool
+from .datablock_pool import MaterialPool
+from .manifest import ProgressManifest
+from .manifest import seed_image
+from .manifest import update_metadata
+from .profiler import get_profiler
+from .packed_dataset import OUTPUT_FORMATS
+from .output_writers import SampleWriter
+from .output_writers import get_image_shape
+from .watchdog import MemoryWatchdog
+from .watchdog import RECYCLE_EXIT_CODE
+from .mask_utils import get_visible_boxes
+from .mask_utils import get_pixel_counts
+from .mask_utils import encode_rle
 
-from .xml_utils import write_xml
+from .annotation_writers import get_annotation_writer
 
 
 class ImageDetectorGenerator():
@@ -35,30 +63,39 @@ class ImageDetectorGenerator():
                  lamp_type='POINT', max_num_lamps=4,
                  lamp_location_range=[-15, 15], lamp_energy_range=[1, 5],
                  rotation_range=[0, 360], max_num_objects_in_scene=3,
-                 translation_range=None, zoom_range=None):
+                 translation_range=None, zoom_range=None,
+                 max_cached_vertices=int(5e6), max_cached_megabytes=None,
+                 use_convex_hull=True, full_detail=False,
+                 cache_path='../data/cache/',
+                 image_args=None, seed=None, manifest_path=None,
+                 annotation_format='voc', annotation_buffer_size=100,
+                 index_path=None, profile=False, profile_interval=100,
+                 min_visible_fraction=0., min_box_area=0.,
+                 max_pose_attempts=10, use_object_index=True,
+                 write_masks=False,
+                 memory_check_interval=50, soft_memory_megabytes=None,
+                 hard_memory_megabytes=None, max_datablocks=None,
+                 async_encoding=False, image_format='PNG', image_quality=90,
+                 num_encoding_workers=2, max_queued_images=8,
+                 output_format='files', max_shard_megabytes=256,
+                 render_profile=None, num_render_threads=None):
 
         if background not in ['plain', 'crop']:
             raise Exception("Backgrounds available are: 'plain' or 'crop'")
         if background == 'crop' and background_images_directory is None:
             raise Exception("Background 'crop' need background_images_path")
 
-        if background == 'crop':
-            self.background_image_paths = glob.glob(
-                            background_images_directory + '*.png')
-            if len(self.background_image_paths) == 0:
-                raise Exception(
-                        "There are no files with '.png' prefix in directory",
-                        self.background_image_paths)
-
-        self.blender_save_path = '../data/cache/current_scene.blend'
         self.obj_models_directory = obj_models_directory
         self.save_path = save_path
         if class_names == 'all':
-            self.class_names = get_class_names(obj_models_directory)
+            self.class_names = ShapeNetDataManager(
+                    obj_models_directory).get_class_names()
         else:
             self.class_names = class_names
         self.resolution = resolution
         self.resolution_percentage = resolution_percentage
+        self.render_profile = render_profile
+        self.num_render_threads = num_render_threads
         self.num_images = num_images
         self.background = background
         self.lamp_type = lamp_type
@@ -68,10 +105,60 @@ class ImageDetectorGenerator():
         self.rotation_range = rotation_range
         self.translation_range = translation_range
         self.zoom_range = zoom_range
+        self.hull_cache = ConvexHullCache(use_convex_hull)
+        self.mesh_cache = MeshCache(max_cached_vertices, max_cached_megabytes,
+                                    self.on_mesh_evicted)
+        self.lod_selector = LODSelector(resolution, resolution_percentage,
+                                        full_detail=full_detail)
+        self.cache_path = cache_path
+        if background == 'crop':
+            self.background_pool = BackgroundPool(background_images_directory)
+        self.seed = seed
+        if manifest_path is None:
+            manifest_path = self.save_path + 'manifest.txt'
+        self.manifest_path = manifest_path
+        self.annotation_format = annotation_format
+        self.annotation_buffer_size = annotation_buffer_size
+        self.index_path = index_path
         self.max_num_objects_in_scene = max_num_objects_in_scene
 
-        if not os.path.exists(self.save_path + 'annotations/'):
-            os.makedirs(self.save_path + 'annotations/')
+        self.profile = profile
+        self.profile_interval = profile_interval
+        self.profiler = get_profiler()
+        self.watchdog = MemoryWatchdog(
+            memory_check_interval, soft_memory_megabytes,
+            hard_memory_megabytes, max_datablocks, get_data_sizes,
+            purge_orphans)
+        if output_format not in OUTPUT_FORMATS:
+            raise Exception('Output formats available are:', OUTPUT_FORMATS)
+        if async_encoding and output_format != 'files':
+            raise Exception("async_encoding needs output_format 'files'")
+        self.output_format = output_format
+        self.max_shard_megabytes = max_shard_megabytes
+        self.async_encoding = async_encoding
+        self.image_format = image_format
+        self.image_quality = image_quality
+        self.num_encoding_workers = num_encoding_workers
+        self.max_queued_images = max_queued_images
+        self.is_over_memory_limit = False
+        self.lamp_pool = None
+        self.material_pool = None
+        self.min_visible_fraction = min_visible_fraction
+        self.min_box_area = min_box_area
+        if max_pose_attempts < 1:
+            raise ValueError('max_pose_attempts must be at least 1')
+        self.max_pose_attempts = max_pose_attempts
+        self.use_object_index = use_object_index
+        self.write_masks = write_masks
+        self.pose_stats = {'num_poses': 0, 'num_rejected': 0,
+                           'num_exhausted': 0}
+
+        if image_args is None:
+            image_args = range(self.num_images)
+        self.image_args = image_args
+
+        if not os.path.exists(self.cache_path):
+            os.makedirs(self.cache_path)
 
     def set_render_properties(self):
         """ sets the render properties regarding resolution and resolution
@@ -81,42 +168,250 @@ class ImageDetectorGenerator():
         returns:
             None
         """
-        set_render_properties(self.resolution, self.resolution_percentage)
+        set_render_properties(self.resolution, self.resolution_percentage,
+                              self.render_profile, self.num_render_threads)
 
-    def render(self):
+    def on_mesh_evicted(self, key, mesh):
+        """ drops the convex hull and the pooled material copies of a mesh
+        leaving the mesh cache
+        args:
+            key: string with the mesh key
+            mesh: blender mesh datablock
+        returns:
+            None
+        """
+        self.hull_cache.remove(key)
+        if self.material_pool is not None:
+            self.material_pool.remove_templates(mesh.materials)
+
+    def write_metadata(self):
+        """ writes the render settings of the run to 'metadata.json'
+        args:
+            None
+        returns:
+            None
+        """
+        if not os.path.exists(self.save_path):
+            os.makedirs(self.save_path, exist_ok=True)
+        metadata = {'resolution': list(self.resolution),
+                    'resolution_percentage': self.resolution_percentage,
+                    'render_profile': self.render_profile,
+                    'num_render_threads': self.num_render_threads,
+                    'render_settings': RENDER_PROFILES.get(
+                        self.render_profile),
+                    'min_visible_fraction': self.min_visible_fraction,
+                    'min_box_area': self.min_box_area,
+                    'output_format': self.output_format,
+                    'image_format': self.image_format,
+                    'seed': self.seed}
+        update_metadata(self.save_path + 'metadata.json', metadata)
+
+    def write_pose_stats(self):
+        """ adds the pose counters of the run to 'metadata.json'. Counters
+        of all workers and restarts are summed up.
+        args:
+            None
+        returns:
+            None
+        """
+        update_metadata(self.save_path + 'metadata.json', dict(),
+                        {'pose_stats': self.pose_stats})
+
+    def generate_samples(self, is_done=None, read_image=True):
+        """ renders the images one by one and yields them as soon as each
+        render finishes. Nothing is written to disk. The scene of an image
+        is kept until the next sample is requested, so consumers apply
+        backpressure by not requesting it. Stops when the memory watchdog
+        asks for a restart. Closing the generator early resets the scene.
+        args:
+            is_done: function taking an image arg and returning True for
+            images that have to be skipped. If None no image is skipped.
+            read_image: boolean. If False the image arrays are None, e.g.
+            when blender writes the files itself. The pixels are then only
+            read for the object index pass.
+        returns:
+            generator of (image_array, boxes, class_names, metadata) with
+            an uint8 array of shape (height, width, 3), a float array of
+            shape (num_objects, 4) with the projected boxes, a list with
+            the class names of the objects and a dictionary with the image
+            'key', its 'arg' in the dataset, its 'image_name' and, with
+            'use_object_index', the visible annotations of every object
+            in 'objects'
+        """
         self.set_render_properties()
-        path_to_class = load_data(self.obj_models_directory, self.class_names)
-        path_to_classes = []
-        for class_name in self.class_names:
-            path_to_class = load_data(self.obj_models_directory, [class_name])
-            path_to_classes.append(path_to_class)
-        data = list(path_to_class.items())
-        for image_arg in range(self.num_images):
+        enable_viewer_pass(self.use_object_index)
+        self.profiler = get_profiler(
+            self.profile, self.save_path + 'profile.jsonl',
+            self.profile_interval, get_data_sizes)
+        clear_scene()
+        # pooled datablocks are created before recording the scene state
+        # so that reset_scene keeps them
+        self.lamp_pool = LampPool(self.max_num_lamps)
+        self.material_pool = MaterialPool()
+        scene_state = get_scene_state()
+        data_manager = ShapeNetDataManager(
+            self.obj_models_directory, self.class_names, self.index_path)
+        class_to_data = dict()
+        for path, class_name in data_manager.load_data().items():
+            class_to_data.setdefault(class_name, []).append(
+                (path, class_name))
+        class_data = [class_to_data[class_name] for class_name
+                      in self.class_names if class_name in class_to_data]
+        self.is_over_memory_limit = False
+        try:
+            for image_arg in self.image_args:
+                if is_done is not None and is_done(image_arg):
+                    continue
+                if self.seed is not None:
+                    seed_image(self.seed, image_arg)
+                try:
+                    yield self.render_scene(image_arg, class_data,
+                                            read_image)
+                finally:
+                    # consumers stopping early close the generator at the
+                    # yield
+                    with self.profiler.stage('reset_scene'):
+                        reset_scene(scene_state)
+                        self.material_pool.release_all()
+                self.profiler.end_image(image_arg)
+                self.is_over_memory_limit = self.watchdog.check()
+                if self.is_over_memory_limit:
+                    break
+        finally:
+            self.profiler.report('mesh cache', self.mesh_cache.get_stats())
+            self.profiler.report('levels of detail',
+                                 self.lod_selector.get_stats())
+            self.profiler.report('poses', self.pose_stats)
+            self.profiler.report('pooled materials',
+                                 self.material_pool.get_stats())
+            self.profiler.report('memory watchdog', self.watchdog.stats)
+            self.profiler.close()
+            self.material_pool.clear()
+
+    def render_scene(self, image_arg, class_data, read_image=True):
+        """ builds and renders the scene of an image. The scene is reset by
+        the caller.
+        args:
+            image_arg: int with the image in the dataset
+            class_data: list with a list of (filepath, class_name) pairs
+            for every class
+            read_image: boolean. If False the image array is None.
+        returns:
+            (image_array, boxes, class_names, metadata) as yielded by
+            generate_samples
+        """
+        with self.profiler.stage('lights'):
             self.set_lights()
-            num_objects = random.randint(1, self.max_num_objects_in_scene)
-            objects, class_names, boxes_coordinates = [], [], []
-            for object_arg in range(num_objects):
-                path_to_class = random.sample(path_to_classes, 1)[0]
-                data = list(path_to_class.items())
-                filepath, class_name = random.sample(data, 1)[0]
-                obj = self.set_object(filepath, class_name)
-                objects.append(obj)
-                class_names.append(class_name)
-            image_name = self.make_image_name(image_arg)
-            for obj in objects:
-                obj.select = True
-            view_selected_object()
-            for obj in objects:
-                box_coordinates = get_image_bounding_box(obj)
+        num_objects = random.randint(1, self.max_num_objects_in_scene)
+        objects, class_names, boxes_coordinates = [], [], []
+        for object_arg in range(num_objects):
+            data = random.sample(class_data, 1)[0]
+            filepath, class_name = random.sample(data, 1)[0]
+            obj = self.set_object(filepath, class_name, 1. / num_objects)
+            obj.pass_index = object_arg + 1
+            objects.append(obj)
+            class_names.append(class_name)
+        for obj in objects:
+            obj.select = True
+        self.place_objects(objects)
+        with self.profiler.stage('bounding_box'):
+            for object_arg, obj in enumerate(objects):
+                obj, box_coordinates = update_level_of_detail(
+                    obj, self.lod_selector, self.hull_cache,
+                    self.mesh_cache, self.material_pool)
+                objects[object_arg] = obj
                 boxes_coordinates.append(box_coordinates)
-            render_image(image_name)
-            boxes_coordinates = np.asarray(boxes_coordinates)
-            write_xml(
-                self.save_path + 'annotations/' + str(image_arg) + '.xml',
-                'CLARA2017', image_name,
-                (self.resolution[0], self.resolution[1], 3),
-                boxes_coordinates, class_names)
-            delete_scene(self.blender_save_path)
+        with self.profiler.stage('render'):
+            render_viewer()
+            pixels, image_array = None, None
+            if read_image or self.use_object_index:
+                pixels = read_viewer_pixels()
+            if read_image:
+                image_array = read_render_image(pixels)
+        boxes_coordinates = np.asarray(boxes_coordinates)
+        metadata = {'key': image_arg, 'arg': image_arg,
+                    'image_name': self.make_image_name(image_arg)}
+        if self.use_object_index:
+            with self.profiler.stage('object_index'):
+                metadata['objects'] = self.get_visible_annotations(
+                    read_object_index_pass(pixels), boxes_coordinates)
+        return image_array, boxes_coordinates, class_names, metadata
+
+    def render(self):
+        self.write_metadata()
+        # manifest lines are written together with the annotations so that
+        # no image is marked as done before its annotation is on disk
+        manifest = ProgressManifest(self.manifest_path, buffer_size=None)
+        sample_writer = self.make_sample_writer()
+        # packed outputs store the annotations next to the images
+        annotation_writer = None
+        if not sample_writer.is_packed():
+            annotation_writer = get_annotation_writer(
+                self.annotation_format, self.save_path, self.class_names,
+                self.annotation_buffer_size)
+        # images written by blender do not need the pixels to be read
+        for image_array, boxes, class_names, metadata in (
+                self.generate_samples(manifest.is_done,
+                                      not sample_writer.saves_render())):
+            extras = metadata.get('objects')
+            with self.profiler.stage('write'):
+                labels = {'class_names': class_names,
+                          'boxes': boxes.tolist()}
+                if extras is not None:
+                    labels['objects'] = extras
+                image_path = sample_writer.write(
+                    image_array, labels, metadata)
+            with self.profiler.stage('manifest'):
+                for key, written_path, checksum in (
+                        sample_writer.get_written_images()):
+                    manifest.add(key, checksum)
+                # packed images are only returned once they are on disk
+                if annotation_writer is None:
+                    manifest.flush()
+            if annotation_writer is not None:
+                with self.profiler.stage('annotations'):
+                    flushed = annotation_writer.write(
+                        metadata['arg'], image_path,
+                        (self.resolution[0], self.resolution[1], 3),
+                        boxes, class_names, extras)
+                    if flushed:
+                        manifest.flush()
+        for key, written_path, checksum in sample_writer.close():
+            manifest.add(key, checksum)
+        if annotation_writer is not None:
+            annotation_writer.close()
+        manifest.flush()
+        self.write_pose_stats()
+        if self.is_over_memory_limit:
+            # the supervisor restarts the worker, which resumes from the
+            # manifest with a fresh blender process
+            sys.exit(RECYCLE_EXIT_CODE)
+
+    def make_sample_writer(self):
+        """ creates the writer of the output format. Image files are
+        encoded in background threads only with 'async_encoding'.
+        args:
+            None
+        returns:
+            SampleWriter instance
+        """
+        settings = RENDER_PROFILES.get(self.render_profile, {})
+        num_encoding_workers, save_render = 0, None
+        if self.async_encoding:
+            num_encoding_workers = self.num_encoding_workers
+        elif self.image_format == 'PNG':
+            # blender writes the files as before, color managed by the scene
+            save_render = save_render_image
+        class_names = self.class_names
+        num_images = self.num_images
+        max_num_objects = self.max_num_objects_in_scene
+        return SampleWriter(
+            self.save_path, self.output_format, num_images,
+            get_image_shape(self.resolution, self.resolution_percentage),
+            class_names, max_num_objects, self.image_format,
+            settings.get('compression', 15), self.image_quality,
+            num_encoding_workers, self.max_queued_images,
+            self.max_shard_megabytes, save_render)
 
     def make_image_name(self, image_arg, prefix='images'):
         """ construct the image name using the given labels
@@ -130,20 +425,89 @@ class ImageDetectorGenerator():
         image_name = self.save_path + prefix + '/' + str(image_arg)
         return image_name
 
+    def get_visible_annotations(self, index_map, boxes_coordinates):
+        """ computes the occlusion aware annotations of every object from
+        the object index pass of the render
+        args:
+            index_map: numpy array of shape (height, width) returned by
+            read_object_index_pass
+            boxes_coordinates: numpy array of shape (num_objects, 4) with
+            the projected boxes of every object
+        returns:
+            list with a dictionary for every object containing
+            'visible_box' as normalized [x_min, y_min, x_max, y_max] from
+            the top left corner, 'num_pixels', 'box_area_ratio' as the
+            visible box area over the projected box area, which is not
+            the fraction of visible pixels, and, if
+            'write_masks' is True, the run-length encoded 'mask'
+        """
+        num_objects = len(boxes_coordinates)
+        visible_boxes = get_visible_boxes(index_map, num_objects)
+        num_pixels = get_pixel_counts(index_map, num_objects)
+        visible_areas = ((visible_boxes[:, 2] - visible_boxes[:, 0]) *
+                         (visible_boxes[:, 3] - visible_boxes[:, 1]))
+        box_areas = np.abs(
+            (boxes_coordinates[:, 2] - boxes_coordinates[:, 0]) *
+            (boxes_coordinates[:, 3] - boxes_coordinates[:, 1]))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            box_area_ratios = np.where(
+                box_areas > 0, visible_areas / box_areas, 0.)
+        box_area_ratios = np.clip(box_area_ratios, 0., 1.)
+        extras = []
+        for object_arg in range(num_objects):
+            extra = {'visible_box': visible_boxes[object_arg].tolist(),
+                     'num_pixels': int(num_pixels[object_arg]),
+                     'box_area_ratio': float(box_area_ratios[object_arg])}
+            if self.write_masks:
+                extra['mask'] = encode_rle(index_map == object_arg + 1)
+            extras.append(extra)
+        return extras
+
     def set_lights(self):
         change_light_conditions(self.max_num_lamps, self.lamp_location_range,
-                                self.lamp_energy_range, self.lamp_type)
+                                self.lamp_energy_range, self.lamp_type,
+                                self.lamp_pool)
 
-    def set_object(self, filepath, class_name):
+    def set_object(self, filepath, class_name, projected_fraction=1.):
         """ constructs blender scene with the object in the file path given
         args:
             filepath: file path containing the .obj file
             class_name: the class name to name it inside blender
+            projected_fraction: expected fraction of the image covered by
+            the object, used for guessing its level of detail until it is
+            placed
         returns:
             obj: blender object file
         """
-        obj = load_obj(filepath, class_name)
+        with self.profiler.stage('load_obj'):
+            lod = self.lod_selector.select(filepath, projected_fraction,
+                                           record=False)
+            obj = load_obj(filepath, class_name, self.mesh_cache, lod=lod,
+                           material_pool=self.material_pool)
+
+        self.randomize_pose(obj)
+
+        if self.zoom_range is not None:
+            zoom = uniform(*self.zoom_range)
+            zoom_camera(zoom)
 
+        with self.profiler.stage('background'):
+            self.add_background()
+
+        with self.profiler.stage('color'):
+            change_color(obj)
+
+        with self.profiler.stage('update_scene'):
+            update_scene()
+        return obj
+
+    def randomize_pose(self, obj):
+        """ samples a new rotation and translation of an object
+        args:
+            obj: blender object
+        returns:
+            None
+        """
         if self.rotation_range is not None:
             rotation = uniform(*self.rotation_range, size=3)
             rotate_object(obj, rotation.tolist())
@@ -152,18 +516,56 @@ class ImageDetectorGenerator():
             translation = uniform(*self.translation_range, size=3)
             translate_object(obj, translation.tolist())
 
-        if self.zoom_range is not None:
-            zoom = uniform(*self.zoom_range)
-            zoom_camera(zoom)
-
-        if self.background == 'plain':
-            RGB_values = randint(0, 256, 3).tolist()
-            add_plain_background(RGB_values)
-        else:
-            image = random.choice(self.background_image_paths)
-            add_random_patch_background(image)
+    def place_objects(self, objects):
+        """ points the camera to the selected objects and resamples the
+        pose of objects that are not visible enough, until all are or
+        'max_pose_attempts' placements were tried
+        args:
+            objects: list of selected blender objects
+        returns:
+            None
+        """
+        for attempt_arg in range(self.max_pose_attempts):
+            with self.profiler.stage('view'):
+                view_selected_object()
+                update_scene()
+            self.pose_stats['num_poses'] += 1
+            with self.profiler.stage('visibility'):
+                hidden_objects = [obj for obj in objects
+                                  if not self.is_visible(obj)]
+            if len(hidden_objects) == 0:
+                return
+            self.pose_stats['num_rejected'] += 1
+            if attempt_arg == self.max_pose_attempts - 1:
+                break
+            for obj in hidden_objects:
+                self.randomize_pose(obj)
+            update_scene()
+        self.pose_stats['num_exhausted'] += 1
 
-        change_color(obj)
+    def is_visible(self, obj):
+        """ checks if enough of the object is inside the camera frame
+        args:
+            obj: blender object
+        returns:
+            boolean
+        """
+        visible_fraction, box_area = get_visibility(
+            obj, self.hull_cache.get_vertices(obj))
+        return (visible_fraction >= self.min_visible_fraction and
+                box_area >= self.min_box_area)
 
-        update_scene()
-        return obj
+    def add_background(self):
+        """ adds a plain background or a random crop of the background pool
+        args:
+            None
+        returns:
+            None
+        """
+        if self.background == 'crop':
+            patch = self.background_pool.sample_patch()
+            if patch is not None:
+                add_array_background(patch)
+                return
+        RGB_values = randint(0, 256, 3).tolist()
+        add_plain_background(RGB_values)
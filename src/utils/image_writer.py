@@ -0,0 +1,150 @@
+import io
+import os
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+IMAGE_EXTENSIONS = {'PNG': '.png', 'JPEG': '.jpg', 'WEBP': '.webp'}
+
+
+def encode_image(image_array, image_format='PNG', compression=15,
+                 quality=90):
+    """ encodes an image in memory
+    args:
+        image_array: uint8 array of shape (height, width, 3)
+        image_format: string, either 'PNG', 'JPEG' or 'WEBP'
+        compression: int between [0, 100] with the PNG compression as in
+        blender's image settings
+        quality: int between [1, 100] used by 'JPEG' and 'WEBP'
+    returns:
+        bytes of the encoded image
+    """
+    if image_format not in IMAGE_EXTENSIONS:
+        raise Exception('Image formats available are:',
+                        list(IMAGE_EXTENSIONS.keys()))
+    image = Image.fromarray(image_array)
+    image_buffer = io.BytesIO()
+    if image_format == 'PNG':
+        # same mapping from percentage to zlib level as blender
+        image.save(image_buffer, 'PNG',
+                   compress_level=int(compression / 11.1111))
+    else:
+        image.save(image_buffer, image_format, quality=quality)
+    return image_buffer.getvalue()
+
+
+def write_image(filepath, image_array, image_format='PNG', compression=15,
+                quality=90):
+    """ encodes an image and writes it atomically
+    args:
+        filepath: string with the path including the file extension
+        image_array: uint8 array of shape (height, width, 3)
+        image_format: string, either 'PNG', 'JPEG' or 'WEBP'
+        compression: int between [0, 100] used by 'PNG'
+        quality: int between [1, 100] used by 'JPEG' and 'WEBP'
+    returns:
+        string with the crc32 checksum of the file as in
+        manifest.get_file_checksum
+    """
+    image_bytes = encode_image(image_array, image_format, compression,
+                               quality)
+    directory = os.path.dirname(filepath)
+    if directory != '' and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = filepath + '.' + str(os.getpid()) + '.tmp'
+    with open(temporary_path, 'wb') as image_file:
+        image_file.write(image_bytes)
+    os.replace(temporary_path, filepath)
+    return '{:08x}'.format(zlib.crc32(image_bytes) & 0xffffffff)
+
+
+class AsyncImageWriter(object):
+    """ encodes and writes rendered images in background threads while the
+    next scene is built. At most 'max_queued_images' images wait to be
+    written; further writes block until one of them is done. Encoders
+    release the GIL, so the threads overlap with blender.
+
+    # Arguments
+        num_workers: int with the number of encoding threads. With zero
+        images are encoded synchronously.
+        max_queued_images: int
+        image_format: string, either 'PNG', 'JPEG' or 'WEBP'
+        compression: int between [0, 100] used by 'PNG'
+        quality: int between [1, 100] used by 'JPEG' and 'WEBP'
+    """
+
+    def __init__(self, num_workers=2, max_queued_images=8,
+                 image_format='PNG', compression=15, quality=90):
+        if image_format not in IMAGE_EXTENSIONS:
+            raise Exception('Image formats available are:',
+                            list(IMAGE_EXTENSIONS.keys()))
+        self.image_format = image_format
+        self.compression = compression
+        self.quality = quality
+        self.extension = IMAGE_EXTENSIONS[image_format]
+        self.executor = None
+        if num_workers > 0:
+            self.executor = ThreadPoolExecutor(num_workers)
+        self.slots = threading.BoundedSemaphore(max(max_queued_images, 1))
+        self.pending = []
+        self.completed = []
+
+    def write(self, key, filepath, image_array):
+        """ queues an image. Its checksum is returned by get_completed
+        once the file is on disk.
+        args:
+            key: string or int identifying the image in the manifest
+            filepath: string with the path without the file extension
+            image_array: uint8 array of shape (height, width, 3). It must
+            not be modified afterwards.
+        returns:
+            string with the filepath including the file extension
+        """
+        filepath = filepath + self.extension
+        if self.executor is None:
+            checksum = write_image(filepath, image_array, self.image_format,
+                                   self.compression, self.quality)
+            self.completed.append((key, filepath, checksum))
+            return filepath
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(
+                write_image, filepath, image_array, self.image_format,
+                self.compression, self.quality)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        self.pending.append((key, filepath, future))
+        return filepath
+
+    def get_completed(self, wait=False):
+        """ returns the images written since the last call in the order
+        they were queued. Errors of the encoding threads are raised here.
+        args:
+            wait: boolean. If True all queued images are waited for.
+        returns:
+            list of (key, filepath, checksum) tuples
+        """
+        completed, self.completed = self.completed, []
+        while len(self.pending) > 0:
+            key, filepath, future = self.pending[0]
+            if not (wait or future.done()):
+                break
+            completed.append((key, filepath, future.result()))
+            self.pending.pop(0)
+        return completed
+
+    def close(self):
+        """ waits for all queued images and stops the threads
+        args:
+            None
+        returns:
+            list of (key, filepath, checksum) tuples not returned before
+        """
+        completed = self.get_completed(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+        return completed
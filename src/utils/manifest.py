@@ -0,0 +1,171 @@
+import os
+import json
+import fcntl
+import zlib
+import random
+import hashlib
+
+import numpy as np
+
+
+def get_image_seed(base_seed, image_key):
+    """ derives the seed of a single image from the run seed and the image
+    key, independently of which process or in which order it is rendered
+    args:
+        base_seed: int
+        image_key: string or int identifying the image
+    returns:
+        int between [0, 2**32)
+    """
+    message = '{}/{}'.format(base_seed, image_key).encode('utf-8')
+    return int(hashlib.md5(message).hexdigest()[:8], 16)
+
+
+def seed_image(base_seed, image_key):
+    """ seeds the global 'random' and 'numpy.random' states for an image
+    args:
+        base_seed: int
+        image_key: string or int identifying the image
+    returns:
+        None
+    """
+    seed = get_image_seed(base_seed, image_key)
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def get_file_checksum(filepaths):
+    """ computes a crc32 checksum over the content of all given files
+    args:
+        filepaths: list of strings
+    returns:
+        string with the hexadecimal checksum
+    """
+    checksum = 0
+    for filepath in filepaths:
+        with open(filepath, 'rb') as data_file:
+            checksum = zlib.crc32(data_file.read(), checksum)
+    return '{:08x}'.format(checksum & 0xffffffff)
+
+
+def append_lines(filepath, lines):
+    """ appends lines to a file shared by several workers. A single write
+    on an O_APPEND file keeps the lines of concurrent workers from
+    interleaving.
+    args:
+        filepath: string
+        lines: list of strings ending with a new line
+    returns:
+        None
+    """
+    if len(lines) == 0:
+        return
+    file_descriptor = os.open(
+        filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(file_descriptor, ''.join(lines).encode('utf-8'))
+    finally:
+        os.close(file_descriptor)
+
+
+def write_metadata(filepath, metadata):
+    """ writes the settings of a run as a json file. Workers of the same
+    run write the same content, so the file is replaced atomically.
+    args:
+        filepath: string with the path of the '.json' file
+        metadata: dictionary with json serializable values
+    returns:
+        None
+    """
+    temporary_path = filepath + '.' + str(os.getpid()) + '.tmp'
+    with open(temporary_path, 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=4, sort_keys=True)
+    os.replace(temporary_path, filepath)
+
+
+def update_metadata(filepath, metadata, counters=None):
+    """ merges settings and counters of a worker into the json file of a
+    run. Workers of the same run write the same settings and add up their
+    counters, so the file is read and replaced under a lock. Stored keys
+    that are not given are kept.
+    args:
+        filepath: string with the path of the '.json' file
+        metadata: dictionary with json serializable values
+        counters: dictionary mapping keys to dictionaries of numbers that
+        are added to the stored ones. If None no counters are added.
+    returns:
+        None
+    """
+    with open(filepath + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        stored_metadata = dict()
+        if os.path.exists(filepath):
+            with open(filepath, 'r') as metadata_file:
+                stored_metadata = json.load(metadata_file)
+        stored_metadata.update(metadata)
+        if counters is not None:
+            for key, values in counters.items():
+                stored_values = stored_metadata.setdefault(key, dict())
+                for name, value in values.items():
+                    stored_values[name] = stored_values.get(name, 0) + value
+        write_metadata(filepath, stored_metadata)
+
+
+class ProgressManifest(object):
+    """ append-only manifest of completed images. Every line contains the
+    image key and the checksum of its outputs separated by a tab.
+
+    # Arguments
+        filepath: string with the path of the manifest file
+        buffer_size: int with the number of images written at once.
+        If None lines are only written when flush is called.
+    """
+
+    def __init__(self, filepath, buffer_size=1):
+        self.filepath = filepath
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.key_to_checksum = self._load(filepath)
+
+    def __contains__(self, key):
+        return str(key) in self.key_to_checksum
+
+    def __len__(self):
+        return len(self.key_to_checksum)
+
+    def is_done(self, key):
+        return str(key) in self.key_to_checksum
+
+    def add(self, key, checksum):
+        """ records an image as completed
+        args:
+            key: string or int identifying the image
+            checksum: string returned by get_file_checksum
+        returns:
+            None
+        """
+        key = str(key)
+        self.buffer.append(key + '\t' + checksum + '\n')
+        self.key_to_checksum[key] = checksum
+        if (self.buffer_size is not None and
+                len(self.buffer) >= self.buffer_size):
+            self.flush()
+
+    def flush(self):
+        append_lines(self.filepath, self.buffer)
+        self.buffer = []
+
+    def _load(self, filepath):
+        key_to_checksum = dict()
+        if not os.path.exists(filepath):
+            return key_to_checksum
+        with open(filepath, 'r') as manifest_file:
+            for line in manifest_file:
+                # lines cut by a crash do not end with a new line
+                if not line.endswith('\n'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 2:
+                    continue
+                key_to_checksum[fields[0]] = fields[1]
+        return key_to_checksum
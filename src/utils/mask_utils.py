@@ -0,0 +1,74 @@
+import numpy as np
+
+
+def get_pixel_counts(index_map, num_objects):
+    """ counts the visible pixels of every object in an object index map
+    args:
+        index_map: int array of shape (height, width). Pixels of object i
+        have value i + 1 and background pixels value zero.
+        num_objects: int
+    returns:
+        int array of shape (num_objects)
+    """
+    counts = np.bincount(index_map.ravel(), minlength=num_objects + 1)
+    return counts[1:num_objects + 1]
+
+
+def get_visible_boxes(index_map, num_objects):
+    """ computes the box enclosing the visible pixels of every object
+    args:
+        index_map: int array of shape (height, width). Pixels of object i
+        have value i + 1 and background pixels value zero.
+        num_objects: int
+    returns:
+        float array of shape (num_objects, 4) with normalized
+        [x_min, y_min, x_max, y_max] values measured from the top left
+        corner. Objects without visible pixels have zero boxes.
+    """
+    height, width = index_map.shape
+    index_map = np.clip(index_map, 0, num_objects + 1)
+    # marks for every object the rows and columns that contain its pixels
+    rows = np.zeros((num_objects + 2, height), dtype=bool)
+    rows[index_map, np.arange(height)[:, None]] = True
+    columns = np.zeros((num_objects + 2, width), dtype=bool)
+    columns[index_map, np.arange(width)[None, :]] = True
+    rows, columns = rows[1:num_objects + 1], columns[1:num_objects + 1]
+    y_min = np.argmax(rows, axis=1)
+    y_max = height - np.argmax(rows[:, ::-1], axis=1)
+    x_min = np.argmax(columns, axis=1)
+    x_max = width - np.argmax(columns[:, ::-1], axis=1)
+    boxes = np.stack([x_min / float(width), y_min / float(height),
+                      x_max / float(width), y_max / float(height)], axis=1)
+    boxes[~np.any(rows, axis=1)] = 0.
+    return boxes
+
+
+def encode_rle(mask):
+    """ encodes a binary mask as uncompressed COCO run-length encoding.
+    Runs are counted in column major order starting with background.
+    args:
+        mask: boolean array of shape (height, width)
+    returns:
+        dictionary with 'size' [height, width] and 'counts' list of ints
+    """
+    pixels = mask.ravel(order='F').astype(np.int8)
+    change_args = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    boundaries = np.concatenate([[0], change_args, [len(pixels)]])
+    counts = np.diff(boundaries).tolist()
+    if len(pixels) > 0 and pixels[0] == 1:
+        counts = [0] + counts
+    return {'size': list(mask.shape), 'counts': counts}
+
+
+def decode_rle(rle):
+    """ decodes an uncompressed COCO run-length encoding
+    args:
+        rle: dictionary returned by encode_rle
+    returns:
+        boolean array of shape (height, width)
+    """
+    height, width = rle['size']
+    counts = np.asarray(rle['counts'], dtype=np.int64)
+    values = np.arange(len(counts)) % 2 == 1
+    pixels = np.repeat(values, counts)
+    return pixels.reshape((height, width), order='F')
@@ -0,0 +1,229 @@
+from collections import OrderedDict
+
+import bpy
+
+from .blender_utils import get_convex_hull_vertices
+from .blender_utils import get_vertices
+
+# rough per element sizes of blender mesh data structures in bytes
+VERTEX_BYTES = 32
+LOOP_BYTES = 24
+POLYGON_BYTES = 24
+
+
+def get_mesh_size(mesh):
+    """ estimates the size of a mesh datablock
+    args:
+        mesh: blender mesh datablock
+    returns:
+        num_vertices: int with the number of vertices in the mesh
+        num_megabytes: float with the approximated memory used by the mesh
+    """
+    num_vertices = len(mesh.vertices)
+    num_bytes = (num_vertices * VERTEX_BYTES +
+                 len(mesh.loops) * LOOP_BYTES +
+                 len(mesh.polygons) * POLYGON_BYTES)
+    return num_vertices, num_bytes / 1e6
+
+
+def protect_mesh(mesh, protect=True):
+    """ sets or clears the fake user of a mesh and its materials, textures
+    and images so that they survive blender_utils.reset_scene
+    args:
+        mesh: blender mesh datablock
+        protect: boolean
+    returns:
+        None
+    """
+    mesh.use_fake_user = protect
+    for material in mesh.materials:
+        if material is None:
+            continue
+        material.use_fake_user = protect
+        for texture_slot in material.texture_slots:
+            if texture_slot is None or texture_slot.texture is None:
+                continue
+            texture = texture_slot.texture
+            texture.use_fake_user = protect
+            if getattr(texture, 'image', None) is not None:
+                texture.image.use_fake_user = protect
+
+
+class MeshCache(object):
+    """ LRU cache of imported and origin normalized meshes keyed by the
+    file path they were loaded from.
+
+    # Arguments
+        max_num_vertices: int with the maximum number of vertices kept
+        in memory. If None vertices are not used as budget.
+        max_megabytes: float with the maximum approximated memory used by
+        the cached meshes. If None memory is not used as budget.
+        on_evict: function called with the key and the mesh of every
+        evicted mesh before the mesh is removed from blender
+    """
+
+    def __init__(self, max_num_vertices=int(5e6), max_megabytes=None,
+                 on_evict=None):
+        self.max_num_vertices = max_num_vertices
+        self.max_megabytes = max_megabytes
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.num_vertices = 0
+        self.num_megabytes = 0.
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """ returns the cached entry of 'key' and marks it as recently used
+        args:
+            key: string with the file path of the model
+        returns:
+            entry: dictionary with the 'mesh', 'rotation' and 'scale' of
+            the imported object or None if key is not cached.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.num_misses = self.num_misses + 1
+            return None
+        self.num_hits = self.num_hits + 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, obj):
+        """ stores the mesh of obj in the cache
+        args:
+            key: string with the file path of the model
+            obj: blender object loaded from 'key'
+        returns:
+            None
+        """
+        if key in self.entries:
+            return
+        mesh = obj.data
+        num_vertices, num_megabytes = get_mesh_size(mesh)
+        if not self._fits(num_vertices, num_megabytes):
+            return
+        protect_mesh(mesh, True)
+        self.entries[key] = {'mesh': mesh,
+                             'rotation': obj.rotation_euler.copy(),
+                             'scale': obj.scale.copy(),
+                             'num_vertices': num_vertices,
+                             'num_megabytes': num_megabytes}
+        self.num_vertices = self.num_vertices + num_vertices
+        self.num_megabytes = self.num_megabytes + num_megabytes
+        while self._over_budget():
+            self.evict()
+
+    def evict(self):
+        """ removes the least recently used mesh from the cache. The mesh
+        is only removed from blender once no object is using it.
+        args:
+            None
+        returns:
+            None
+        """
+        key, entry = self.entries.popitem(last=False)
+        self.num_vertices = self.num_vertices - entry['num_vertices']
+        self.num_megabytes = self.num_megabytes - entry['num_megabytes']
+        self.num_evictions = self.num_evictions + 1
+        mesh = entry['mesh']
+        if self.on_evict is not None:
+            self.on_evict(key, mesh)
+        protect_mesh(mesh, False)
+        if mesh.users == 0:
+            bpy.data.meshes.remove(mesh)
+
+    def clear(self):
+        while len(self.entries) > 0:
+            self.evict()
+
+    def get_stats(self):
+        """ returns the cache counters
+        args:
+            None
+        returns:
+            dictionary with hits, misses, evictions and current usage
+        """
+        num_requests = self.num_hits + self.num_misses
+        hit_rate = self.num_hits / num_requests if num_requests > 0 else 0.
+        return {'num_hits': self.num_hits,
+                'num_misses': self.num_misses,
+                'hit_rate': hit_rate,
+                'num_evictions': self.num_evictions,
+                'num_meshes': len(self.entries),
+                'num_vertices': self.num_vertices,
+                'num_megabytes': self.num_megabytes}
+
+    def _fits(self, num_vertices, num_megabytes):
+        if (self.max_num_vertices is not None and
+                num_vertices > self.max_num_vertices):
+            return False
+        if (self.max_megabytes is not None and
+                num_megabytes > self.max_megabytes):
+            return False
+        return True
+
+    def _over_budget(self):
+        if (self.max_num_vertices is not None and
+                self.num_vertices > self.max_num_vertices):
+            return True
+        if (self.max_megabytes is not None and
+                self.num_megabytes > self.max_megabytes):
+            return True
+        return False
+
+
+class ConvexHullCache(object):
+    """ LRU cache of the convex hull vertices of every loaded model keyed by
+    the mesh key set by blender_utils.load_obj, i.e. per level of detail.
+    The projected bounding box of the hull vertices is exactly the one of
+    the mesh as long as the mesh lies in front of the camera.
+
+    # Arguments
+        use_convex_hull: boolean. If False all mesh vertices are returned.
+        max_num_entries: int with the maximum number of cached hulls
+    """
+
+    def __init__(self, use_convex_hull=True, max_num_entries=1024):
+        self.use_convex_hull = use_convex_hull
+        self.max_num_entries = max_num_entries
+        self.key_to_vertices = OrderedDict()
+
+    def __len__(self):
+        return len(self.key_to_vertices)
+
+    def get_vertices(self, obj):
+        """ returns the vertices used for projecting the bounding box of obj
+        args:
+            obj: blender object loaded with blender_utils.load_obj
+        returns:
+            numpy array of shape (num_vertices, 3) with local coordinates
+        """
+        key = obj.get('mesh_key')
+        if not self.use_convex_hull or key is None:
+            return get_vertices(obj)
+        vertices = self.key_to_vertices.get(key)
+        if vertices is not None:
+            self.key_to_vertices.move_to_end(key)
+            return vertices
+        vertices = get_convex_hull_vertices(obj)
+        self.key_to_vertices[key] = vertices
+        while len(self.key_to_vertices) > self.max_num_entries:
+            self.key_to_vertices.popitem(last=False)
+        return vertices
+
+    def remove(self, key):
+        """ drops the hull of a mesh, e.g. when it leaves the MeshCache
+        args:
+            key: string with the mesh key
+        returns:
+            None
+        """
+        self.key_to_vertices.pop(key, None)
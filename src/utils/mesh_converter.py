@@ -0,0 +1,556 @@
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+LOD_FACE_COUNTS = (2000, 8000, 32000)
+# version of the converted arrays. Older files are converted again.
+CONVERTED_VERSION = 2
+
+
+def get_converted_path(filepath):
+    """ returns the path of the converted mesh of an .obj file
+    args:
+        filepath: string with the path of the .obj file
+    returns:
+        string with the path of the '.npz' file next to it
+    """
+    return os.path.splitext(filepath)[0] + '.npz'
+
+
+def is_converted(filepath):
+    """ checks if an .obj file has an up to date converted mesh
+    args:
+        filepath: string with the path of the .obj file
+    returns:
+        boolean
+    """
+    return _is_up_to_date(get_converted_path(filepath), filepath)
+
+
+def _is_up_to_date(converted_path, filepath):
+    if not os.path.exists(converted_path):
+        return False
+    if os.path.getmtime(converted_path) < os.path.getmtime(filepath):
+        return False
+    # only the header of the archive is read here
+    with np.load(converted_path) as arrays:
+        if 'version' not in arrays.files:
+            return False
+        return int(arrays['version']) >= CONVERTED_VERSION
+
+
+def _to_arg(index, num_elements):
+    # obj indices start at one and negative ones are relative to the end
+    index = int(index)
+    if index < 0:
+        return num_elements + index
+    return index - 1
+
+
+def parse_mtl(filepath, obj_directory):
+    """ parses the colors and diffuse textures of a .mtl file as used by
+    the blender .obj importer
+    args:
+        filepath: string with the path of the .mtl file
+        obj_directory: string with the directory of the .obj file. Texture
+        paths are returned relative to it.
+    returns:
+        dictionary mapping material names to dictionaries with the
+        'diffuse' and 'specular' colors, the specular exponent 'hardness',
+        the 'alpha' and the 'texture' path, empty without texture
+    """
+    materials = dict()
+    material = None
+    mtl_directory = os.path.dirname(filepath)
+    with open(filepath, 'r') as mtl_file:
+        for line in mtl_file:
+            tokens = line.split()
+            if len(tokens) < 2:
+                continue
+            keyword = tokens[0]
+            if keyword == 'newmtl':
+                material = {'diffuse': (0.8, 0.8, 0.8),
+                            'specular': (1., 1., 1.), 'hardness': 98.,
+                            'alpha': 1., 'texture': ''}
+                materials[line.split(None, 1)[1].strip()] = material
+            elif material is None:
+                continue
+            elif keyword == 'Kd':
+                material['diffuse'] = tuple(map(float, tokens[1:4]))
+            elif keyword == 'Ks':
+                material['specular'] = tuple(map(float, tokens[1:4]))
+            elif keyword == 'Ns':
+                material['hardness'] = float(tokens[1])
+            elif keyword == 'd':
+                material['alpha'] = float(tokens[1])
+            elif keyword == 'map_Kd':
+                # options like '-s 1 1 1' precede the filename
+                texture_path = tokens[-1].replace('\\', '/')
+                texture_path = os.path.normpath(
+                    os.path.join(mtl_directory, texture_path))
+                material['texture'] = os.path.relpath(
+                    texture_path, obj_directory)
+    return materials
+
+
+def parse_obj(filepath):
+    """ parses vertices, uvs, faces and face materials of an .obj file.
+    The materials are looked up in the .mtl files of its 'mtllib' lines.
+    args:
+        filepath: string with the path of the .obj file
+    returns:
+        dictionary with the numpy arrays 'vertices' (num_vertices, 3),
+        'uvs' (num_uvs, 2), 'loop_vertex_args' and 'loop_uv_args'
+        (num_loops), 'loop_totals' and 'material_args' (num_polygons),
+        'material_names', 'material_diffuse' and 'material_specular'
+        (num_materials, 3), 'material_hardness', 'material_alpha' and
+        'material_textures' (num_materials) with texture paths relative
+        to the .obj file
+    """
+    vertices, uvs = [], []
+    loop_vertex_args, loop_uv_args = [], []
+    loop_totals, material_args, material_names = [], [], []
+    mtl_names = []
+    material_arg = 0
+    with open(filepath, 'r') as obj_file:
+        for line in obj_file:
+            if line.startswith('v '):
+                vertices.append(line.split()[1:4])
+            elif line.startswith('vt '):
+                uvs.append(line.split()[1:3])
+            elif line.startswith('f '):
+                tokens = line.split()[1:]
+                if len(tokens) < 3:
+                    continue
+                for token in tokens:
+                    indices = token.split('/')
+                    loop_vertex_args.append(
+                        _to_arg(indices[0], len(vertices)))
+                    if len(indices) > 1 and indices[1] != '':
+                        loop_uv_args.append(_to_arg(indices[1], len(uvs)))
+                    else:
+                        loop_uv_args.append(-1)
+                loop_totals.append(len(tokens))
+                material_args.append(material_arg)
+            elif line.startswith('usemtl '):
+                material_name = line.split(None, 1)[1].strip()
+                if material_name not in material_names:
+                    material_names.append(material_name)
+                material_arg = material_names.index(material_name)
+            elif line.startswith('mtllib '):
+                mtl_names.append(line.split(None, 1)[1].strip())
+    obj_directory = os.path.dirname(filepath)
+    materials = dict()
+    for mtl_name in mtl_names:
+        mtl_path = os.path.join(obj_directory, mtl_name)
+        if os.path.exists(mtl_path):
+            materials.update(parse_mtl(mtl_path, obj_directory))
+    default_material = {'diffuse': (0.8, 0.8, 0.8), 'specular': (1., 1., 1.),
+                        'hardness': 98., 'alpha': 1., 'texture': ''}
+    mesh_materials = [materials.get(material_name, default_material)
+                      for material_name in material_names]
+
+    def get_values(key, dtype):
+        return np.array([material[key] for material in mesh_materials],
+                        dtype=dtype)
+
+    return {'vertices': np.array(vertices, dtype=np.float32).reshape(-1, 3),
+            'uvs': np.array(uvs, dtype=np.float32).reshape(-1, 2),
+            'loop_vertex_args': np.array(loop_vertex_args, dtype=np.int32),
+            'loop_uv_args': np.array(loop_uv_args, dtype=np.int32),
+            'loop_totals': np.array(loop_totals, dtype=np.int32),
+            'material_args': np.array(material_args, dtype=np.int32),
+            'material_names': np.array(material_names, dtype=np.str_),
+            'material_diffuse': get_values('diffuse', np.float32).reshape(
+                -1, 3),
+            'material_specular': get_values('specular', np.float32).reshape(
+                -1, 3),
+            'material_hardness': get_values('hardness', np.float32),
+            'material_alpha': get_values('alpha', np.float32),
+            'material_textures': get_values('texture', np.str_)}
+
+
+def normalize_vertices(vertices):
+    """ applies the axis conversion of the blender .obj importer (Y up to
+    Z up) and moves the origin to the lowest point of the mesh as done by
+    blender_utils.load_obj
+    args:
+        vertices: numpy array of shape (num_vertices, 3)
+    returns:
+        numpy array of shape (num_vertices, 3)
+    """
+    x, y, z = vertices[:, 0], vertices[:, 1], vertices[:, 2]
+    vertices = np.stack([x, -z, y], axis=1)
+    if len(vertices) > 0:
+        vertices[:, 2] = vertices[:, 2] - vertices[:, 2].min()
+    return vertices
+
+
+def convert_obj(filepath, overwrite=False):
+    """ converts an .obj file into a '.npz' file with normalized vertices
+    args:
+        filepath: string with the path of the .obj file
+        overwrite: boolean. If False up to date conversions are skipped.
+    returns:
+        boolean indicating if the file was converted
+    """
+    if not overwrite and is_converted(filepath):
+        return False
+    mesh = parse_obj(filepath)
+    mesh['vertices'] = normalize_vertices(mesh['vertices'])
+    converted_path = get_converted_path(filepath)
+    temporary_path = converted_path[:-4] + '.' + str(os.getpid()) + '.npz'
+    np.savez(temporary_path, version=CONVERTED_VERSION,
+             num_faces=count_faces(mesh), **mesh)
+    os.replace(temporary_path, converted_path)
+    return True
+
+
+def count_faces(mesh):
+    """ returns the number of triangles of a parsed mesh
+    args:
+        mesh: dictionary returned by parse_obj
+    returns:
+        int
+    """
+    return int(np.sum(mesh['loop_totals'] - 2))
+
+
+def get_num_faces(filepath):
+    """ returns the number of triangles of the converted mesh of an .obj
+    file without loading its vertices
+    args:
+        filepath: string with the path of the .obj file
+    returns:
+        int
+    """
+    with np.load(get_converted_path(filepath)) as arrays:
+        if 'num_faces' in arrays.files:
+            return int(arrays['num_faces'])
+        # older conversions only have the number of corners of every face
+        return count_faces(arrays)
+
+
+def get_lod_path(filepath, num_faces):
+    """ returns the path of a decimated mesh of an .obj file
+    args:
+        filepath: string with the path of the .obj file
+        num_faces: int with the target number of triangles of the level
+    returns:
+        string with the path of the '.npz' file next to the .obj file
+    """
+    return os.path.splitext(filepath)[0] + '.lod' + str(num_faces) + '.npz'
+
+
+def get_available_lods(filepath, lod_face_counts=LOD_FACE_COUNTS):
+    """ returns the levels of detail of an .obj file that are up to date
+    args:
+        filepath: string with the path of the .obj file
+        lod_face_counts: list of ints with the target number of triangles
+    returns:
+        list of ints with the available target number of triangles
+    """
+    available_lods = []
+    for num_faces in lod_face_counts:
+        if _is_up_to_date(get_lod_path(filepath, num_faces), filepath):
+            available_lods.append(num_faces)
+    return available_lods
+
+
+def get_missing_lods(filepath, lod_face_counts=LOD_FACE_COUNTS):
+    """ returns the levels of detail that convert_lods still has to write.
+    Levels with at least as many triangles as the converted mesh are never
+    written and are not missing.
+    args:
+        filepath: string with the path of the .obj file
+        lod_face_counts: list of ints with the target number of triangles
+    returns:
+        list of ints with the missing target number of triangles
+    """
+    available_lods = get_available_lods(filepath, lod_face_counts)
+    missing_lods = [num_faces for num_faces in lod_face_counts
+                    if num_faces not in available_lods]
+    if len(missing_lods) == 0 or not is_converted(filepath):
+        return missing_lods
+    original_num_faces = get_num_faces(filepath)
+    return [num_faces for num_faces in missing_lods
+            if num_faces < original_num_faces]
+
+
+def select_lod(lod_face_counts, resolution, projected_fraction=1.,
+               faces_per_pixel=0.5):
+    """ selects the coarsest level of detail that still has about
+    'faces_per_pixel' triangles for every pixel covered by the object
+    args:
+        lod_face_counts: list of ints with the available levels
+        resolution: list of two ints with the image width and height
+        projected_fraction: float with the expected fraction of the image
+        covered by the object
+        faces_per_pixel: float
+    returns:
+        int with the selected level or None for full detail
+    """
+    num_pixels = resolution[0] * resolution[1] * projected_fraction
+    target_num_faces = num_pixels * faces_per_pixel
+    for num_faces in sorted(lod_face_counts):
+        if num_faces >= target_num_faces:
+            return num_faces
+    return None
+
+
+class LODSelector(object):
+    """ selects the level of detail loaded for every model from the render
+    resolution and the expected size of the object in the image. The
+    available levels of every model are only looked up once.
+
+    # Arguments
+        resolution: list of two ints with the image width and height
+        resolution_percentage: int with the render resolution percentage
+        lod_face_counts: list of ints with the target number of triangles
+        of the levels of detail written by convert_lods
+        faces_per_pixel: float with the number of triangles kept for every
+        pixel covered by the object
+        full_detail: boolean. If True the full meshes are always loaded.
+    """
+
+    def __init__(self, resolution, resolution_percentage=100,
+                 lod_face_counts=LOD_FACE_COUNTS, faces_per_pixel=0.5,
+                 full_detail=False):
+        scale = resolution_percentage / 100.
+        self.resolution = (resolution[0] * scale, resolution[1] * scale)
+        self.lod_face_counts = lod_face_counts
+        self.faces_per_pixel = faces_per_pixel
+        self.full_detail = full_detail
+        self.path_to_lods = dict()
+        self.lod_to_count = dict()
+
+    def select(self, filepath, projected_fraction=1., record=True):
+        """ selects the level of detail of a model
+        args:
+            filepath: string with the path of the .obj file
+            projected_fraction: float with the expected fraction of the
+            image covered by the object
+            record: boolean. If False the selection is not counted by
+            get_stats, e.g. for a guess made before the object is placed.
+        returns:
+            int with the level given to blender_utils.load_obj or None
+            for the full mesh
+        """
+        lod = None
+        if not self.full_detail:
+            available_lods = self.path_to_lods.get(filepath)
+            if available_lods is None:
+                available_lods = get_available_lods(
+                    filepath, self.lod_face_counts)
+                self.path_to_lods[filepath] = available_lods
+            lod = select_lod(available_lods, self.resolution,
+                             projected_fraction, self.faces_per_pixel)
+        if record:
+            self.lod_to_count[lod] = self.lod_to_count.get(lod, 0) + 1
+        return lod
+
+    def get_stats(self):
+        """ returns how many times every level of detail was selected
+        args:
+            None
+        returns:
+            dictionary mapping levels, or 'full', to counts
+        """
+        return dict(('full' if lod is None else lod, count)
+                    for lod, count in self.lod_to_count.items())
+
+
+def triangulate(mesh):
+    """ splits the polygons of a parsed mesh into triangle fans
+    args:
+        mesh: dictionary returned by parse_obj
+    returns:
+        loop_args: numpy array of shape (num_triangles, 3) with the loop
+        indices of every triangle
+        polygon_args: numpy array of shape (num_triangles) with the
+        polygon every triangle belongs to
+    """
+    loop_totals = mesh['loop_totals'].astype(np.int64)
+    loop_starts = np.zeros_like(loop_totals)
+    loop_starts[1:] = np.cumsum(loop_totals)[:-1]
+    num_triangles = loop_totals - 2
+    polygon_args = np.repeat(np.arange(len(loop_totals)), num_triangles)
+    first_triangle_args = np.zeros_like(num_triangles)
+    first_triangle_args[1:] = np.cumsum(num_triangles)[:-1]
+    fan_args = (np.arange(len(polygon_args)) -
+                np.repeat(first_triangle_args, num_triangles))
+    starts = loop_starts[polygon_args]
+    loop_args = np.stack(
+        [starts, starts + fan_args + 1, starts + fan_args + 2], axis=1)
+    return loop_args, polygon_args
+
+
+def cluster_vertices(vertices, triangles, grid_size):
+    """ decimates a triangle mesh by merging all vertices inside the same
+    cell of a regular grid
+    args:
+        vertices: numpy array of shape (num_vertices, 3)
+        triangles: numpy array of shape (num_triangles, 3) of vertex indices
+        grid_size: int with the number of cells along the longest side
+    returns:
+        new_vertices: numpy array of shape (num_new_vertices, 3)
+        new_triangles: numpy array of shape (num_kept_triangles, 3)
+        kept_args: indices of the kept triangles in 'triangles'
+    """
+    minimum = vertices.min(axis=0)
+    extent = max(float((vertices.max(axis=0) - minimum).max()), 1e-12)
+    cells = np.floor((vertices - minimum) / extent * grid_size)
+    cells = np.minimum(cells, grid_size - 1).astype(np.int64)
+    cell_keys = (cells[:, 0] * (grid_size ** 2) +
+                 cells[:, 1] * grid_size + cells[:, 2])
+    _, vertex_to_cluster = np.unique(cell_keys, return_inverse=True)
+    vertex_to_cluster = vertex_to_cluster.ravel()
+    num_clusters = vertex_to_cluster.max() + 1
+    counts = np.bincount(vertex_to_cluster, minlength=num_clusters)
+    new_vertices = np.zeros((num_clusters, 3), dtype=np.float64)
+    for axis in range(3):
+        new_vertices[:, axis] = np.bincount(
+            vertex_to_cluster, vertices[:, axis], num_clusters) / counts
+    new_triangles = vertex_to_cluster[triangles]
+    is_valid = ((new_triangles[:, 0] != new_triangles[:, 1]) &
+                (new_triangles[:, 1] != new_triangles[:, 2]) &
+                (new_triangles[:, 0] != new_triangles[:, 2]))
+    valid_args = np.where(is_valid)[0]
+    _, unique_args = np.unique(np.sort(new_triangles[valid_args], axis=1),
+                               axis=0, return_index=True)
+    kept_args = valid_args[np.sort(unique_args)]
+    return new_vertices.astype(np.float32), new_triangles[kept_args], kept_args
+
+
+def decimate_mesh(mesh, num_faces):
+    """ decimates a parsed mesh to at most 'num_faces' triangles with
+    vertex clustering, searching the finest grid that fits the budget
+    args:
+        mesh: dictionary returned by parse_obj
+        num_faces: int with the maximum number of triangles
+    returns:
+        dictionary with the same arrays as parse_obj
+    """
+    loop_args, polygon_args = triangulate(mesh)
+    triangles = mesh['loop_vertex_args'][loop_args]
+    best = None
+    min_grid_size, max_grid_size = 1, 1024
+    while min_grid_size <= max_grid_size:
+        grid_size = (min_grid_size + max_grid_size) // 2
+        decimated = cluster_vertices(mesh['vertices'], triangles, grid_size)
+        if len(decimated[1]) <= num_faces:
+            best = decimated
+            min_grid_size = grid_size + 1
+        else:
+            max_grid_size = grid_size - 1
+    vertices, new_triangles, kept_args = best
+    num_triangles = len(new_triangles)
+    decimated_mesh = {
+        'vertices': vertices,
+        'uvs': mesh['uvs'],
+        'loop_vertex_args': new_triangles.ravel().astype(np.int32),
+        'loop_uv_args': mesh['loop_uv_args'][
+            loop_args[kept_args]].ravel().astype(np.int32),
+        'loop_totals': np.full(num_triangles, 3, dtype=np.int32),
+        'material_args': mesh['material_args'][polygon_args[kept_args]]}
+    for key in mesh:
+        if key.startswith('material_') and key != 'material_args':
+            decimated_mesh[key] = mesh[key]
+    return decimated_mesh
+
+
+def convert_lods(filepath, lod_face_counts=LOD_FACE_COUNTS, overwrite=False):
+    """ writes the decimated levels of detail of an .obj file. Levels with
+    at least as many triangles as the original mesh are not written, and
+    are not looked at again while the converted mesh is up to date.
+    args:
+        filepath: string with the path of the .obj file
+        lod_face_counts: list of ints with the target number of triangles
+        overwrite: boolean. If False up to date levels are skipped.
+    returns:
+        lod_stats: list of (target, num_triangles, original_num_triangles)
+        tuples of the written levels
+    """
+    lod_stats = []
+    if overwrite:
+        missing_lods = list(lod_face_counts)
+    else:
+        missing_lods = get_missing_lods(filepath, lod_face_counts)
+    if len(missing_lods) == 0:
+        return lod_stats
+    if is_converted(filepath):
+        mesh = dict(np.load(get_converted_path(filepath)))
+    else:
+        mesh = parse_obj(filepath)
+        mesh['vertices'] = normalize_vertices(mesh['vertices'])
+    original_num_faces = count_faces(mesh)
+    for num_faces in missing_lods:
+        if num_faces >= original_num_faces:
+            continue
+        lod_mesh = decimate_mesh(mesh, num_faces)
+        lod_path = get_lod_path(filepath, num_faces)
+        temporary_path = lod_path[:-4] + '.' + str(os.getpid()) + '.npz'
+        np.savez(temporary_path, version=CONVERTED_VERSION, **lod_mesh)
+        os.replace(temporary_path, lod_path)
+        lod_stats.append((num_faces, len(lod_mesh['loop_totals']),
+                          original_num_faces))
+    return lod_stats
+
+
+def convert_models(filepaths, num_workers=None, overwrite=False,
+                   lod_face_counts=LOD_FACE_COUNTS):
+    """ converts many .obj files and their levels of detail in a process
+    pool
+    args:
+        filepaths: list of strings with the paths of the .obj files
+        num_workers: int with the number of processes. If None all cpus
+        are used.
+        overwrite: boolean. If False up to date conversions are skipped.
+        lod_face_counts: list of ints with the target number of triangles
+        of the levels of detail. If empty no levels are written.
+    returns:
+        stats: dictionary with the number of converted, skipped and
+        failed models, the elapsed time and for every level of detail
+        the number of written models and their number of triangles
+        before and after decimation
+    """
+    start_time = time.time()
+    num_converted, num_skipped, failed_paths = 0, 0, []
+    lod_stats = dict()
+    for num_faces in lod_face_counts:
+        lod_stats[num_faces] = {'num_models': 0, 'num_faces': 0,
+                                'num_original_faces': 0}
+    with Pool(num_workers) as pool:
+        results = pool.imap(_convert_obj, [
+            (filepath, overwrite, lod_face_counts)
+            for filepath in filepaths], chunksize=16)
+        for filepath, result in zip(filepaths, results):
+            if result is None:
+                failed_paths.append(filepath)
+                continue
+            converted, model_lod_stats = result
+            if converted:
+                num_converted = num_converted + 1
+            else:
+                num_skipped = num_skipped + 1
+            for target, num_faces, num_original_faces in model_lod_stats:
+                lod_stats[target]['num_models'] += 1
+                lod_stats[target]['num_faces'] += num_faces
+                lod_stats[target]['num_original_faces'] += num_original_faces
+    return {'num_converted': num_converted,
+            'num_skipped': num_skipped,
+            'failed_paths': failed_paths,
+            'lod_stats': lod_stats,
+            'elapsed_time': time.time() - start_time}
+
+
+def _convert_obj(args):
+    filepath, overwrite, lod_face_counts = args
+    try:
+        converted = convert_obj(filepath, overwrite)
+        lod_stats = convert_lods(filepath, lod_face_counts, overwrite)
+        return converted, lod_stats
+    except (OSError, ValueError, IndexError):
+        return None
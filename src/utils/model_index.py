@@ -0,0 +1,143 @@
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_directory_mtime(directory):
+    """ returns the modification time of a directory or None if it does
+    not exist
+    args:
+        directory: string
+    returns:
+        float or None
+    """
+    try:
+        return os.stat(directory).st_mtime
+    except OSError:
+        return None
+
+
+def scan_directory(directory, suffix='.obj'):
+    """ lists the model files of a directory
+    args:
+        directory: string ending with '/'
+        suffix: string that model file names have to contain
+    returns:
+        list of (path, size, mtime) tuples
+    """
+    models = []
+    try:
+        entries = list(os.scandir(directory))
+    except OSError:
+        return models
+    for entry in entries:
+        if suffix in entry.name and entry.is_file():
+            stat = entry.stat()
+            models.append((directory + entry.name, stat.st_size,
+                           stat.st_mtime))
+    return models
+
+
+class ModelIndex(object):
+    """ persistent SQLite index of model files. For every model it stores
+    path, class, file size and modification time. Directories are only
+    read again when their modification time changed.
+
+    # Arguments
+        index_path: string with the path of the SQLite file
+        suffix: string that model file names have to contain
+        num_workers: int with the number of threads used for reading
+        directories, which mostly wait on the (network) file system.
+    """
+
+    def __init__(self, index_path, suffix='.obj', num_workers=32):
+        self.index_path = index_path
+        self.suffix = suffix
+        self.num_workers = num_workers
+        self.connection = sqlite3.connect(index_path, timeout=60)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS directories (
+                path TEXT PRIMARY KEY, class_name TEXT, mtime REAL);
+            CREATE TABLE IF NOT EXISTS models (
+                path TEXT PRIMARY KEY, directory TEXT, class_name TEXT,
+                size INTEGER, mtime REAL);
+            CREATE INDEX IF NOT EXISTS models_class_name
+                ON models (class_name);
+            CREATE INDEX IF NOT EXISTS models_directory
+                ON models (directory);
+            """)
+
+    def __len__(self):
+        cursor = self.connection.execute('SELECT COUNT(*) FROM models')
+        return cursor.fetchone()[0]
+
+    def refresh(self, directory_to_class, prune=True):
+        """ updates the index with the models inside the given directories
+        args:
+            directory_to_class: dictionary mapping directories that contain
+            model files to their class name
+            prune: boolean. If True directories that are not given are
+            removed from the index.
+        returns:
+            num_changed: int with the number of directories read again
+        """
+        stored = dict()
+        for path, class_name, mtime in self.connection.execute(
+                'SELECT path, class_name, mtime FROM directories'):
+            stored[path] = (class_name, mtime)
+
+        directories = list(directory_to_class.keys())
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            mtimes = list(executor.map(get_directory_mtime, directories))
+            changed_directories = []
+            for directory, mtime in zip(directories, mtimes):
+                if stored.get(directory) != (directory_to_class[directory],
+                                             mtime):
+                    changed_directories.append((directory, mtime))
+            scans = list(executor.map(
+                lambda directory: scan_directory(directory[0], self.suffix),
+                changed_directories))
+
+        with self.connection:
+            for (directory, mtime), models in zip(changed_directories, scans):
+                class_name = directory_to_class[directory]
+                self.connection.execute(
+                    'DELETE FROM models WHERE directory = ?', (directory,))
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?)',
+                    [(path, directory, class_name, size, model_mtime)
+                     for path, size, model_mtime in models])
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO directories VALUES (?, ?, ?)',
+                    (directory, class_name, mtime))
+            if prune:
+                removed_directories = [(directory,) for directory in stored
+                                       if directory not in directory_to_class]
+                self.connection.executemany(
+                    'DELETE FROM models WHERE directory = ?',
+                    removed_directories)
+                self.connection.executemany(
+                    'DELETE FROM directories WHERE path = ?',
+                    removed_directories)
+        return len(changed_directories)
+
+    def query(self, class_names=None):
+        """ returns the indexed models of the given classes
+        args:
+            class_names: list of strings. If None all models are returned.
+        returns:
+            path_to_class: dictionary that maps paths to classes.
+        """
+        if class_names is None:
+            cursor = self.connection.execute(
+                'SELECT path, class_name FROM models ORDER BY path')
+        else:
+            class_names = list(class_names)
+            placeholders = ', '.join(['?'] * len(class_names))
+            cursor = self.connection.execute(
+                'SELECT path, class_name FROM models WHERE class_name IN (' +
+                placeholders + ') ORDER BY path', class_names)
+        return dict(cursor.fetchall())
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,139 @@
+import os
+
+from .image_writer import AsyncImageWriter
+from .manifest import get_file_checksum
+from .packed_dataset import ShardWriter
+from .packed_dataset import ArrayWriter
+from .packed_dataset import OUTPUT_FORMATS
+
+
+def get_image_shape(resolution, resolution_percentage=100):
+    """ returns the shape of the rendered images
+    args:
+        resolution: list of two ints with the image width and height
+        resolution_percentage: int between [1, 100]
+    returns:
+        tuple of two ints with the image height and width
+    """
+    scale = resolution_percentage / 100.
+    return (int(resolution[1] * scale), int(resolution[0] * scale))
+
+
+class SampleWriter(object):
+    """ writes the samples of a generator in one of OUTPUT_FORMATS and
+    tells which images are on disk, so that they can be added to the
+    manifest. 'files' images are encoded in background threads only with
+    'num_encoding_workers' larger than zero. Without them and with
+    'save_render' blender writes the files itself, which applies the color
+    management of the scene.
+
+    # Arguments
+        save_path: string with the directory of the dataset
+        output_format: string in OUTPUT_FORMATS
+        num_images: int with the number of rows of 'array' outputs
+        image_shape: list of two ints with the image height and width
+        class_names: list of strings with the classes of 'array' outputs
+        max_num_objects: int with the number of box slots of 'array'
+        outputs
+        image_format: string, either 'PNG', 'JPEG' or 'WEBP'
+        compression: int between [0, 100] used by 'PNG'
+        quality: int between [1, 100] used by 'JPEG' and 'WEBP'
+        num_encoding_workers: int with the number of encoding threads
+        max_queued_images: int
+        max_shard_megabytes: float with the size of 'shards' outputs
+        save_render: function writing the last render to a filepath without
+        extension and returning the filepath with extension, e.g.
+        blender_utils.save_render_image
+    """
+
+    def __init__(self, save_path, output_format='files', num_images=None,
+                 image_shape=None, class_names=None, max_num_objects=1,
+                 image_format='PNG', compression=15, quality=90,
+                 num_encoding_workers=0, max_queued_images=8,
+                 max_shard_megabytes=256, save_render=None):
+        if output_format not in OUTPUT_FORMATS:
+            raise Exception('Output formats available are:', OUTPUT_FORMATS)
+        self.image_writer = None
+        self.packed_writer = None
+        self.save_render = None
+        self.written_images = []
+        if (output_format == 'files' and num_encoding_workers == 0 and
+                save_render is not None):
+            self.save_render = save_render
+        elif output_format == 'files':
+            self.image_writer = AsyncImageWriter(
+                num_encoding_workers, max_queued_images, image_format,
+                compression, quality)
+        elif output_format == 'shards':
+            self.packed_writer = ShardWriter(
+                save_path + 'shards/', max_shard_megabytes, image_format,
+                compression, quality)
+        else:
+            self.packed_writer = ArrayWriter(
+                save_path + 'arrays/', num_images, image_shape, class_names,
+                max_num_objects)
+
+    def is_packed(self):
+        """ returns True if the labels are stored next to the images
+        instead of being written by an annotation writer
+        """
+        return self.packed_writer is not None
+
+    def saves_render(self):
+        """ returns True if blender writes the images from its last render,
+        in which case write does not need the image arrays
+        """
+        return self.save_render is not None
+
+    def write(self, image_array, labels, metadata):
+        """ writes a sample with the writer of the output format
+        args:
+            image_array: uint8 array of shape (height, width, 3). It can be
+            None if saves_render returns True.
+            labels: dictionary with the 'class_names' and 'boxes' of the
+            objects and optional json serializable annotations
+            metadata: dictionary yielded by generate_samples
+        returns:
+            string with the image filepath including its extension or None
+            for packed outputs
+        """
+        if self.save_render is not None:
+            directory = os.path.dirname(metadata['image_name'])
+            if directory != '' and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            filepath = self.save_render(metadata['image_name'])
+            self.written_images.append(
+                (metadata['key'], filepath, get_file_checksum([filepath])))
+            return filepath
+        if self.image_writer is not None:
+            return self.image_writer.write(
+                metadata['key'], metadata['image_name'], image_array)
+        self.written_images.extend(self.packed_writer.write(
+            metadata['key'], metadata['arg'], image_array, labels))
+        return None
+
+    def get_written_images(self, wait=False):
+        """ returns the images that are on disk since the last call
+        args:
+            wait: boolean. If True queued images are waited for.
+        returns:
+            list of (key, filepath, checksum) tuples
+        """
+        written_images, self.written_images = self.written_images, []
+        if self.image_writer is not None:
+            written_images.extend(self.image_writer.get_completed(wait))
+        return written_images
+
+    def close(self):
+        """ waits for all queued images and completes the packed output
+        args:
+            None
+        returns:
+            list of (key, filepath, checksum) tuples not returned before
+        """
+        written_images = self.get_written_images(wait=True)
+        if self.image_writer is not None:
+            self.image_writer.close()
+        if self.packed_writer is not None:
+            written_images.extend(self.packed_writer.close())
+        return written_images
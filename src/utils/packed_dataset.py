@@ -0,0 +1,424 @@
+import io
+import os
+import glob
+import json
+import mmap
+import zlib
+import tarfile
+
+import numpy as np
+from PIL import Image
+
+from .image_writer import encode_image
+from .image_writer import IMAGE_EXTENSIONS
+from .manifest import write_metadata
+
+# 'files' writes one image file per image as blender does
+OUTPUT_FORMATS = ('files', 'shards', 'array')
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+ARRAY_NAMES = ('images', 'class_args', 'boxes', 'is_written')
+
+
+def get_crc32(data):
+    return '{:08x}'.format(zlib.crc32(data) & 0xffffffff)
+
+
+def decode_image(image_bytes):
+    """ decodes an image read from a shard
+    args:
+        image_bytes: bytes or memoryview of an encoded image
+    returns:
+        uint8 numpy array of shape (height, width, 3)
+    """
+    return np.asarray(Image.open(io.BytesIO(image_bytes)).convert('RGB'))
+
+
+class ShardWriter(object):
+    """ packs encoded images and their labels into tar shards of bounded
+    size. Shards are written under a temporary name and renamed once they
+    are complete; their index is written last, so readers never see
+    unfinished shards. Several workers can write to the same directory.
+
+    # Arguments
+        save_path: string with the directory of the shards
+        max_shard_megabytes: float with the size after which a shard is
+        completed
+        image_format: string, either 'PNG', 'JPEG' or 'WEBP'
+        compression: int between [0, 100] used by 'PNG'
+        quality: int between [1, 100] used by 'JPEG' and 'WEBP'
+        prefix: string with the start of the shard names
+    """
+
+    def __init__(self, save_path, max_shard_megabytes=256,
+                 image_format='PNG', compression=15, quality=90,
+                 prefix='shard'):
+        if image_format not in IMAGE_EXTENSIONS:
+            raise Exception('Image formats available are:',
+                            list(IMAGE_EXTENSIONS.keys()))
+        self.save_path = save_path
+        self.max_shard_size = int(max_shard_megabytes * 1024 * 1024)
+        self.image_format = image_format
+        self.compression = compression
+        self.quality = quality
+        self.prefix = prefix
+        self.shard_arg = 0
+        self.tar = None
+        self.shard_path = None
+        self.index = None
+        self.pending = []
+        if not os.path.exists(self.save_path):
+            os.makedirs(self.save_path, exist_ok=True)
+
+    def write(self, key, arg, image_array, labels):
+        """ adds an image to the current shard
+        args:
+            key: string or int identifying the image in the manifest
+            arg: int with the position of the image in the dataset
+            image_array: uint8 array of shape (height, width, 3)
+            labels: dictionary with json serializable values
+        returns:
+            list of (key, filepath, checksum) tuples of the images whose
+            shard was completed by this write
+        """
+        if self.tar is None:
+            self._open_shard()
+        image_bytes = encode_image(image_array, self.image_format,
+                                   self.compression, self.quality)
+        label_bytes = json.dumps(labels, separators=(',', ':')).encode(
+            'utf-8')
+        name = str(key).replace('/', '_')
+        extension = IMAGE_EXTENSIONS[self.image_format]
+        image_offset = self._add_member(name + extension, image_bytes)
+        label_offset = self._add_member(name + '.json', label_bytes)
+        self.index['keys'].append(key)
+        self.index['args'].append(int(arg))
+        self.index['image_offsets'].append(image_offset)
+        self.index['image_sizes'].append(len(image_bytes))
+        self.index['label_offsets'].append(label_offset)
+        self.index['label_sizes'].append(len(label_bytes))
+        self.pending.append((key, get_crc32(image_bytes)))
+        if self.tar.offset >= self.max_shard_size:
+            return self._close_shard()
+        return []
+
+    def close(self):
+        """ completes the current shard
+        args:
+            None
+        returns:
+            list of (key, filepath, checksum) tuples of the images whose
+            shard was completed
+        """
+        if self.tar is None:
+            return []
+        return self._close_shard()
+
+    def _open_shard(self):
+        while True:
+            shard_name = '{}-{}-{:05d}.tar'.format(
+                self.prefix, os.getpid(), self.shard_arg)
+            self.shard_path = os.path.join(self.save_path, shard_name)
+            self.shard_arg = self.shard_arg + 1
+            if not os.path.exists(self.shard_path):
+                break
+        self.tar = tarfile.open(self.shard_path + '.tmp', 'w',
+                                format=tarfile.USTAR_FORMAT)
+        self.index = {'image_format': self.image_format, 'keys': [],
+                      'args': [], 'image_offsets': [], 'image_sizes': [],
+                      'label_offsets': [], 'label_sizes': []}
+
+    def _add_member(self, name, data):
+        tar_info = tarfile.TarInfo(name)
+        tar_info.size = len(data)
+        self.tar.addfile(tar_info, io.BytesIO(data))
+        # members are padded to whole blocks after their data
+        num_blocks = (len(data) + TAR_BLOCK_SIZE - 1) // TAR_BLOCK_SIZE
+        return self.tar.offset - num_blocks * TAR_BLOCK_SIZE
+
+    def _close_shard(self):
+        self.tar.close()
+        os.replace(self.shard_path + '.tmp', self.shard_path)
+        index_path = os.path.splitext(self.shard_path)[0] + '.index.json'
+        temporary_path = index_path + '.tmp'
+        with open(temporary_path, 'w') as index_file:
+            json.dump(self.index, index_file, separators=(',', ':'))
+        os.replace(temporary_path, index_path)
+        completed = [(key, self.shard_path, checksum)
+                     for key, checksum in self.pending]
+        self.tar, self.index, self.pending = None, None, []
+        return completed
+
+
+class ShardReader(object):
+    """ random access and sequential streaming over the shards of a
+    ShardWriter. Shards are memory mapped and images are returned as
+    memoryviews into them without copying.
+
+    # Arguments
+        save_path: string with the directory of the shards
+    """
+
+    def __init__(self, save_path):
+        self.save_path = save_path
+        self.shard_paths = []
+        self.entries = []
+        self.key_to_entry = {}
+        index_paths = sorted(glob.glob(
+            os.path.join(save_path, '*.index.json')))
+        for shard_arg, index_path in enumerate(index_paths):
+            with open(index_path, 'r') as index_file:
+                index = json.load(index_file)
+            self.shard_paths.append(
+                index_path[:-len('.index.json')] + '.tar')
+            for entry in zip(index['keys'], index['args'],
+                             index['image_offsets'], index['image_sizes'],
+                             index['label_offsets'], index['label_sizes']):
+                entry = (shard_arg,) + tuple(entry)
+                self.key_to_entry[entry[1]] = len(self.entries)
+                self.entries.append(entry)
+        self.shard_maps = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.key_to_entry
+
+    def __getitem__(self, key):
+        """ returns the image of a key
+        args:
+            key: string or int given to ShardWriter.write
+        returns:
+            image_bytes: memoryview of the encoded image
+            labels: dictionary
+        """
+        return self._read(self.entries[self.key_to_entry[key]])
+
+    def __iter__(self):
+        """ streams all images shard by shard in the order they were
+        written
+        returns:
+            generator of (key, arg, image_bytes, labels) tuples
+        """
+        for entry in self.entries:
+            image_bytes, labels = self._read(entry)
+            yield entry[1], entry[2], image_bytes, labels
+
+    def keys(self):
+        return [entry[1] for entry in self.entries]
+
+    def close(self):
+        """ closes the memory maps of the shards. A map can not be closed
+        while memoryviews returned by this reader still point into it;
+        such maps stay open until the views are released and close is
+        called again.
+        args:
+            None
+        returns:
+            int with the number of maps that are still open
+        """
+        open_maps = {}
+        for shard_arg, shard_map in self.shard_maps.items():
+            try:
+                shard_map.close()
+            except BufferError:
+                open_maps[shard_arg] = shard_map
+        self.shard_maps = open_maps
+        return len(open_maps)
+
+    def _get_shard_map(self, shard_arg):
+        shard_map = self.shard_maps.get(shard_arg)
+        if shard_map is None:
+            with open(self.shard_paths[shard_arg], 'rb') as shard_file:
+                shard_map = mmap.mmap(shard_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            self.shard_maps[shard_arg] = shard_map
+        return shard_map
+
+    def _read(self, entry):
+        (shard_arg, key, arg, image_offset, image_size,
+         label_offset, label_size) = entry
+        shard_view = memoryview(self._get_shard_map(shard_arg))
+        image_bytes = shard_view[image_offset:image_offset + image_size]
+        label_bytes = shard_view[label_offset:label_offset + label_size]
+        labels = json.loads(bytes(label_bytes).decode('utf-8'))
+        return image_bytes, labels
+
+
+def _open_array(filepath, shape, dtype, fill_value):
+    """ opens a .npy file as a writable memory map. The file is created
+    under a temporary name and linked to 'filepath', so that concurrent
+    workers never replace an array another worker already writes to.
+    """
+    if not os.path.exists(filepath):
+        temporary_path = filepath + '.' + str(os.getpid()) + '.tmp'
+        array = np.lib.format.open_memmap(temporary_path, 'w+', dtype, shape)
+        array[...] = fill_value
+        array.flush()
+        del array
+        try:
+            os.link(temporary_path, filepath)
+        except FileExistsError:
+            pass
+        os.remove(temporary_path)
+    array = np.lib.format.open_memmap(filepath, 'r+')
+    if array.shape != tuple(shape) or array.dtype != np.dtype(dtype):
+        raise Exception('Array', filepath, 'has shape', array.shape,
+                        'and dtype', array.dtype, 'instead of', shape, dtype)
+    return array
+
+
+class ArrayWriter(object):
+    """ writes fixed resolution images into memory mapped .npy arrays
+    together with padded class and box arrays. Every image has a fixed
+    row, so workers can fill disjoint rows of the same arrays. Boxes are
+    stored as normalized [x_min, y_min, x_max, y_max] from the top left
+    corner, whichever order of the corners they are given in.
+
+    # Arguments
+        save_path: string with the directory of the arrays
+        num_images: int with the number of rows
+        image_shape: list of two ints with the image height and width
+        class_names: list of strings. Labels store indices into it.
+        max_num_objects: int with the number of box slots of every image
+        buffer_size: int with the number of images after which the
+        arrays are flushed and the images are completed
+    """
+
+    def __init__(self, save_path, num_images, image_shape, class_names,
+                 max_num_objects=1, buffer_size=100):
+        self.save_path = save_path
+        self.class_names = list(class_names)
+        self.class_to_arg = dict(
+            zip(self.class_names, range(len(self.class_names))))
+        self.max_num_objects = max_num_objects
+        self.buffer_size = buffer_size
+        if not os.path.exists(self.save_path):
+            os.makedirs(self.save_path, exist_ok=True)
+        write_metadata(os.path.join(save_path, 'class_names.json'),
+                       self.class_names)
+        height, width = image_shape
+        self.images = _open_array(
+            self._get_path('images'), (num_images, height, width, 3),
+            np.uint8, 0)
+        self.class_args = _open_array(
+            self._get_path('class_args'), (num_images, max_num_objects),
+            np.int16, -1)
+        self.boxes = _open_array(
+            self._get_path('boxes'), (num_images, max_num_objects, 4),
+            np.float32, 0.)
+        self.is_written = _open_array(
+            self._get_path('is_written'), (num_images,), np.bool_, False)
+        self.pending = []
+
+    def _get_path(self, name):
+        return os.path.join(self.save_path, name + '.npy')
+
+    def write(self, key, arg, image_array, labels):
+        """ writes an image into its row
+        args:
+            key: string or int identifying the image in the manifest
+            arg: int with the row of the image
+            image_array: uint8 array of shape (height, width, 3)
+            labels: dictionary with the 'class_names' and 'boxes' of the
+            objects. Other labels are not stored.
+        returns:
+            list of (key, filepath, checksum) tuples of the images that
+            were flushed by this write
+        """
+        class_names = labels['class_names'][:self.max_num_objects]
+        num_objects = len(class_names)
+        self.images[arg] = image_array
+        self.class_args[arg] = -1
+        self.class_args[arg, :num_objects] = [
+            self.class_to_arg[class_name] for class_name in class_names]
+        self.boxes[arg] = 0.
+        boxes = np.asarray(labels['boxes'], dtype=np.float32).reshape(-1, 4)
+        boxes = boxes[:num_objects]
+        # projected boxes have their y corners swapped
+        self.boxes[arg, :num_objects, :2] = np.minimum(
+            boxes[:, :2], boxes[:, 2:])
+        self.boxes[arg, :num_objects, 2:] = np.maximum(
+            boxes[:, :2], boxes[:, 2:])
+        checksum = get_crc32(np.ascontiguousarray(image_array).tobytes())
+        self.pending.append((key, arg, checksum))
+        if len(self.pending) >= self.buffer_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """ writes the buffered rows to disk and marks them as written
+        args:
+            None
+        returns:
+            list of (key, filepath, checksum) tuples of the flushed images
+        """
+        if len(self.pending) == 0:
+            return []
+        self.images.flush()
+        self.class_args.flush()
+        self.boxes.flush()
+        for key, arg, checksum in self.pending:
+            self.is_written[arg] = True
+        self.is_written.flush()
+        images_path = self._get_path('images')
+        completed = [(key, images_path, checksum)
+                     for key, arg, checksum in self.pending]
+        self.pending = []
+        return completed
+
+    def close(self):
+        """ flushes the buffered rows and closes the memory maps
+        args:
+            None
+        returns:
+            list of (key, filepath, checksum) tuples of the flushed images
+        """
+        completed = self.flush()
+        del self.images, self.class_args, self.boxes, self.is_written
+        return completed
+
+
+class ArrayReader(object):
+    """ zero copy access to the arrays of an ArrayWriter. Only rows that
+    were completely written are visible.
+
+    # Arguments
+        save_path: string with the directory of the arrays
+    """
+
+    def __init__(self, save_path):
+        self.save_path = save_path
+        with open(os.path.join(save_path, 'class_names.json'), 'r') as names:
+            self.class_names = json.load(names)
+        arrays = [np.load(os.path.join(save_path, name + '.npy'),
+                          mmap_mode='r') for name in ARRAY_NAMES]
+        self.images, self.class_args, self.boxes, is_written = arrays
+        self.args = np.flatnonzero(is_written)
+
+    def __len__(self):
+        return len(self.args)
+
+    def __getitem__(self, arg):
+        """ returns the image of a row
+        args:
+            arg: int with the row of the image
+        returns:
+            image: uint8 array of shape (height, width, 3) mapped from disk
+            class_names: list of strings
+            boxes: float32 array of shape (num_objects, 4)
+        """
+        class_args = self.class_args[arg]
+        num_objects = int(np.sum(class_args >= 0))
+        class_names = [self.class_names[class_arg]
+                       for class_arg in class_args[:num_objects]]
+        return self.images[arg], class_names, self.boxes[arg, :num_objects]
+
+    def __iter__(self):
+        """ streams the written rows in order
+        returns:
+            generator of (arg, image, class_names, boxes) tuples
+        """
+        for arg in self.args:
+            image, class_names, boxes = self[arg]
+            yield int(arg), image, class_names, boxes
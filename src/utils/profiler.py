@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import resource
+from collections import deque
+
+import numpy as np
+
+from .manifest import append_lines
+
+
+def get_rss_megabytes():
+    """ returns the resident memory of the current process
+    args:
+        None
+    returns:
+        float with megabytes. The peak resident memory is returned where
+        '/proc' is not available.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as statm_file:
+            num_pages = int(statm_file.read().split()[1])
+        return num_pages * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is given in kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.profiler.add(self.name, time.perf_counter() - self.start_time)
+        return False
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        return False
+
+
+class NullProfiler(object):
+    """ profiler used when instrumentation is off. Stages are a shared
+    context manager that does nothing.
+    """
+    null_stage = _NullStage()
+
+    def stage(self, name):
+        return self.null_stage
+
+    def add(self, name, duration):
+        pass
+
+    def end_image(self, image_key):
+        pass
+
+    def report(self, name, stats):
+        pass
+
+    def close(self):
+        pass
+
+
+class StageProfiler(object):
+    """ times the stages of every rendered image. Records are appended to a
+    JSON lines file and a summary with the median and 95th percentile of
+    every stage is printed every 'summary_interval' images.
+
+    # Arguments
+        filepath: string with the path of the '.jsonl' file. If None
+        records are not written.
+        summary_interval: int with the number of images between summaries
+        window_size: int with the number of recent images used for the
+        percentiles
+        get_data_sizes: function returning a dictionary with the sizes of
+        the bpy.data collections. If None they are not reported.
+    """
+
+    def __init__(self, filepath=None, summary_interval=100, window_size=1000,
+                 get_data_sizes=None):
+        self.filepath = filepath
+        self.summary_interval = summary_interval
+        self.window_size = window_size
+        self.get_data_sizes = get_data_sizes
+        self.stage_to_durations = dict()
+        self.image_durations = dict()
+        self.image_times = deque(maxlen=window_size)
+        self.records = []
+        self.num_images = 0
+        self.image_start_time = time.perf_counter()
+
+    def stage(self, name):
+        """ returns a context manager that times a stage
+        args:
+            name: string with the stage name
+        returns:
+            context manager
+        """
+        return _Stage(self, name)
+
+    def add(self, name, duration):
+        """ adds the duration of a stage to the current image
+        args:
+            name: string with the stage name
+            duration: float with seconds
+        returns:
+            None
+        """
+        self.image_durations[name] = (
+            self.image_durations.get(name, 0.) + duration)
+
+    def end_image(self, image_key):
+        """ closes the record of the current image
+        args:
+            image_key: string or int identifying the image
+        returns:
+            None
+        """
+        end_time = time.perf_counter()
+        for name, duration in self.image_durations.items():
+            if name not in self.stage_to_durations:
+                self.stage_to_durations[name] = deque(maxlen=self.window_size)
+            self.stage_to_durations[name].append(duration)
+        self.image_times.append(end_time)
+        if self.filepath is not None:
+            self.records.append(json.dumps({
+                'image': str(image_key),
+                'pid': os.getpid(),
+                'total': end_time - self.image_start_time,
+                'stages': self.image_durations}) + '\n')
+        self.num_images = self.num_images + 1
+        self.image_durations = dict()
+        self.image_start_time = end_time
+        if (self.summary_interval and
+                self.num_images % self.summary_interval == 0):
+            self.flush()
+            print(self.format_summary(self.get_summary()))
+
+    def report(self, name, stats):
+        """ prints the counters of a component, e.g. a cache, and adds them
+        to the records
+        args:
+            name: string
+            stats: json serializable dictionary
+        returns:
+            None
+        """
+        print(name + ':', stats)
+        if self.filepath is not None:
+            self.records.append(json.dumps({
+                'report': name,
+                'pid': os.getpid(),
+                'stats': stats}) + '\n')
+
+    def get_summary(self):
+        """ summarizes the images inside the window
+        args:
+            None
+        returns:
+            dictionary with the number of images, images per second,
+            resident memory, bpy.data sizes and for every stage its median
+            and 95th percentile in milliseconds
+        """
+        summary = {'num_images': self.num_images,
+                   'rss_megabytes': get_rss_megabytes(),
+                   'stages': dict()}
+        if len(self.image_times) > 1:
+            elapsed_time = self.image_times[-1] - self.image_times[0]
+            summary['images_per_second'] = (
+                (len(self.image_times) - 1) / max(elapsed_time, 1e-9))
+        for name, durations in self.stage_to_durations.items():
+            p50, p95 = np.percentile(np.asarray(durations) * 1e3, [50, 95])
+            summary['stages'][name] = {'p50': p50, 'p95': p95}
+        if self.get_data_sizes is not None:
+            summary['data_sizes'] = self.get_data_sizes()
+        return summary
+
+    def format_summary(self, summary):
+        lines = ['images: {} images/s: {:.2f} rss: {:.0f}MB'.format(
+            summary['num_images'], summary.get('images_per_second', 0.),
+            summary['rss_megabytes'])]
+        for name, stats in sorted(summary['stages'].items()):
+            lines.append('  {:<20} p50: {:8.2f}ms p95: {:8.2f}ms'.format(
+                name, stats['p50'], stats['p95']))
+        if 'data_sizes' in summary:
+            lines.append('  bpy.data: ' + ' '.join(
+                '{}={}'.format(name, size) for name, size
+                in sorted(summary['data_sizes'].items())))
+        return '\n'.join(lines)
+
+    def flush(self):
+        if self.filepath is not None:
+            append_lines(self.filepath, self.records)
+        self.records = []
+
+    def close(self):
+        self.flush()
+        if self.num_images > 0 and (not self.summary_interval or
+                                    self.num_images % self.summary_interval):
+            print(self.format_summary(self.get_summary()))
+
+
+def get_profiler(enabled=False, filepath=None, summary_interval=100,
+                 get_data_sizes=None):
+    """ builds a StageProfiler or a NullProfiler
+    args:
+        enabled: boolean
+        filepath: string with the path of the '.jsonl' file or None
+        summary_interval: int with the number of images between summaries
+        get_data_sizes: function returning the bpy.data collection sizes
+    returns:
+        StageProfiler or NullProfiler
+    """
+    if not enabled:
+        return NullProfiler()
+    return StageProfiler(filepath, summary_interval,
+                         get_data_sizes=get_data_sizes)
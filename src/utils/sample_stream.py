@@ -0,0 +1,100 @@
+import queue
+import threading
+
+_END_OF_STREAM = object()
+
+
+class SampleQueue(object):
+    """ hands the samples of a generator's generate_samples to a consumer
+    running in another thread. Blender can only render from its main
+    thread, so the main thread feeds the queue while e.g. a training loop
+    iterates over it. At most 'prefetch_depth' samples are rendered ahead
+    of the consumer; afterwards rendering waits until it catches up.
+
+    # Arguments
+        prefetch_depth: int with the maximum number of waiting samples
+    """
+
+    def __init__(self, prefetch_depth=4):
+        self.queue = queue.Queue(maxsize=max(prefetch_depth, 1))
+        self.is_closed = False
+
+    def feed(self, samples):
+        """ puts samples into the queue until they are exhausted or the
+        consumer closes the queue. Has to be called from the thread that
+        renders.
+        args:
+            samples: iterable of samples
+        returns:
+            int with the number of samples put into the queue
+        """
+        num_samples = 0
+        try:
+            for sample in samples:
+                if not self._put(sample):
+                    break
+                num_samples = num_samples + 1
+        finally:
+            # generators stopped early run their cleanup right away
+            if hasattr(samples, 'close'):
+                samples.close()
+            self._put(_END_OF_STREAM)
+        return num_samples
+
+    def close(self):
+        """ stops the feeding thread after its current sample. Called by
+        consumers that stop early.
+        args:
+            None
+        returns:
+            None
+        """
+        self.is_closed = True
+
+    def __iter__(self):
+        while True:
+            sample = self.queue.get()
+            if sample is _END_OF_STREAM:
+                return
+            yield sample
+
+    def _put(self, sample):
+        while not self.is_closed:
+            try:
+                self.queue.put(sample, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+def consume_samples(samples, consumer, prefetch_depth=4):
+    """ renders samples on the calling thread and processes them with
+    'consumer' in a background thread
+    args:
+        samples: iterable of samples, e.g. from generate_samples
+        consumer: function called with every sample
+        prefetch_depth: int with the maximum number of waiting samples
+    returns:
+        int with the number of rendered samples
+    """
+    sample_queue = SampleQueue(prefetch_depth)
+    errors = []
+
+    def consume():
+        try:
+            for sample in sample_queue:
+                consumer(sample)
+        except Exception as error:
+            errors.append(error)
+            sample_queue.close()
+
+    consumer_thread = threading.Thread(target=consume)
+    consumer_thread.start()
+    try:
+        num_samples = sample_queue.feed(samples)
+    finally:
+        consumer_thread.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return num_samples
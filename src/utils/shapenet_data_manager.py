@@ -1,15 +1,56 @@
 import os
 
+from .model_index import ModelIndex
+
 
 class ShapeNetDataManager():
-    """ShapeNet data manager for models"""
+    """ShapeNet data manager for models
+
+    # Arguments
+        data_prefix: string data prefix containing all offsets
+        class_names: list of strings or None for all classes
+        index_path: string with the path of a persistent ModelIndex.
+        If None the dataset directories are walked on every load.
+        refresh_index: boolean. If True the index is refreshed before
+        answering load_data. An empty index is always refreshed.
+    """
 
-    def __init__(self, data_prefix, class_names=None):
+    def __init__(self, data_prefix, class_names=None, index_path=None,
+                 refresh_index=False):
         self.data_prefix = data_prefix
         self.class_names = class_names
+        self.index_path = index_path
+        self.refresh_index = refresh_index
 
     def load_data(self):
-        return self._load_data(self.data_prefix, self.class_names)
+        if self.index_path is None:
+            return self._load_data(self.data_prefix, self.class_names)
+        index = ModelIndex(self.index_path)
+        if self.refresh_index or len(index) == 0:
+            index.refresh(self.get_directory_to_class())
+        path_to_class = index.query(self.class_names)
+        index.close()
+        return path_to_class
+
+    def get_directory_to_class(self):
+        """ lists the 'models/' directory of every model in the dataset
+        args:
+            None
+        returns:
+            directory_to_class: dictionary mapping model directories to
+            their class name
+        """
+        directory_to_class = dict()
+        offset_to_name = self.get_offset_to_name()
+        for offset_entry in os.scandir(self.data_prefix):
+            class_name = offset_to_name.get(offset_entry.name)
+            if class_name is None or not offset_entry.is_dir():
+                continue
+            for model_entry in os.scandir(offset_entry.path):
+                traversed_path = (self.data_prefix + offset_entry.name + '/' +
+                                  model_entry.name + '/models/')
+                directory_to_class[traversed_path] = class_name
+        return directory_to_class
 
     def _load_data(self, data_prefix, class_names=None):
         """ Makes a dictionary containing the data samples paths as keys
@@ -0,0 +1,228 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+from .watchdog import RECYCLE_EXIT_CODE
+from .manifest import ProgressManifest
+
+
+def parse_worker_args(argv=None):
+    """ parses the sharding arguments given to a blender script after '--'
+    e.g. blender -bP generate_detection_data.py -- --num_workers 8
+    args:
+        argv: list of strings. If None sys.argv is used.
+    returns:
+        args: namespace with 'num_workers', 'worker_arg' and
+        'blender_path'. 'worker_arg' is None for the parent process.
+    """
+    if argv is None:
+        argv = sys.argv
+    if '--' in argv:
+        argv = argv[argv.index('--') + 1:]
+    else:
+        argv = []
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_workers', type=int, default=1)
+    parser.add_argument('--worker_arg', type=int, default=None)
+    parser.add_argument('--blender_path', type=str, default='blender')
+    args, _ = parser.parse_known_args(argv)
+    return args
+
+
+def is_parent(args):
+    """ returns True if the process has to launch workers instead of
+    rendering itself
+    args:
+        args: namespace returned by parse_worker_args
+    returns:
+        boolean
+    """
+    return args.worker_arg is None and args.num_workers > 1
+
+
+def get_shard(num_items, num_shards, shard_arg):
+    """ splits 'num_items' indices into contiguous disjoint shards
+    args:
+        num_items: int with the total number of items
+        num_shards: int with the number of shards
+        shard_arg: int between [0, num_shards) or None for all items
+    returns:
+        range with the item indices of the shard
+    """
+    if shard_arg is None:
+        return range(num_items)
+    if not 0 <= shard_arg < num_shards:
+        raise Exception('Invalid shard', shard_arg, 'for', num_shards)
+    shard_size, remainder = divmod(num_items, num_shards)
+    start = shard_arg * shard_size + min(shard_arg, remainder)
+    stop = start + shard_size + int(shard_arg < remainder)
+    return range(start, stop)
+
+
+def get_render_threads(num_workers):
+    """ splits the cpus between the blender processes rendering at once
+    args:
+        num_workers: int with the number of processes
+    returns:
+        int with the number of render threads of every process
+    """
+    return max((os.cpu_count() or 1) // max(num_workers, 1), 1)
+
+
+def get_worker_cache_path(cache_path, worker_arg):
+    """ returns a cache directory that is not shared with other workers
+    args:
+        cache_path: string with the base cache directory
+        worker_arg: int or None for a single process run
+    returns:
+        string with the cache directory of the worker
+    """
+    if worker_arg is None:
+        return cache_path
+    return cache_path + 'worker_' + str(worker_arg) + '/'
+
+
+def launch_worker(script_path, num_workers, worker_arg,
+                  blender_path='blender', extra_args=()):
+    """ launches one headless blender process rendering a shard
+    args:
+        script_path: string with the path of the python script to run
+        num_workers: int
+        worker_arg: int with the shard of the worker
+        blender_path: string with the blender executable
+        extra_args: list of strings appended after the worker arguments
+    returns:
+        process: subprocess.Popen
+    """
+    command = [blender_path, '-b', '-P', script_path, '--',
+               '--num_workers', str(num_workers),
+               '--worker_arg', str(worker_arg)]
+    command.extend(extra_args)
+    return subprocess.Popen(command)
+
+
+def launch_workers(script_path, num_workers, blender_path='blender',
+                   extra_args=()):
+    """ launches one headless blender process per worker
+    args:
+        script_path: string with the path of the python script to run
+        num_workers: int
+        blender_path: string with the blender executable
+        extra_args: list of strings appended after the worker arguments
+    returns:
+        processes: list of subprocess.Popen
+    """
+    processes = []
+    for worker_arg in range(num_workers):
+        processes.append(launch_worker(script_path, num_workers, worker_arg,
+                                       blender_path, extra_args))
+    return processes
+
+
+def count_completed_images(manifest_path):
+    """ returns the number of images recorded in a manifest
+    args:
+        manifest_path: string with the path of the manifest file
+    returns:
+        int
+    """
+    return len(ProgressManifest(manifest_path))
+
+
+def wait_for_workers(processes, num_images, start_time, restart_worker=None,
+                     max_restarts=100, poll_interval=1., manifest_path=None,
+                     num_completed_before=0):
+    """ waits for all workers and reports the aggregated throughput.
+    Workers that exit with RECYCLE_EXIT_CODE are restarted and resume
+    from their manifest.
+    args:
+        processes: list of subprocess.Popen
+        num_images: int with the total number of images of all workers
+        start_time: float with the time.time() the workers were launched
+        restart_worker: function taking a worker_arg and returning a new
+        subprocess.Popen. If None workers are not restarted.
+        max_restarts: int with the maximum number of restarts per worker
+        poll_interval: float with the seconds between checks
+        manifest_path: string with the manifest shared by the workers. If
+        None all 'num_images' are counted as rendered by this run.
+        num_completed_before: int with the images in the manifest before
+        the workers were launched
+    returns:
+        stats: dictionary with the elapsed time, the images rendered by
+        this run and their images per second, the worker return codes and
+        restarts
+    """
+    processes = list(processes)
+    return_codes = [None] * len(processes)
+    num_restarts = [0] * len(processes)
+    while any(return_code is None for return_code in return_codes):
+        for worker_arg, process in enumerate(processes):
+            if return_codes[worker_arg] is not None:
+                continue
+            return_code = process.poll()
+            if return_code is None:
+                continue
+            if (return_code == RECYCLE_EXIT_CODE and
+                    restart_worker is not None and
+                    num_restarts[worker_arg] < max_restarts):
+                print('restarting worker', worker_arg)
+                num_restarts[worker_arg] += 1
+                processes[worker_arg] = restart_worker(worker_arg)
+                continue
+            return_codes[worker_arg] = return_code
+        if any(return_code is None for return_code in return_codes):
+            time.sleep(poll_interval)
+    elapsed_time = time.time() - start_time
+    # images completed by a previous run were skipped by the workers
+    num_rendered = num_images
+    if manifest_path is not None:
+        num_rendered = (count_completed_images(manifest_path) -
+                        num_completed_before)
+    images_per_second = (num_rendered / elapsed_time
+                         if elapsed_time > 0 else 0.)
+    stats = {'num_workers': len(processes),
+             'num_images': num_images,
+             'num_rendered': num_rendered,
+             'elapsed_time': elapsed_time,
+             'images_per_second': images_per_second,
+             'return_codes': return_codes,
+             'num_restarts': num_restarts}
+    print('workers finished:', stats)
+    failed_workers = [worker_arg for worker_arg, return_code
+                      in enumerate(return_codes) if return_code != 0]
+    if len(failed_workers) > 0:
+        raise Exception('Workers failed', failed_workers)
+    return stats
+
+
+def render_in_workers(script_path, num_workers, num_images,
+                      blender_path='blender', manifest_path=None):
+    """ renders a generation script in 'num_workers' blender processes
+    and waits for all of them. Workers recycled by their memory watchdog
+    are restarted.
+    args:
+        script_path: string with the path of the python script to run
+        num_workers: int
+        num_images: int with the total number of images of all workers
+        blender_path: string with the blender executable
+        manifest_path: string with the manifest shared by the workers,
+        used for counting the images rendered by this run. If None all
+        'num_images' are counted.
+    returns:
+        stats: dictionary returned by wait_for_workers
+    """
+    num_completed_before = 0
+    if manifest_path is not None:
+        num_completed_before = count_completed_images(manifest_path)
+    start_time = time.time()
+    processes = launch_workers(script_path, num_workers, blender_path)
+
+    def restart_worker(worker_arg):
+        return launch_worker(script_path, num_workers, worker_arg,
+                             blender_path)
+
+    return wait_for_workers(processes, num_images, start_time,
+                            restart_worker, manifest_path=manifest_path,
+                            num_completed_before=num_completed_before)
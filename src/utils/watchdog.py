@@ -0,0 +1,75 @@
+from .profiler import get_rss_megabytes
+
+# exit code of a worker that stopped itself to be restarted by
+# sharding.wait_for_workers, i.e. EX_TEMPFAIL
+RECYCLE_EXIT_CODE = 75
+
+
+class MemoryWatchdog(object):
+    """ samples the resident memory and the number of blender datablocks
+    every 'check_interval' images. Orphan datablocks are purged when the
+    soft limits are exceeded and the worker is asked to restart itself
+    when the hard limit is exceeded.
+
+    # Arguments
+        check_interval: int with the number of images between checks
+        soft_megabytes: float with the resident memory above which orphans
+        are purged. If None memory does not trigger purges.
+        hard_megabytes: float with the resident memory above which the
+        worker has to be restarted. If None workers are never restarted.
+        max_datablocks: int with the number of datablocks above which
+        orphans are purged. If None it does not trigger purges.
+        get_data_sizes: function returning a dictionary with the sizes
+        of the bpy.data collections
+        purge_orphans: function removing orphan datablocks and returning
+        how many were removed
+    """
+
+    def __init__(self, check_interval=50, soft_megabytes=None,
+                 hard_megabytes=None, max_datablocks=None,
+                 get_data_sizes=None, purge_orphans=None):
+        self.check_interval = check_interval
+        self.soft_megabytes = soft_megabytes
+        self.hard_megabytes = hard_megabytes
+        self.max_datablocks = max_datablocks
+        self.get_data_sizes = get_data_sizes
+        self.purge_orphans = purge_orphans
+        self.num_images = 0
+        self.stats = {'num_checks': 0, 'num_purges': 0,
+                      'num_purged_datablocks': 0, 'max_rss_megabytes': 0.,
+                      'data_sizes': None}
+
+    def check(self):
+        """ counts a completed image and checks the limits when due
+        args:
+            None
+        returns:
+            boolean indicating if the worker has to be restarted
+        """
+        self.num_images = self.num_images + 1
+        if self.num_images % self.check_interval != 0:
+            return False
+        self.stats['num_checks'] += 1
+        rss_megabytes = get_rss_megabytes()
+        num_datablocks = 0
+        if self.get_data_sizes is not None:
+            data_sizes = self.get_data_sizes()
+            self.stats['data_sizes'] = data_sizes
+            num_datablocks = sum(data_sizes.values())
+        is_over_soft_limit = (
+            (self.soft_megabytes is not None and
+             rss_megabytes > self.soft_megabytes) or
+            (self.max_datablocks is not None and
+             num_datablocks > self.max_datablocks))
+        if is_over_soft_limit and self.purge_orphans is not None:
+            self.stats['num_purges'] += 1
+            self.stats['num_purged_datablocks'] += self.purge_orphans()
+            rss_megabytes = get_rss_megabytes()
+        self.stats['max_rss_megabytes'] = max(
+            self.stats['max_rss_megabytes'], rss_megabytes)
+        if (self.hard_megabytes is not None and
+                rss_megabytes > self.hard_megabytes):
+            print('resident memory', rss_megabytes, 'MB is over the limit',
+                  self.hard_megabytes, 'MB, the worker will be restarted')
+            return True
+        return False
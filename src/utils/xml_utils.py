@@ -1,11 +1,11 @@
 import os
-import glob
+from multiprocessing import Pool
 from xml.dom import minidom
 import xml.etree.ElementTree as ET
 
 import numpy as np
 
-from .data_manager import get_class_names
+from .shapenet_data_manager import ShapeNetDataManager
 
 
 def prettify(elem, doctype=None):
@@ -19,7 +19,31 @@ def prettify(elem, doctype=None):
 
 
 def write_xml(xml_pathname, folder_name, file_name,
-              img_shape, coordinates, names):
+              img_shape, coordinates, names, pretty=True):
+    xml_string = make_xml(folder_name, file_name, img_shape,
+                          coordinates, names, pretty)
+    text_file = open(xml_pathname, 'w')
+    text_file.write(xml_string)
+    text_file.close()
+
+
+def make_xml(folder_name, file_name, img_shape, coordinates, names,
+             pretty=False, extras=None):
+    """ builds a Pascal VOC annotation
+    args:
+        folder_name: string written in the 'folder' tag
+        file_name: string with the image name
+        img_shape: list of three ints (width, height, depth)
+        coordinates: array of shape (num_objects, 4) with the boxes
+        names: list of strings with the class name of every object
+        pretty: boolean. If True the xml is indented, which needs
+        reparsing it with minidom.
+        extras: list with a dictionary of additional fields for every
+        object. 'visible_box' is written as 'visible_bndbox', numbers as
+        tags and masks are skipped.
+    returns:
+        string with the xml annotation
+    """
     root = ET.Element('annotation')
 
     folder = ET.SubElement(root, 'folder')
@@ -63,10 +87,44 @@ def write_xml(xml_pathname, folder_name, file_name,
         y_max = ET.SubElement(bndbox, 'ymax')
         y_max.text = str(obj_coordinates[3])
 
-    pretty_root = prettify(root)
-    text_file = open(xml_pathname, 'w')
-    text_file.write(pretty_root)
-    text_file.close()
+        if extras is None:
+            continue
+        for key, value in sorted(extras[object_arg].items()):
+            if key == 'visible_box':
+                visible_bndbox = ET.SubElement(obj, 'visible_bndbox')
+                for tag, coordinate in zip(
+                        ['xmin', 'ymin', 'xmax', 'ymax'], value):
+                    element = ET.SubElement(visible_bndbox, tag)
+                    element.text = str(coordinate)
+            elif not isinstance(value, (dict, list)):
+                element = ET.SubElement(obj, key)
+                element.text = str(value)
+
+    if pretty:
+        return prettify(root)
+    return ET.tostring(root, encoding='unicode')
+
+
+def parse_annotation(filename_path):
+    """ parses a Pascal VOC annotation file
+    args:
+        filename_path: string with the path of the xml file
+    returns:
+        image_name: string with the content of the 'filename' tag
+        names: list of strings with the class name of every object
+        boxes: list of lists of four floats [xmin, ymin, xmax, ymax]
+    """
+    root = ET.parse(filename_path).getroot()
+    names, boxes = [], []
+    for object_tree in root.findall('object'):
+        names.append(object_tree.find('name').text)
+        for bounding_box in object_tree.iter('bndbox'):
+            xmin = float(bounding_box.find('xmin').text)
+            ymin = float(bounding_box.find('ymin').text)
+            xmax = float(bounding_box.find('xmax').text)
+            ymax = float(bounding_box.find('ymax').text)
+        boxes.append([xmin, ymin, xmax, ymax])
+    return root.find('filename').text, names, boxes
 
 
 class XMLParser(object):
@@ -98,44 +156,121 @@ class XMLParser(object):
 
         self.class_names = class_names
         if self.class_names == 'all':
-            self.class_names = get_class_names()
+            self.class_names = ShapeNetDataManager(None).get_class_names()
         self.num_classes = len(self.class_names)
         class_keys = np.arange(self.num_classes)
         self.arg_to_class = dict(zip(class_keys, self.class_names))
         self.class_to_arg = {value: key for key, value
                              in self.arg_to_class.items()}
 
-    def load_data(self):
+    def load_data(self, num_workers=None, use_cache=True):
+        """ parses all annotations. Parsed annotations are cached in
+        'annotations_cache.npz' inside the dataset path together with the
+        modification time of every file, so later loads only parse new or
+        modified files.
+        args:
+            num_workers: int with the number of parsing processes.
+            If None all cpus are used.
+            use_cache: boolean
+        returns:
+            data: dictionary as described in the class docstring
+        """
+        cache = self._update_cache(num_workers, use_cache)
+        class_args = self._to_class_args(cache['names'])
+        is_valid = class_args >= 0
+        one_hot_classes = np.zeros((len(class_args), self.num_classes))
+        one_hot_classes[np.where(is_valid)[0], class_args[is_valid]] = 1
+        boxes_data = np.hstack((cache['boxes'], one_hot_classes))
+        offsets = cache['offsets']
         data = dict()
-        filenames = glob.glob(self.annotations_path + '*.xml')
-        for filename_path in filenames:
-            tree = ET.parse(filename_path)
-            root = tree.getroot()
-            bounding_boxes = []
-            one_hot_classes = []
-            for object_tree in root.findall('object'):
-                class_name = object_tree.find('name').text
-                if class_name in self.class_names:
-                    one_hot_class = self._to_one_hot(class_name)
-                    one_hot_classes.append(one_hot_class)
-                    for bounding_box in object_tree.iter('bndbox'):
-                        xmin = float(bounding_box.find('xmin').text)
-                        ymin = float(bounding_box.find('ymin').text)
-                        xmax = float(bounding_box.find('xmax').text)
-                        ymax = float(bounding_box.find('ymax').text)
-                    bounding_box = [xmin, ymin, xmax, ymax]
-                    bounding_boxes.append(bounding_box)
-            if len(one_hot_classes) == 0:
+        for file_arg, image_name in enumerate(cache['image_names']):
+            start, stop = offsets[file_arg], offsets[file_arg + 1]
+            image_is_valid = is_valid[start:stop]
+            if not np.any(image_is_valid):
                 continue
-            image_name = root.find('filename').text
-            bounding_boxes = np.asarray(bounding_boxes)
-            one_hot_classes = np.asarray(one_hot_classes)
-            image_data = np.hstack((bounding_boxes, one_hot_classes))
-            if len(bounding_boxes.shape) == 1:
-                image_data = np.expand_dims(image_data, axis=0)
-            data[image_name + '.png'] = image_data
+            image_data = boxes_data[start:stop][image_is_valid]
+            image_name = str(image_name)
+            # older annotations stored png image names without extension
+            if os.path.splitext(image_name)[1] == '':
+                image_name = image_name + '.png'
+            data[image_name] = image_data
         return data
 
+    def _update_cache(self, num_workers, use_cache):
+        cache_path = self.dataset_path + 'annotations_cache.npz'
+        filename_to_mtime = dict()
+        for entry in os.scandir(self.annotations_path):
+            if entry.name.endswith('.xml'):
+                filename_to_mtime[entry.name] = entry.stat().st_mtime
+        filenames = sorted(filename_to_mtime.keys())
+        mtimes = np.array([filename_to_mtime[filename]
+                           for filename in filenames], dtype=np.float64)
+
+        cache = None
+        if use_cache and os.path.exists(cache_path):
+            cache = dict(np.load(cache_path))
+            if (len(cache['filenames']) == len(filenames) and
+                    np.array_equal(cache['filenames'], filenames) and
+                    np.array_equal(cache['mtimes'], mtimes)):
+                return cache
+
+        filename_to_cache_arg = dict()
+        if cache is not None:
+            for cache_arg, filename in enumerate(cache['filenames']):
+                if cache['mtimes'][cache_arg] == filename_to_mtime.get(
+                        filename):
+                    filename_to_cache_arg[str(filename)] = cache_arg
+
+        new_filenames = [filename for filename in filenames
+                         if filename not in filename_to_cache_arg]
+        new_paths = [self.annotations_path + filename
+                     for filename in new_filenames]
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if num_workers > 1 and len(new_paths) > 100:
+            with Pool(num_workers) as pool:
+                annotations = pool.map(parse_annotation, new_paths,
+                                       chunksize=256)
+        else:
+            annotations = [parse_annotation(path) for path in new_paths]
+        filename_to_annotation = dict(zip(new_filenames, annotations))
+
+        image_names, names, boxes, offsets = [], [], [], [0]
+        for filename in filenames:
+            if filename in filename_to_annotation:
+                image_name, image_names_list, image_boxes = (
+                    filename_to_annotation[filename])
+            else:
+                cache_arg = filename_to_cache_arg[filename]
+                start = cache['offsets'][cache_arg]
+                stop = cache['offsets'][cache_arg + 1]
+                image_name = str(cache['image_names'][cache_arg])
+                image_names_list = cache['names'][start:stop].tolist()
+                image_boxes = cache['boxes'][start:stop].tolist()
+            image_names.append(image_name)
+            names.extend(image_names_list)
+            boxes.extend(image_boxes)
+            offsets.append(len(names))
+
+        cache = {'filenames': np.array(filenames, dtype=np.str_),
+                 'mtimes': mtimes,
+                 'image_names': np.array(image_names, dtype=np.str_),
+                 'names': np.array(names, dtype=np.str_),
+                 'boxes': np.array(boxes, dtype=np.float64).reshape(-1, 4),
+                 'offsets': np.array(offsets, dtype=np.int64)}
+        if use_cache:
+            temporary_path = cache_path[:-4] + '.' + str(os.getpid()) + '.npz'
+            np.savez(temporary_path, **cache)
+            os.replace(temporary_path, cache_path)
+        return cache
+
+    def _to_class_args(self, names):
+        unique_names, inverse_args = np.unique(names, return_inverse=True)
+        unique_class_args = np.array(
+            [self.class_to_arg.get(str(name), -1) for name in unique_names],
+            dtype=np.int64)
+        return unique_class_args[inverse_args]
+
     def _to_one_hot(self, class_name):
         one_hot_vector = [0] * self.num_classes
         class_arg = self.class_to_arg[class_name]
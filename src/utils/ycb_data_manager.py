@@ -1,14 +1,19 @@
 import os
 from glob import glob
 
+from .model_index import ModelIndex
+
 YCB_DATA_PATH = '../data/models/'
 
 
 class YCBVideoDataManager(object):
 
-    def __init__(self, data_path=YCB_DATA_PATH, class_names='all'):
+    def __init__(self, data_path=YCB_DATA_PATH, class_names='all',
+                 index_path=None, refresh_index=False):
         self.data_path = data_path
         self.class_names = class_names
+        self.index_path = index_path
+        self.refresh_index = refresh_index
         if self.class_names == 'all':
             self.class_names = self.get_class_names()
 
@@ -23,6 +28,8 @@ class YCBVideoDataManager(object):
         returns:
             path_to_class: dictionary that maps paths to classes.
         """
+        if self.index_path is not None:
+            return self._load_indexed_data()
         path_to_class = dict()
         for class_name in self.class_names:
             class_path = os.path.join(self.data_path, class_name)
@@ -32,6 +39,22 @@ class YCBVideoDataManager(object):
             path_to_class[class_name] = obj_path
         return path_to_class
 
+    def _load_indexed_data(self):
+        index = ModelIndex(self.index_path)
+        if self.refresh_index or len(index) == 0:
+            directory_to_class = dict()
+            for class_name in self.get_class_names():
+                class_path = os.path.join(self.data_path, class_name) + '/'
+                directory_to_class[class_path] = class_name
+            index.refresh(directory_to_class)
+        path_to_class = index.query(self.class_names)
+        index.close()
+        class_to_path = dict()
+        for path, class_name in path_to_class.items():
+            if os.path.basename(path) == 'textured.obj':
+                class_to_path[class_name] = path
+        return class_to_path
+
     def get_class_names(self):
         """ Helper function for obtaining all classes in the YCB_Video dataset.
         args: